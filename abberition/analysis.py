@@ -17,8 +17,6 @@ def get_stats(image:CCDData):
     return stats
 
 
-# calculate an optical system distortion model from multiple WCS
-
 # calculate focal plane distortion
 
 # generate a 3d view of the focal plane
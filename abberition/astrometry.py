@@ -3,15 +3,24 @@ from ccdproc import CCDData
 # find stars in the image
 
 
-def solve_wcs(ccd:CCDData, out_fn=None):
+def solve_wcs(ccd:CCDData, out_fn=None, seed=None):
     '''
+    Seeded flow, if seed is given (the refined WCS of the previous frame of a sequence):
+    - find stars
+    - match bright stars with gaias projected with the seed, allowing for drift (see seed_wcs)
+    - refit the seed's pointing, rotation and scale, keeping its distortion
+    - falls back to the full flow if too few stars match
+
     WCS refinement flow:
     - load image
     - find stars
-    - get Astrometry.net (astnet) WCS with point pairs
-    - get gaias for astnet wcs
-    - project gaias to px with astnet wcs
-    - match found stars with astnet projected gaia pixels, keeping track of the gaia indices
+    - get initial WCS from the local solver index (see solver.py), or Astrometry.net if there is none,
+      searching near OBJCTRA/OBJCTDEC if the header has them
+    - get gaias for initial wcs
+    - if the library has a distortion model of the frame's setup, fit only the linear wcs with the
+      model's distortion and stop there (see distortion.py)
+    - project gaias to px with initial wcs
+    - match found stars with initial projected gaia pixels, keeping track of the gaia indices
     - get gwcs with matched star px to gaia sky coords with low spline order to handle edges
     - project all gaias via gwcs into pixels
     - match found stars with gaia gwcs pixels
@@ -44,24 +53,15 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     from astropy.io import fits
     from astropy.wcs.utils import fit_wcs_from_points
     from astropy.wcs import WCS
-    from gwcs.wcstools import wcs_from_points
-    import matplotlib.pyplot as plt
     import numpy as np
-    from numpy.linalg import norm
-    import os
-    import pathlib
-    import sys
     import logging
 
-    p = os.path.abspath("../processing")
-    if not p in sys.path:
-        sys.path.append(p)
-        
+    from . import background
+    from . import distortion
+    from . import metrics
+    from . import solver
     from . import wcs_helpers
 
-    log_status = True
-    log_plots = True
-
     ###############################################################################
     # Configuration Parameters
 
@@ -73,6 +73,7 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     fwhm_min = 1.5
     find_threshold = 3.0
     min_star_count = 20
+    star_count = 1000
 
     # wcs
     gaia_request_count = 1000
@@ -87,12 +88,15 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     data = im_hdu.data.astype(np.float32)
     width, height = np.shape(data)
 
+    pointing = __get_pointing(header)
+
     logging.info('removing existing wcs header')
     wcs_helpers.remove_wcs_header(header)
 
     # find star pixel locations, ordered by brightness
     logging.info('Finding stars in image.')
-    stars_tbl = find_stars(data, fwhm_est, fwhm_min, find_threshold)
+    bkg = background.get_background(data)
+    stars_tbl = find_stars(data, fwhm_est, fwhm_min, find_threshold, bkg=bkg, n_stars=star_count)
 
     #return
 
@@ -108,14 +112,31 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     all_star_indices = matched_star_indices
     logging.info(f'Found {len(stars_tbl)} stars.')
 
-    # Use astrometry.net for initial wcs
-    logging.info('Solving astrometry.net WCS')
-    astnet_wcs = wcs_helpers.solve_astrometry_net(stars_x_px, stars_y_px, width, height)
+    if seed is not None:
+        seeded = seed_wcs(seed, stars_px.T, data.shape, mag_limit=gaia_mag_limit)
+
+        if seeded is not None:
+            metrics.count('seeded_solves')
+            refined_wcs, gaias_tbl, matched_star_indices, matched_gaia_indices = seeded
+            return __save_solution(ccd, hdus, stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices,
+                                   refined_wcs.to_header(relax=True), refined_wcs, out_fn)
+
+        logging.info('Seed WCS not verified, solving blind')
+
+    metrics.count('blind_solves')
+
+    # initial wcs from the local solver index, or astrometry.net if there isn't one
+    if solver.has_index():
+        logging.info('Solving WCS with the local index')
+        initial_wcs = solver.solve(stars_x_px, stars_y_px, data.shape, center=pointing)
+    else:
+        logging.info('Solving astrometry.net WCS')
+        initial_wcs = wcs_helpers.solve_astrometry_net(stars_x_px, stars_y_px, width, height, center=pointing)
 
 
     # Get contained GAIA stars
     logging.info('Searching for gaia stars within wcs footprint')
-    gaias_tbl = wcs_helpers.gaia_get_wcs(astnet_wcs, (2048, 2048), max_count=gaia_request_count, mag_limit=gaia_mag_limit)
+    gaias_tbl = wcs_helpers.gaia_get_wcs(initial_wcs, (2048, 2048), max_count=gaia_request_count, mag_limit=gaia_mag_limit)
 
     # set up some data structures for the found gaiass
     gaias_ra = wcs_helpers.gaia_get_data(gaias_tbl, 'ra')
@@ -126,62 +147,22 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     matched_gaia_indices = np.array(range(len(gaias_ra)))
     logging.info(f'... found {len(gaias_tbl)} Gaia stars.')
 
-    def get_dists(src, dests):
-        # src is [a, b]
-        # dests is [[a0, a1, a2], [b0, b1, b2]]
-        diffs = np.array([src[0]-dests[0], src[1]-dests[1]])
-        dists = norm(diffs, axis=0)
-        return dists
-
-    def match_coords_px(stars_px, catalog_px):
-        #  idx: indices into catalog_sky of the closest star in the catalog
-        #  sep: separation of the closest star, NaN if bad result
-
-        num_stars = len(stars_px[0])
-        separations = [] #1.0e42 * np.ones(num_stars, dtype=np.float32)
-        indices = [] #np.zeros(num_stars, dtype=np.int32)
-
-        for i in range(num_stars):
-            # get distances to other stars
-            seps = get_dists(stars_px[:,i], catalog_px)
-            
-            # choose the closest
-            min_idx = seps.argmin()
-
-            # store the separation
-            #separations[i] = seps[min_idx]
-            #indices[i] = min_idx
-            separations.append(seps[min_idx])
-            indices.append(min_idx)
-
-        indices = np.array(indices)
-        separations = np.array(separations)
-
-        # remove stars with duplicate gaia indices 
-        for i in range(num_stars):
-            dups = [i]
-            i_idx = indices[i]
-
-            # get list of duplicates
-            for j in range(i+1,num_stars):
-                if i_idx == indices[j]:
-                    dups.append(j)
-
-            # if there are dups, find the nearest stars and their offsets from the 
-            # paired stars and find which of the dups is closest to that point
-            if len(dups) > 1:
-                # just setting separations to NaN so we don't use the points
-                separations[dups] = np.NaN
-
-        return np.array(indices), np.array(separations)    
+    # with a distortion model of the setup in the library only the linear wcs is fit (see distortion.py)
+    model = distortion.get_model(header)
+    if model is not None:
+        prior = distortion.refine_with_model(initial_wcs, model, stars_px.T, gaias_ra, gaias_dec, max_sep_px)
 
-    logging.info('matching gaia projections with found star positions')
-    astnet_gaias_px = np.array(astnet_wcs.world_to_pixel(gaias_sky))
-    idx, sep = match_coords_px(stars_px, astnet_gaias_px)
-    logging.info(f'Found {sum(np.isnan(sep))} stars with duplicate gaias')
+        if prior is not None:
+            prior_wcs, matched_star_indices, matched_gaia_indices = prior
+            return __save_solution(ccd, hdus, stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices,
+                                   prior_wcs.to_header(relax=True), prior_wcs, out_fn)
+
+        logging.info('Distortion model not verified, fitting the distortion of the frame')
 
-    is_dup = np.isnan(sep)
-    dup_gaia_ind = idx[is_dup]
+    logging.info('matching gaia projections with found star positions')
+    initial_gaias_px = np.array(initial_wcs.world_to_pixel(gaias_sky))
+    idx, sep = wcs_helpers.match_coords_px(stars_px, initial_gaias_px, max_sep_px)
+    logging.info(f'Found {sum(np.isnan(sep))} stars without a gaia match')
 
     sep_constraint = (sep < max_sep_px) & ~np.isnan(sep)
 
@@ -191,18 +172,19 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     matched_gaias_sky_np = np.array([matched_gaias_sky.ra.deg, matched_gaias_sky.dec.deg])
 
     # track indices
-    star_gaia_dup_indices = matched_star_indices[sep == np.NaN]
-
     matched_star_indices = matched_star_indices[sep_constraint]
     matched_gaia_indices = matched_gaia_indices[idx[sep_constraint]]
 
+    # gwcs is only needed for blind solves
+    from gwcs.wcstools import wcs_from_points
+
     logging.info('calculating gwcs')
     gwcs_wcs = wcs_from_points(matched_stars_px, matched_gaias_sky)
 
     # Refine gwcs by removing all more than x stdev's from wcs says they should be
-    matched_gaias_gwcs_px = np.array(gwcs_wcs.world_to_pixel(matched_gaias_sky_np[0], matched_gaias_sky_np[1]))
+    matched_gaias_gwcs_px = np.array(gwcs_wcs.world_to_pixel_values(matched_gaias_sky_np[0], matched_gaias_sky_np[1]))
     diff_gwcs = matched_gaias_gwcs_px - matched_stars_px
-    dist_gwcs = get_dists([0, 0], diff_gwcs)
+    dist_gwcs = np.hypot(*diff_gwcs)
     std_gwcs = np.std(dist_gwcs)
 
     dist_in_range = dist_gwcs < gwcs_refin_max_stdev * std_gwcs
@@ -218,6 +200,14 @@ def solve_wcs(ccd:CCDData, out_fn=None):
 
     refined_wcs = WCS(refined_gwcs_fits)
 
+    return __save_solution(ccd, hdus, stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices, refined_gwcs_fits, refined_wcs,
+                           out_fn)
+
+
+def __save_solution(ccd:CCDData, hdus, stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices, wcs_header, wcs, out_fn) -> CCDData:
+    import logging
+    from . import wcs_helpers
+
     logging.info('creating data table for fits')
     fits_tbl = wcs_helpers.create_starinfo_table(stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices)
     hdus.append(fits_tbl)
@@ -225,7 +215,7 @@ def solve_wcs(ccd:CCDData, out_fn=None):
     logging.info('writing fits output file')
     
     # save to output file
-    hdus[0].header.update(refined_gwcs_fits)
+    hdus[0].header.update(wcs_header)
 
     if out_fn is not None:
         hdus.writeto(out_fn, overwrite=True)
@@ -233,11 +223,132 @@ def solve_wcs(ccd:CCDData, out_fn=None):
         wcs_ccd = CCDData.read(out_fn, unit="adu")  
     else:
         wcs_ccd = ccd.copy()
-        wcs_ccd.wcs = refined_wcs
+        wcs_ccd.wcs = wcs
     
     return wcs_ccd
 
-def find_stars(data, fwhm_est=2.0, fwhm_min=1.5, threshold_stddevs=4.0, mask=None):
+
+def __get_pointing(header):
+    # (ra, dec) the telescope pointed at from OBJCTRA/OBJCTDEC, None if the header doesn't have them
+    from . import wcs_helpers
+
+    try:
+        pointing = wcs_helpers.get_fits_sky_coord(header)
+    except (KeyError, ValueError):
+        return None
+
+    return pointing.ra.deg, pointing.dec.deg
+
+
+def seed_wcs(seed, stars_px, shape, max_drift_px:float=30.0, tolerance_px:float=3.0, n_stars:int=50, min_matches:int=10,
+             mag_limit:float=17):
+    '''
+    Verify and refine a WCS seeded from an earlier frame of a sequence.
+
+    Gaia stars in the seed's footprint are projected into the frame with the seed. The drift since the
+    seed is the offset most of the brightest star pairs within max_drift_px agree on. The brightest
+    stars are then matched within tolerance_px of the drifted gaias, and the seed's pointing, rotation
+    and scale refit to them (see solver.refine_wcs).
+
+    Parameters
+    ----------
+    seed : WCS
+        WCS of an earlier frame with the same sensor, such as the previous frame.
+
+    stars_px : ndarray
+        (x, y) positions of the stars found, brightest first, shape (n, 2).
+
+    shape : tuple
+        (height, width) of the frame.
+
+    Returns
+    -------
+    tuple
+        (wcs, gaias_tbl, matched star indices, matched gaia indices) of all stars matched with the
+        refined WCS, or None if fewer than min_matches stars match.
+    '''
+    import logging
+    import numpy as np
+    from scipy.spatial import cKDTree
+    from . import matching
+    from . import solver
+    from . import wcs_helpers
+
+    size = max(shape)
+    gaias_tbl = wcs_helpers.gaia_get_wcs(seed, (size, size), pixel_border=max_drift_px, max_count=4 * n_stars, mag_limit=mag_limit)
+    gaias_ra = wcs_helpers.gaia_get_data(gaias_tbl, 'ra')
+    gaias_dec = wcs_helpers.gaia_get_data(gaias_tbl, 'dec')
+
+    if len(gaias_ra) < min_matches:
+        return None
+
+    predicted = np.column_stack(seed.all_world2pix(gaias_ra, gaias_dec, 0))
+    bright = stars_px[:n_stars]
+
+    # offsets of all bright pairs within max_drift_px, the drift is where most of them agree
+    near = cKDTree(predicted[:2 * n_stars]).query_ball_point(bright, max_drift_px)
+    offsets = np.array([predicted[j] - bright[i] for i, js in enumerate(near) for j in js]).reshape(-1, 2)
+
+    if len(offsets) < min_matches:
+        return None
+
+    votes = cKDTree(offsets).query_ball_point(offsets, tolerance_px, return_length=True)
+    best = offsets[np.argmax(votes)]
+    drift = np.median(offsets[np.hypot(*(offsets - best).T) <= tolerance_px], axis=0)
+
+    pairs, _ = matching.match_pairs(bright, predicted - drift, tolerance_px)
+    if len(pairs) < min_matches:
+        return None
+
+    wcs = solver.refine_wcs(seed, bright[pairs[:, 0]], gaias_ra[pairs[:, 1]], gaias_dec[pairs[:, 1]])
+    if wcs is None:
+        return None
+
+    # all stars matched with the refined wcs, refit with them
+    for _ in range(2):
+        predicted = np.column_stack(wcs.all_world2pix(gaias_ra, gaias_dec, 0))
+        pairs, separations = matching.match_pairs(stars_px, predicted, tolerance_px)
+
+        if len(pairs) < min_matches:
+            return None
+
+        refined = solver.refine_wcs(seed, stars_px[pairs[:, 0]], gaias_ra[pairs[:, 1]], gaias_dec[pairs[:, 1]])
+        if refined is None:
+            return None
+        wcs = refined
+
+    logging.info(f'Seed WCS verified with {len(pairs)} stars, drift ({drift[0]:.1f}, {drift[1]:.1f}) px, '
+                 f'rms {np.sqrt(np.mean(separations ** 2)):.2f} px')
+
+    return wcs, gaias_tbl, pairs[:, 0], pairs[:, 1]
+
+
+def solve_sequence(frames, seed=None) -> list:
+    '''
+    Solve the frames of a sequence in order, seeding each frame with the WCS of the one before (see
+    solve_wcs). The first frame is seeded with seed if given, otherwise solved blind.
+
+    Parameters
+    ----------
+    frames : list
+        (source path, destination path) of each frame, in order of observation.
+
+    Returns
+    -------
+    list
+        Solved CCDData of each frame.
+    '''
+    solved = []
+
+    for src, dest in frames:
+        ccd = solve_wcs(CCDData.read(src, unit='adu'), dest, seed=seed)
+        seed = ccd.wcs
+        solved.append(ccd)
+
+    return solved
+
+def find_stars(data, fwhm_est=2.0, fwhm_min=1.5, threshold_stddevs=4.0, mask=None, bkg=None, n_stars:int=None,
+               downsample:int=4, tile_size:int=1024, workers:int=None):
     '''
     Finds stars via iraf method and returns table with:
         id: unique object identification number.
@@ -252,15 +363,120 @@ def find_stars(data, fwhm_est=2.0, fwhm_min=1.5, threshold_stddevs=4.0, mask=Non
         flux: the object instrumental flux.
         mag: the object instrumental magnitude calculated as -2.5 * log10(flux).
 
+    Stars are found over overlapping tiles across a pool of workers threads, each star kept by the
+    tile whose core holds its centroid. The detection threshold is threshold_stddevs times the noise
+    level of the background, the cached estimate of background.get_background if bkg isn't passed.
+
+    If n_stars is given only the n_stars brightest stars are returned. Candidates are found on the
+    image binned by downsample, where the noise is lower and there are downsample ** 2 fewer pixels,
+    and only the brightest of them are measured at full resolution, skipping tiles without any.
     '''
-    from astropy.stats import sigma_clipped_stats
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from astropy.table import QTable, vstack
     from photutils.detection import IRAFStarFinder
+    from . import background
+    from . import parallel
+    from . import tiling
+
+    if bkg is None:
+        bkg = background.get_background(data, mask=mask)
+
+    threshold = threshold_stddevs * bkg.std
+    tiles = tiling.get_tiles(data.shape, tile_size, max(16, int(4 * fwhm_est)))
+    candidates = None
+
+    if n_stars is not None and downsample > 1:
+        # twice as many candidates as stars, some are rejected as not star shaped
+        candidates = __bright_peaks(data, bkg, downsample, threshold_stddevs, mask)[:2 * n_stars]
+
+    def find_tile(tile):
+        xycoords = None
+        if candidates is not None:
+            inside = ((candidates[:, 1] >= tile.core[0].start) & (candidates[:, 1] < tile.core[0].stop) &
+                      (candidates[:, 0] >= tile.core[1].start) & (candidates[:, 0] < tile.core[1].stop))
+            if not np.any(inside):
+                return None
+
+            xycoords = candidates[inside] - [tile.slices[1].start, tile.slices[0].start]
+
+        iraffind = IRAFStarFinder(fwhm=fwhm_est, exclude_border=True, threshold=threshold, xycoords=xycoords)
+        sources = iraffind.find_stars(data[tile.slices], mask=mask[tile.slices] if mask is not None else None)
+        if sources is None:
+            return None
+
+        # newer photutils renames columns, and warns on each use of the old names it maps
+        renamed = getattr(sources, 'deprecation_map', None) or {}
+        sources = QTable(sources)
+        for old, new in renamed.items():
+            if new in sources.colnames and old not in sources.colnames:
+                sources.rename_column(new, old)
 
-    mean, median, std = sigma_clipped_stats(data, sigma=3.0)
+        sources['xcentroid'] += tile.slices[1].start
+        sources['ycentroid'] += tile.slices[0].start
 
-    iraffind = IRAFStarFinder(fwhm=fwhm_est, exclude_border=True, threshold=threshold_stddevs * std)
-    sources = iraffind.find_stars(data, mask=mask)
-    sources.sort('peak', reverse=True) 
+        # stars of the overlap belong to the neighbouring tile
+        x = np.floor(np.asarray(sources['xcentroid']) + 0.5)
+        y = np.floor(np.asarray(sources['ycentroid']) + 0.5)
+        core = (y >= tile.core[0].start) & (y < tile.core[0].stop) & (x >= tile.core[1].start) & (x < tile.core[1].stop)
+
+        return sources[core]
+
+    workers = min(parallel.get_worker_count(workers), len(tiles))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        found = [sources for sources in executor.map(find_tile, tiles) if sources is not None and len(sources) > 0]
+
+    if len(found) == 0:
+        return None
+
+    sources = vstack(found, metadata_conflicts='silent')
+
+    sources.sort('peak', reverse=True)
+
+    if n_stars is not None:
+        sources = sources[:n_stars]
+    sources['id'] = np.arange(1, len(sources) + 1)
 
     return sources
 
+
+def __bright_peaks(data, bkg, factor:int, threshold_stddevs:float, mask=None):
+    # brightest pixels of the local maxima of the background subtracted image binned by factor, as
+    # (x, y) brightest first
+    import numpy as np
+    from scipy.ndimage import maximum_filter
+    from .background import interpolation_weights
+
+    rows, cols = data.shape[0] // factor, data.shape[1] // factor
+    blocks = np.asarray(data[:rows * factor, :cols * factor], dtype=np.float32)
+    if mask is not None:
+        blocks = np.where(mask[:rows * factor, :cols * factor], np.float32(bkg.median), blocks)
+
+    binned = blocks.reshape(rows, factor, cols, factor).mean(axis=(1, 3))
+
+    # the background mesh interpolated straight onto the binned pixels
+    wy = interpolation_weights(rows, bkg.box_size[0] / factor, bkg.mesh.shape[0])
+    wx = interpolation_weights(cols, bkg.box_size[1] / factor, bkg.mesh.shape[1])
+    sky = wy @ bkg.mesh.astype(np.float32) @ wx.T
+    binned = binned - sky
+    binned[~np.isfinite(binned)] = 0.0
+
+    # averaging factor ** 2 pixels lowers the noise by factor
+    peaks = (binned > threshold_stddevs * bkg.std / factor) & (binned == maximum_filter(binned, size=3, mode='constant'))
+    y, x = np.nonzero(peaks)
+
+    # brightest full resolution pixel of each peak block and the pixels around it, a star's peak can
+    # be just over the edge of its brightest block
+    offsets = np.arange(-1, factor + 1)
+    py = np.clip(y[:, None] * factor + offsets[None, :], 0, blocks.shape[0] - 1)
+    px = np.clip(x[:, None] * factor + offsets[None, :], 0, blocks.shape[1] - 1)
+    window = np.nan_to_num(blocks[py[:, :, None], px[:, None, :]].reshape(len(y), -1), nan=-np.inf)
+    brightest = np.argmax(window, axis=1)
+
+    # brightest above the background first, as stars are ordered by peak
+    level = window[np.arange(len(y)), brightest] - sky[y, x]
+    order = np.argsort(-level, kind='stable')
+    brightest = brightest[order]
+
+    return np.column_stack([px[order, brightest % len(offsets)], py[order, brightest // len(offsets)]])
+
@@ -0,0 +1,273 @@
+'''
+Background estimation shared by star finding, photometry and stacking.
+
+The background is estimated on a low resolution mesh of sigma clipped box statistics, computed
+for all boxes at once. The mesh is only interpolated to full resolution when the full background
+is requested, and meshes are cached per frame so each frame's background is computed once.
+'''
+
+from collections import OrderedDict
+import logging
+import numpy as np
+
+from abberition import cache
+
+
+class Background:
+    '''
+    Background estimate of an image.
+
+    mesh: background value of each box
+    mesh_rms: background rms of each box
+    median: median background level of the image
+    std: median background rms of the image
+    '''
+
+    def __init__(self, mesh:np.ndarray, mesh_rms:np.ndarray, shape, box_size):
+        self.mesh = mesh
+        self.mesh_rms = mesh_rms
+        self.shape = tuple(shape)
+        self.box_size = tuple(box_size)
+        self.median = float(np.nanmedian(mesh))
+        self.std = float(np.nanmedian(mesh_rms))
+
+        self.__background = None
+        self.__rms = None
+
+    @property
+    def background(self) -> np.ndarray:
+        '''
+        Full resolution background, interpolated from the mesh on first use.
+        '''
+        if self.__background is None:
+            self.__background = self.__interpolate(self.mesh)
+
+        return self.__background
+
+    @property
+    def rms(self) -> np.ndarray:
+        '''
+        Full resolution background rms, interpolated from the mesh on first use.
+        '''
+        if self.__rms is None:
+            self.__rms = self.__interpolate(self.mesh_rms)
+
+        return self.__rms
+
+    def subtract(self, data:np.ndarray) -> np.ndarray:
+        return data - self.background
+
+    def __interpolate(self, mesh:np.ndarray) -> np.ndarray:
+        # bicubic interpolation is separable, so it is applied as a pair of small weight matrices
+        wy = interpolation_weights(self.shape[0], self.box_size[0], mesh.shape[0])
+        wx = interpolation_weights(self.shape[1], self.box_size[1], mesh.shape[1])
+
+        return (wy @ mesh.astype(np.float32) @ wx.T).astype(np.float32)
+
+
+def interpolation_weights(size:int, box:int, mesh_size:int) -> np.ndarray:
+    '''
+    Cubic convolution weights mapping mesh values at box centres to size pixels, shape (size, mesh_size).
+    Edges are extended with the nearest mesh value.
+    '''
+    u = np.clip((np.arange(size) + 0.5) / box - 0.5, 0, mesh_size - 1)
+    base = np.floor(u).astype(np.int64)
+    t = u - base
+
+    weights = np.zeros((size, mesh_size), dtype=np.float32)
+    rows = np.arange(size)
+
+    for k in range(-1, 3):
+        d = np.abs(t - k)
+        # Keys cubic convolution kernel, a = -0.5
+        w = np.where(d <= 1, (1.5 * d - 2.5) * d * d + 1, np.where(d < 2, ((-0.5 * d + 2.5) * d - 4) * d + 2, 0.0))
+        np.add.at(weights, (rows, np.clip(base + k, 0, mesh_size - 1)), w)
+
+    return weights
+
+
+__memory_cache = OrderedDict()
+__memory_cache_size = 8
+
+
+def get_background(data:np.ndarray, box_size=32, filter_size=3, sigma:float=3.0, maxiters:int=10, mask:np.ndarray=None,
+                   exclude_fraction:float=0.1, use_cache:bool=True) -> Background:
+    '''
+    Estimate the background of an image with the SExtractor estimator on a mesh of boxes.
+
+    Results are cached in memory and on disk by a hash of the data, mask and parameters.
+
+    Parameters
+    ----------
+    data : ndarray
+        Image data.
+
+    box_size : int or tuple
+        Size of the mesh boxes (rows, cols).
+
+    filter_size : int
+        Size of the median filter applied to the mesh, 1 for none.
+
+    sigma : float
+        Number of standard deviations to clip at.
+
+    maxiters : int
+        Maximum number of sigma clipping iterations.
+
+    mask : ndarray
+        Pixels to exclude from the estimate (True is excluded).
+
+    exclude_fraction : float
+        Boxes with less than this fraction of pixels remaining after masking are filled from their neighbours.
+
+    use_cache : bool
+        Reuse and store meshes in the cache.
+
+    Returns
+    -------
+    Background
+    '''
+    if np.isscalar(box_size):
+        box_size = (int(box_size), int(box_size))
+    box_size = (min(box_size[0], data.shape[0]), min(box_size[1], data.shape[1]))
+
+    key = None
+    if use_cache:
+        mask_hash = cache.hash_array(mask) if mask is not None else None
+        key = cache.hash_params(cache.hash_array(data), mask_hash, box_size, filter_size, sigma, maxiters, exclude_fraction)
+
+        if key in __memory_cache:
+            __memory_cache.move_to_end(key)
+            return __memory_cache[key]
+
+        meshes = cache.load_array('background', key)
+        if meshes is not None:
+            logging.debug(f'Using cached background mesh {key}')
+            bkg = Background(meshes[0], meshes[1], data.shape, box_size)
+            __remember(key, bkg)
+            return bkg
+
+    mesh, mesh_rms = get_mesh(data, box_size, sigma, maxiters, mask, exclude_fraction)
+
+    if filter_size is not None and filter_size > 1 and min(mesh.shape) > 1:
+        from scipy.ndimage import median_filter
+        mesh = median_filter(mesh, size=filter_size, mode='nearest')
+        mesh_rms = median_filter(mesh_rms, size=filter_size, mode='nearest')
+
+    bkg = Background(mesh, mesh_rms, data.shape, box_size)
+
+    if use_cache:
+        cache.save_array('background', key, np.array([mesh, mesh_rms]))
+        __remember(key, bkg)
+
+    return bkg
+
+
+def get_mesh(data:np.ndarray, box_size, sigma:float=3.0, maxiters:int=10, mask:np.ndarray=None, exclude_fraction:float=0.1):
+    '''
+    Calculate the sigma clipped SExtractor background and rms of every box of the image at once.
+
+    The image is padded to a whole number of boxes and reshaped so each row of a 2d array holds
+    the pixels of one box. Clipping is done for all boxes together.
+
+    Returns
+    -------
+    mesh, mesh_rms : ndarray
+        Background and rms per box, shape (ceil(rows / box rows), ceil(cols / box cols)).
+    '''
+    by, bx = box_size
+    rows, cols = data.shape
+    ny = -(-rows // by)
+    nx = -(-cols // bx)
+
+    boxes = np.full((ny * by, nx * bx), np.nan, dtype=np.float32)
+    boxes[:rows, :cols] = data
+    if mask is not None:
+        boxes[:rows, :cols][mask] = np.nan
+
+    boxes = boxes.reshape(ny, by, nx, bx).transpose(0, 2, 1, 3).reshape(ny * nx, by * bx)
+
+    # the clipped values of a box are a contiguous range [lo, hi) of its sorted values, so after
+    # one sort each clipping iteration only needs prefix sums and a count per box
+    boxes = np.sort(boxes, axis=1)
+    counts = np.sum(~np.isnan(boxes), axis=1)
+
+    values = np.nan_to_num(boxes).astype(np.float64)
+    zeros = np.zeros((len(boxes), 1))
+    csum = np.concatenate([zeros, np.cumsum(values, axis=1)], axis=1)
+    csum2 = np.concatenate([zeros, np.cumsum(values * values, axis=1)], axis=1)
+
+    rows = np.arange(len(boxes))
+    lo = np.zeros(len(boxes), dtype=np.int64)
+    hi = counts.astype(np.int64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(maxiters + 1):
+            n = hi - lo
+            median = __sorted_median(boxes, lo, hi)
+            mean = (csum[rows, hi] - csum[rows, lo]) / n
+            std = np.sqrt(np.maximum((csum2[rows, hi] - csum2[rows, lo]) / n - mean * mean, 0.0))
+
+            if i == maxiters:
+                break
+
+            new_lo = np.maximum(lo, np.sum(boxes < (median - sigma * std)[:, None], axis=1))
+            new_hi = np.minimum(hi, np.sum(boxes <= (median + sigma * std)[:, None], axis=1))
+            new_hi = np.maximum(new_hi, new_lo)
+
+            if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+                break
+
+            lo, hi = new_lo, new_hi
+
+    # SExtractor estimator, median for crowded boxes
+    mesh = np.where(std > 0, 2.5 * median - 1.5 * mean, median)
+    crowded = (std == 0) | (np.abs(mean - median) / np.where(std > 0, std, 1.0) > 0.3)
+    mesh = np.where(crowded, median, mesh)
+
+    excluded = (counts < exclude_fraction * by * bx) | (n == 0) | np.isnan(mesh)
+    mesh[excluded] = np.nan
+    std[excluded] = np.nan
+
+    mesh = __fill_excluded(mesh.reshape(ny, nx))
+    mesh_rms = __fill_excluded(std.reshape(ny, nx))
+
+    return mesh.astype(np.float32), mesh_rms.astype(np.float32)
+
+
+def __sorted_median(boxes:np.ndarray, lo:np.ndarray, hi:np.ndarray) -> np.ndarray:
+    '''
+    Median of the range [lo, hi) of each row of boxes, which are sorted.
+    '''
+    last = boxes.shape[1] - 1
+    a = boxes[np.arange(len(boxes)), np.clip((lo + hi - 1) // 2, 0, last)]
+    b = boxes[np.arange(len(boxes)), np.clip((lo + hi) // 2, 0, last)]
+
+    return np.where(hi > lo, 0.5 * (a.astype(np.float64) + b), np.nan)
+
+
+def __fill_excluded(mesh:np.ndarray) -> np.ndarray:
+    '''
+    Replace nan boxes with the value of the nearest valid box.
+    '''
+    bad = np.isnan(mesh)
+
+    if not np.any(bad):
+        return mesh
+
+    if np.all(bad):
+        logging.warning('No valid background boxes, using zero background.')
+        return np.zeros_like(mesh)
+
+    from scipy.ndimage import distance_transform_edt
+    _, (iy, ix) = distance_transform_edt(bad, return_indices=True)
+
+    return mesh[iy, ix]
+
+
+def __remember(key:str, bkg:Background):
+    __memory_cache[key] = bkg
+
+    while len(__memory_cache) > __memory_cache_size:
+        __memory_cache.popitem(last=False)
+
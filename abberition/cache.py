@@ -0,0 +1,170 @@
+'''
+Content-addressed cache of data derived from images.
+
+Entries are keyed by a hash of the data they were derived from and the parameters used, so
+a cached entry is only ever reused for identical inputs.
+
+The cache is capped at get_max_bytes() (2 GiB by default). prune() removes the least recently
+used entries, by modification time which is updated when an entry is read, until the cache fits.
+The processor prunes at the end of each stage that uses the cache.
+'''
+
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+from pathlib import Path
+import tempfile
+
+from abberition import metrics
+
+__cache_path = Path(tempfile.gettempdir()) / 'abberition.cache'
+__max_bytes = 2 << 30
+
+
+def get_cache_path():
+    return __cache_path
+
+
+def set_cache_path(path:Path):
+    global __cache_path
+    __cache_path = Path(path)
+
+
+def get_max_bytes() -> int:
+    return __max_bytes
+
+
+def set_max_bytes(max_bytes:int):
+    '''
+    Set the size the cache is pruned to, None to never prune.
+    '''
+    global __max_bytes
+    __max_bytes = max_bytes
+
+
+def hash_array(data:np.ndarray) -> str:
+    '''
+    Hash the contents, shape and type of an array.
+    '''
+    data = np.ascontiguousarray(data)
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(data.dtype).encode())
+    h.update(str(data.shape).encode())
+    h.update(memoryview(data).cast('B'))
+
+    return h.hexdigest()
+
+
+def hash_params(*args, **kwargs) -> str:
+    '''
+    Hash a set of json serializable parameters. Values that can't be serialized are hashed by their str.
+    '''
+    text = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+def hash_file(path:Path, chunk_size:int=1 << 22) -> str:
+    '''
+    Hash the contents of a file.
+    '''
+    h = hashlib.blake2b(digest_size=20)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def get_entry_path(kind:str, key:str, ext:str='.npy') -> Path:
+    return __cache_path / kind / key[:2] / f'{key}{ext}'
+
+
+def load_array(kind:str, key:str):
+    '''
+    Load a cached array, returns None if no entry exists for key.
+    '''
+    path = get_entry_path(kind, key)
+
+    if not path.exists():
+        metrics.count('cache_misses')
+        return None
+
+    try:
+        data = np.load(path, allow_pickle=False)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Ignoring unreadable cache entry {path}: {e}')
+        metrics.count('cache_misses')
+        return None
+
+    # mark the entry as recently used for prune
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    metrics.count('cache_hits')
+    return data
+
+
+def save_array(kind:str, key:str, data:np.ndarray):
+    '''
+    Save an array to the cache. The entry is written to a temporary file first so readers never
+    see a partial entry.
+    '''
+    path = get_entry_path(kind, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path.with_name(f'{path.stem}.{np.random.randint(1 << 30)}.tmp.npy')
+    np.save(tmp_path, data, allow_pickle=False)
+    tmp_path.replace(path)
+
+    return path
+
+
+def prune(max_bytes:int=None) -> int:
+    '''
+    Remove the least recently used entries until the cache is at most max_bytes, get_max_bytes()
+    if None. Entries removed by another process while pruning are skipped. Returns the number of
+    bytes removed.
+    '''
+    if max_bytes is None:
+        max_bytes = __max_bytes
+
+    if max_bytes is None or not __cache_path.exists():
+        return 0
+
+    entries = []
+    for path in __cache_path.glob('*/*/*.npy'):
+        # entries still being written
+        if path.name.endswith('.tmp.npy'):
+            continue
+
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+
+    for _, size, path in sorted(entries, key=lambda e: e[0]):
+        if total - removed <= max_bytes:
+            break
+
+        try:
+            path.unlink()
+        except OSError:
+            continue
+
+        removed += size
+
+    if removed > 0:
+        logging.info(f'Pruned {removed / 2**20:.1f} MiB from the cache, {(total - removed) / 2**20:.1f} MiB remaining')
+
+    return removed
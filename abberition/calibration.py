@@ -1,11 +1,13 @@
 # collection of calibration functions for calibration of images
 
+from astropy.io import fits
 import astropy.units as u
 import logging
 import ccdproc as ccdp
 import numpy as np
+import os
 
-from abberition import library
+from abberition import background, cache, library, parallel, shared, tiling
 
 def calibrate_dark(image:ccdp.CCDData):
     '''
@@ -145,7 +147,7 @@ def get_speed(header):
 
     return speed
 
-def calibrate_light(image: ccdp.CCDData, flat=None, bias: ccdp.CCDData=None, dark: ccdp.CCDData=None, return_calibration=False):
+def calibrate_light(image: ccdp.CCDData, flat=None, bias: ccdp.CCDData=None, dark: ccdp.CCDData=None, return_calibration=False, remove_cosmics=False, workers:int=None):
     '''
     Calibrate a light image.
 
@@ -153,6 +155,7 @@ def calibrate_light(image: ccdp.CCDData, flat=None, bias: ccdp.CCDData=None, dar
     1. bias calibration
     2. dark calibration
     3. flat calibration
+    4. cosmic ray removal (if remove_cosmics)
     '''
 
     if bias is None:
@@ -172,17 +175,307 @@ def calibrate_light(image: ccdp.CCDData, flat=None, bias: ccdp.CCDData=None, dar
         logging.error(f'Invalid flat type for calibrate_light: {type(flat)}')
 
 
+    # saturation is only known from the raw values, calibration moves saturated pixels to varying levels
+    saturated = saturation_mask(image) if remove_cosmics else None
+
     calib_light = ccdp.ccd_process(image, master_bias=bias, dark_frame=dark, master_flat=flat, exposure_key='exptime', exposure_unit=u.second, dark_scale=True)
 
+    if remove_cosmics:
+        calib_light = remove_cosmic_rays(calib_light, workers=workers, saturated=saturated)
+
     if return_calibration:
         return calib_light, (bias, dark, flat)
     
     return calib_light
 
-def estimate_background(image: ccdp.CCDData):
+
+class SharedMasters:
+    '''
+    Masters (bias, dark, flat) selected for a set of lights, held in shared memory so that worker
+    processes use them without reading them again or pickling them with every task. Each master is
+    read and shared once, however many lights use it, as masters are selected from their headers.
+
+    Select the masters of each light in the main process, pass specs() to the workers, rebuild the
+    masters there with SharedMasters.attach, and unlink() once all lights are done.
+
+    If share is False, masters are only selected from their headers for their names and keys, keyed by
+    a hash of their files, for workers that select them again themselves (such as queued jobs).
+    '''
+
+    def __init__(self, share:bool=True):
+        self.share = share
+        self.arrays = {}
+        self.headers = {}
+        self.units = {}
+        self.keys = {}
+
+    def select(self, header, flats:ccdp.ImageFileCollection=None):
+        '''
+        Select and share the masters for a light from its header, from the library and flats if given.
+
+        Returns
+        -------
+        tuple
+            Names of the (bias, dark, flat) masters, None where there is no master.
+        '''
+        light = ccdp.CCDData(np.zeros((1, 1), dtype=np.float32), unit='adu', meta=header)
+
+        library_path = library.get_library_path()
+        selected = [('bias', library_path, library.select_bias(light, load=False)),
+                    ('dark', library_path, library.select_dark(light, load=False)),
+                    ('flat', flats.location if flats is not None else library_path, library.select_flat(light, flats=flats, load=False))]
+        names = []
+
+        for kind, location, (frame_header, filename) in selected:
+            if frame_header is None:
+                names.append(None)
+                continue
+
+            name = f'{kind}:{filename}'
+            if not self.share:
+                if name not in self.keys:
+                    self.keys[name] = cache.hash_file(os.path.join(location, filename))
+            elif name not in self.arrays:
+                frame = ccdp.CCDData.read(os.path.join(location, filename), unit=frame_header.get('bunit', 'adu'))
+                self.arrays[name] = shared.SharedArray.from_array(np.asarray(frame.data, dtype=np.float32))
+                self.headers[name] = fits.Header(frame.meta).tostring()
+                self.units[name] = str(frame.unit)
+                self.keys[name] = cache.hash_array(self.arrays[name].array)
+
+            names.append(name)
+
+        return tuple(names)
+
+    def key(self, name:str) -> str:
+        '''
+        Content hash of a master, None for no master.
+        '''
+        return self.keys.get(name) if name is not None else None
+
+    def specs(self) -> dict:
+        return {name: (array.spec(), self.headers[name], self.units[name]) for name, array in self.arrays.items()}
+
+    @staticmethod
+    def attach(specs:dict):
+        '''
+        Rebuild the masters from specs() in a worker process.
+
+        Returns
+        -------
+        masters : dict
+            Read only CCDData of each master by name.
+
+        arrays : list
+            The attached shared arrays, which must be kept while the masters are used.
+        '''
+        masters = {}
+        arrays = []
+
+        for name, (spec, header, unit) in specs.items():
+            array = shared.SharedArray.attach(spec)
+            array.array.flags.writeable = False
+            arrays.append(array)
+            masters[name] = ccdp.CCDData(array.array, unit=unit, meta=fits.Header.fromstring(header))
+
+        return masters, arrays
+
+    def unlink(self):
+        for array in self.arrays.values():
+            array.unlink()
+
+        self.arrays = {}
+
+
+def estimate_background(image: ccdp.CCDData, box_size=32, filter_size=3, sigma:float=3.0):
     '''
-    Estimate the background of an image.
+    Estimate the background of an image. The estimate is cached per frame, so star finding,
+    photometry and stacking of the same frame share a single computation.
+
+    Returns a background.Background, with the full resolution background available as .background
     ''' 
     logging.info('Estimating background.')
+
+    mask = image.mask if image.mask is not None and np.any(image.mask) else None
     
-    import photutils
\ No newline at end of file
+    return background.get_background(np.asarray(image.data), box_size=box_size, filter_size=filter_size, sigma=sigma, mask=mask)
+
+
+def saturation_level(header, data:np.ndarray=None) -> float:
+    '''
+    Saturation level (ADU) of a raw image, from the 'saturate' or 'datamax' keyword, otherwise the largest
+    value of an integer data type. Returns None if the level is unknown.
+    '''
+    for key in ['saturate', 'datamax']:
+        if header.get(key) is not None:
+            return float(header[key])
+
+    if data is not None and np.issubdtype(data.dtype, np.integer):
+        return float(np.iinfo(data.dtype).max)
+
+    return None
+
+
+def saturation_mask(image:ccdp.CCDData) -> np.ndarray:
+    '''
+    Mask of the saturated pixels of a raw (uncalibrated) image, None if the saturation level is unknown.
+    '''
+    data = np.asarray(image.data)
+    satlevel = saturation_level(image.header, data)
+
+    if satlevel is None:
+        return None
+
+    return data >= satlevel
+
+
+def remove_cosmic_rays(image:ccdp.CCDData, tile_size:int=512, overlap:int=16, workers:int=None, use_cache:bool=True,
+                       sigclip:float=4.5, sigfrac:float=0.3, objlim:float=5.0, readnoise:float=None, satlevel:float=None, niter:int=4,
+                       saturated:np.ndarray=None):
+    '''
+    Detect and clean cosmic rays with the L.A.Cosmic algorithm (astroscrappy).
+
+    The image is split into overlapping tiles that are processed across a pool of worker processes,
+    and the tile masks are stitched back together. Masks are cached by a hash of the image data and
+    parameters so reprocessing the same frame skips detection.
+
+    Detected pixels are replaced with the mean of the unmasked pixels in the surrounding 5x5 box and
+    added to the image mask.
+
+    Parameters
+    ----------
+    image : CCDData
+        Calibrated image to clean.
+
+    tile_size : int
+        Size of the tiles in pixels, excluding overlap.
+
+    overlap : int
+        Border added to each tile so detections at tile edges match a full frame detection.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    use_cache : bool
+        Reuse and store masks in the cache.
+
+    readnoise : float
+        Read noise (e-). Read from 'rdnoise' keyword if None, otherwise 6.5.
+
+    satlevel : float
+        Saturation level of the calibrated image (ADU). Read from the 'saturate' or 'datamax' keyword if
+        None, saturated stars are not protected if neither is set.
+
+    saturated : np.ndarray
+        Mask of the saturated pixels, from saturation_mask of the raw image. Saturated stars are protected
+        from detection (grown by 4 pixels as astroscrappy does) instead of finding them with satlevel.
+
+    Returns
+    -------
+    CCDData
+        Copy of the image with cosmic rays cleaned and masked.
+    '''
+    logging.info('Removing cosmic rays.')
+
+    data = np.asarray(image.data, dtype=np.float32)
+    header = image.header
+
+    gain = float(header.get('gainadu', 0.0) or 0.0)
+    if gain <= 0.0:
+        gain = 1.0
+
+    if readnoise is None:
+        readnoise = float(header.get('rdnoise', 6.5))
+
+    if saturated is not None:
+        satlevel = np.inf
+    elif satlevel is None:
+        satlevel = saturation_level(header)
+        satlevel = np.inf if satlevel is None else satlevel
+
+    params = dict(sigclip=sigclip, sigfrac=sigfrac, objlim=objlim, gain=gain, readnoise=readnoise, satlevel=satlevel, niter=niter)
+
+    crmask = None
+    key = None
+
+    if use_cache:
+        saturated_hash = cache.hash_array(saturated) if saturated is not None else None
+        key = cache.hash_params(cache.hash_array(data), saturated_hash, **params)
+        crmask = cache.load_array('crmask', key)
+
+        if crmask is not None and crmask.shape != data.shape:
+            crmask = None
+
+        if crmask is not None:
+            logging.debug(f'Using cached cosmic ray mask {key}')
+
+    if crmask is None:
+        crmask = detect_cosmic_rays(data, tile_size, overlap, workers, saturated=saturated, **params)
+
+        if use_cache:
+            cache.save_array('crmask', key, crmask)
+
+    logging.info(f'Found {int(np.count_nonzero(crmask))} cosmic ray pixels.')
+
+    cleaned = image.copy()
+    cleaned.data = __clean_masked(data, crmask).astype(image.data.dtype, copy=False)
+    cleaned.mask = crmask if image.mask is None else (image.mask | crmask)
+    cleaned.header['crclean'] = True
+    cleaned.header['ncosmic'] = int(np.count_nonzero(crmask))
+
+    return cleaned
+
+
+def detect_cosmic_rays(data:np.ndarray, tile_size:int=512, overlap:int=16, workers:int=None, saturated:np.ndarray=None, **params) -> np.ndarray:
+    '''
+    Detect cosmic rays over overlapping tiles across a process pool and return the stitched boolean mask.
+    Pixels within 4 pixels of a saturated pixel are excluded from detection. params are passed through to
+    astroscrappy.detect_cosmics.
+    '''
+    from scipy.ndimage import binary_dilation
+
+    tiles = tiling.get_tiles(data.shape, tile_size, overlap)
+    crmask = np.zeros(data.shape, dtype=bool)
+
+    if saturated is not None and np.any(saturated):
+        # the same growth as astroscrappy's saturated star mask, two 5x5 dilations
+        protected = binary_dilation(saturated, structure=np.ones((5, 5), dtype=bool), iterations=2)
+    else:
+        protected = None
+
+    tasks = [(data[t.slices], None if protected is None else protected[t.slices], params) for t in tiles]
+
+    for tile, tile_mask in zip(tiles, parallel.map_ordered(_detect_cosmics_tile, tasks, workers)):
+        crmask[tile.core] = tile_mask[tile.core_local]
+
+    return crmask
+
+
+def _detect_cosmics_tile(task):
+    import astroscrappy
+
+    data, protected, params = task
+    tile_mask, _ = astroscrappy.detect_cosmics(data, inmask=protected, cleantype='meanmask', **params)
+
+    if protected is not None:
+        tile_mask &= ~protected
+
+    return tile_mask
+
+
+def __clean_masked(data:np.ndarray, mask:np.ndarray, size:int=5):
+    '''
+    Replace masked pixels with the mean of the unmasked pixels in a size x size box.
+    '''
+    from scipy.ndimage import uniform_filter
+
+    if not np.any(mask):
+        return data.copy()
+
+    good = (~mask).astype(np.float32)
+    sums = uniform_filter(np.where(mask, 0.0, data).astype(np.float32), size=size, mode='mirror')
+    counts = uniform_filter(good, size=size, mode='mirror')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nanmedian(data))
+
+    return np.where(mask, means, data)
@@ -0,0 +1,345 @@
+'''
+Local store of Gaia stars, partitioned into HEALPix tiles.
+
+Each tile is a small npz file of columns (source_id, ra, dec, phot_g_mean_mag, phot_rp_mean_mag)
+ordered by G magnitude, with the G magnitude to which the tile is complete. Cone and polygon queries
+load the tiles overlapping the region and filter their stars, so they are answered from disk in
+milliseconds, and every frame of a field reuses the same tiles.
+
+The store is filled from a bulk export with add_table, or from Gaia TAP queries of whole tiles. A
+query needing tiles that aren't complete to its magnitude limit fetches them first, one TAP job per
+tile, storing each tile as its results arrive. Tiles are written atomically, so worker processes
+can share a store.
+'''
+
+from astropy import units as u
+from astropy.table import Table
+import json
+import logging
+import numpy as np
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from abberition import library, metrics, solver
+
+
+columns = ['source_id', 'ra', 'dec', 'phot_g_mean_mag', 'phot_rp_mean_mag']
+column_types = [np.int64, np.float64, np.float64, np.float32, np.float32]
+
+gaia_table = 'gaiaedr3.gaia_source'
+
+# magnitude limit of queries that don't give one, and of tiles fetched for them
+default_mag_limit = 17.0
+
+__catalog_path = library.get_library_path() / 'catalog'
+__stores = {}
+
+
+def get_catalog_path() -> Path:
+    return __catalog_path
+
+
+def set_catalog_path(path:Path):
+    global __catalog_path
+    __catalog_path = Path(path)
+
+
+def get_store(path:Path=None) -> 'CatalogStore':
+    '''
+    Get the store at path, by default get_catalog_path(), kept open for the life of the process.
+    '''
+    path = Path(path if path is not None else __catalog_path)
+    key = str(path.resolve())
+
+    if key not in __stores:
+        __stores[key] = CatalogStore(path)
+
+    return __stores[key]
+
+
+class CatalogStore:
+    '''
+    HEALPix tiled store of catalog stars in a directory.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the store, created if needed.
+
+    nside : int
+        HEALPix resolution of the tiles of a new store (nested ordering). The default of 32 gives tiles
+        of about 1.8 degrees. An existing store keeps its own.
+
+    fetch : bool
+        Fetch missing or incomplete tiles from the Gaia archive when queried, otherwise queries are
+        answered from the stars stored.
+    '''
+
+    def __init__(self, path:Path, nside:int=32, fetch:bool=True):
+        from astropy_healpix import HEALPix
+
+        self.path = Path(path)
+        self.fetch = fetch
+
+        info_path = self.path / 'catalog.json'
+        if info_path.exists():
+            with open(info_path, 'r') as f:
+                nside = json.load(f)['nside']
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            self.__write_atomic(info_path, json.dumps({'nside': nside, 'order': 'nested', 'columns': columns}).encode())
+
+        self.healpix = HEALPix(nside=nside, order='nested')
+        self.tiles = {}
+
+    def tile_path(self, tile:int) -> Path:
+        return self.path / f'{int(tile):07d}.npz'
+
+    def get_tile(self, ra, dec) -> np.ndarray:
+        return self.healpix.lonlat_to_healpix(np.asarray(ra) * u.deg, np.asarray(dec) * u.deg)
+
+    def cone_tiles(self, ra:float, dec:float, radius:float) -> np.ndarray:
+        '''
+        Tiles overlapping the cone of radius degrees about (ra, dec).
+        '''
+        return np.asarray(self.healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg))
+
+    def load_tile(self, tile:int):
+        '''
+        Get the stars of a tile as a dict of columns, and the G magnitude to which it is complete
+        (-inf if not stored).
+        '''
+        path = self.tile_path(tile)
+
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {c: np.empty(0, dtype=t) for c, t in zip(columns, column_types)}, -np.inf
+
+        cached = self.tiles.get(tile)
+        if cached is None or cached[0] != mtime:
+            with np.load(path) as data:
+                cached = (mtime, {c: data[c] for c in columns}, float(data['mag_limit']))
+            self.tiles[tile] = cached
+
+        return cached[1], cached[2]
+
+    def save_tile(self, tile:int, stars:dict, mag_limit:float):
+        order = np.argsort(stars['phot_g_mean_mag'], kind='stable')
+        arrays = {c: np.asarray(stars[c], dtype=t)[order] for c, t in zip(columns, column_types)}
+
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False) as f:
+            np.savez(f, mag_limit=np.float64(mag_limit), **arrays)
+        os.replace(f.name, self.tile_path(tile))
+
+        self.tiles.pop(tile, None)
+
+    def add_table(self, table:Table, mag_limit:float=None) -> list:
+        '''
+        Add stars to the store, merging them with the stars stored by source_id.
+
+        Parameters
+        ----------
+        table : Table
+            Stars with the catalog columns, e.g. a bulk export of the Gaia archive.
+
+        mag_limit : float
+            G magnitude to which the table is complete over each tile it has stars in, which holds for
+            an all sky export or one of whole tiles. Queries to this limit are then answered without
+            fetching those tiles. None if the table isn't complete anywhere.
+
+        Returns
+        -------
+        list
+            Tiles updated.
+        '''
+        stars = self.__columns(table)
+        tiles = self.get_tile(stars['ra'], stars['dec'])
+
+        updated = []
+        for tile in np.unique(tiles):
+            in_tile = tiles == tile
+            self.__merge(int(tile), {c: v[in_tile] for c, v in stars.items()}, mag_limit)
+            updated.append(int(tile))
+
+        return updated
+
+    def __merge(self, tile:int, stars:dict, mag_limit:float):
+        stored, stored_limit = self.load_tile(tile)
+        merged = {c: np.concatenate([stored[c], stars[c]]) for c in columns}
+
+        # newer rows replace stored rows of the same source
+        _, last = np.unique(merged['source_id'][::-1], return_index=True)
+        keep = len(merged['source_id']) - 1 - last
+        merged = {c: v[keep] for c, v in merged.items()}
+
+        self.save_tile(tile, merged, max(stored_limit, mag_limit) if mag_limit is not None else stored_limit)
+
+    def fill_tiles(self, tiles, mag_limit:float=default_mag_limit):
+        '''
+        Fetch whole tiles from the Gaia archive to mag_limit. A TAP job is launched for each tile, and
+        each tile is stored as its results arrive.
+        '''
+        from astroquery.gaia import Gaia
+
+        jobs = []
+        for tile in tiles:
+            ra, dec, radius = self.__tile_circle(tile)
+            query = (f"select {', '.join(columns)} from {gaia_table} where "
+                     f"phot_g_mean_mag < {mag_limit} "
+                     "AND "
+                     f"1=CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', {ra}, {dec}, {radius}))")
+            jobs.append((tile, Gaia.launch_job_async(query, background=True)))
+
+        for tile, job in jobs:
+            start = time.perf_counter()
+            table = job.get_results()
+
+            # the circle covers neighbouring tiles too
+            stars = self.__columns(table)
+            in_tile = self.get_tile(stars['ra'], stars['dec']) == tile
+            self.__merge(int(tile), {c: v[in_tile] for c, v in stars.items()}, mag_limit)
+
+            metrics.count('catalog_tiles_fetched')
+            logging.info(f'Fetched catalog tile {tile}, {np.sum(in_tile)} stars to G {mag_limit} in {time.perf_counter() - start:.1f} s')
+
+    def __tile_circle(self, tile:int):
+        # circle containing a tile, from points along its boundary
+        lon, lat = self.healpix.boundaries_lonlat([tile], step=4)
+        center_lon, center_lat = self.healpix.healpix_to_lonlat([tile])
+
+        ra, dec = center_lon.to_value(u.deg)[0], center_lat.to_value(u.deg)[0]
+        dist = self.__separation(ra, dec, lon.to_value(u.deg)[0], lat.to_value(u.deg)[0])
+
+        return ra, dec, float(np.max(dist)) * 1.01
+
+    def query_tiles(self, tiles, mag_limit:float=default_mag_limit) -> dict:
+        '''
+        Get the stars of tiles brighter than mag_limit as a dict of columns, fetching tiles that
+        aren't complete to mag_limit if fetch is set.
+        '''
+        tiles = [int(t) for t in tiles]
+        incomplete = [t for t in tiles if self.load_tile(t)[1] < mag_limit]
+
+        if len(incomplete) > 0:
+            if self.fetch:
+                self.fill_tiles(incomplete, mag_limit)
+            else:
+                logging.warning(f'{len(incomplete)} catalog tiles aren\'t complete to G {mag_limit}')
+
+        metrics.count('catalog_tiles_read', len(tiles))
+        parts = [self.load_tile(t)[0] for t in tiles]
+        stars = {c: np.concatenate([p[c] for p in parts]) if len(parts) > 0 else np.empty(0, dtype=t) for c, t in zip(columns, column_types)}
+
+        bright = stars['phot_g_mean_mag'] < mag_limit
+        return {c: v[bright] for c, v in stars.items()}
+
+    def cone(self, ra:float, dec:float, radius:float, mag_limit:float=None, max_count:int=None) -> Table:
+        '''
+        Get the stars within radius degrees of (ra, dec), brightest first.
+
+        Returns
+        -------
+        Table
+            Masked table of the catalog columns, as returned by a Gaia TAP query.
+        '''
+        mag_limit = mag_limit if mag_limit is not None else default_mag_limit
+        stars = self.query_tiles(self.cone_tiles(ra, dec, radius), mag_limit)
+
+        inside = self.__separation(ra, dec, stars['ra'], stars['dec']) <= radius
+        return self.__stars_table(stars, inside, max_count)
+
+    def polygon(self, ra, dec, mag_limit:float=None, max_count:int=None) -> Table:
+        '''
+        Get the stars inside the polygon with vertices (ra, dec) joined by great circles, as an ADQL
+        POLYGON, brightest first.
+
+        Returns
+        -------
+        Table
+            Masked table of the catalog columns, as returned by a Gaia TAP query.
+        '''
+        ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+        mag_limit = mag_limit if mag_limit is not None else default_mag_limit
+
+        # cone about the vertices' mean direction containing the polygon
+        xyz = solver.radec_to_xyz(ra, dec)
+        center = np.sum(xyz, axis=0)
+        center /= np.linalg.norm(center)
+        center_ra, center_dec = np.degrees(np.arctan2(center[1], center[0])) % 360.0, np.degrees(np.arcsin(center[2]))
+        radius = float(np.max(self.__separation(center_ra, center_dec, ra, dec)))
+
+        stars = self.query_tiles(self.cone_tiles(center_ra, center_dec, radius), mag_limit)
+
+        # great circles are straight lines in the gnomonic projection, of the near hemisphere
+        points = solver.radec_to_xyz(stars['ra'], stars['dec'])
+        near = points @ center > 0
+        inside = np.zeros(len(points), dtype=bool)
+        inside[near] = self.__inside_polygon(solver.tan_project(points[near], center), solver.tan_project(xyz, center))
+
+        return self.__stars_table(stars, inside, max_count)
+
+    @staticmethod
+    def __stars_table(stars:dict, selected:np.ndarray, max_count:int) -> Table:
+        # stars are in order of G magnitude within each tile
+        selected = np.flatnonzero(selected)
+        selected = selected[np.argsort(stars['phot_g_mean_mag'][selected], kind='stable')]
+
+        if max_count is not None:
+            selected = selected[:max_count]
+
+        return Table({c: stars[c][selected] for c in columns}, masked=True)
+
+    @staticmethod
+    def __write_atomic(path:Path, data:bytes):
+        with tempfile.NamedTemporaryFile(dir=Path(path).parent, suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    @staticmethod
+    def __columns(table:Table) -> dict:
+        # catalog columns of a table as arrays, missing values as nan (or -1 for ids). Archive results
+        # may have upper case names (SOURCE_ID)
+        names = {n.lower(): n for n in table.colnames}
+        return {c: np.ma.filled(np.ma.asarray(table[names[c]]).astype(t), np.nan if t != np.int64 else -1) for c, t in zip(columns, column_types)}
+
+    @staticmethod
+    def __separation(ra1, dec1, ra2, dec2) -> np.ndarray:
+        # angular separation in degrees, haversine
+        ra1, dec1, ra2, dec2 = (np.radians(v) for v in (ra1, dec1, ra2, dec2))
+        h = np.sin((dec2 - dec1) / 2.0) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.0) ** 2
+
+        return np.degrees(2.0 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0))))
+
+    @staticmethod
+    def __inside_polygon(points:np.ndarray, vertices:np.ndarray) -> np.ndarray:
+        # even-odd rule, casting rays along +x
+        inside = np.zeros(len(points), dtype=bool)
+        x, y = points[:, 0], points[:, 1]
+
+        for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            crosses = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < x_cross)
+
+        return inside
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Add a bulk export of Gaia stars to the catalog store')
+    parser.add_argument('tables', nargs='+', help='tables (FITS, CSV, ECSV, ...) with the catalog columns')
+    parser.add_argument('--store', default=str(get_catalog_path()), help='catalog store directory')
+    parser.add_argument('--mag-limit', type=float, default=None, help='G magnitude to which the tables are complete')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    store = CatalogStore(args.store)
+    for fn in args.tables:
+        tiles = store.add_table(Table.read(fn), args.mag_limit)
+        logging.info(f'Added {fn} to {len(tiles)} tiles')
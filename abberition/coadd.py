@@ -0,0 +1,228 @@
+'''
+Out-of-core coaddition of solved images onto a common output frame.
+
+The output grid is split into tiles. Each tile only reprojects the input frames whose footprint
+intersects it, reading just the part of each frame that covers the tile, and writes its result
+into disk backed (memmap) coadd and weight arrays. Tiles are independent so they are processed
+across a pool of worker processes, and memory use is bounded by the tile size rather than the
+size of the mosaic.
+'''
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from ccdproc import CCDData, ImageFileCollection
+import logging
+import numpy as np
+from pathlib import Path
+import tempfile
+
+from abberition import background, combine, parallel, tiling
+
+
+class CoaddFrame:
+    '''
+    An input frame of a coadd with the bounding box (x0, x1, y0, y1) of its footprint in output pixels.
+    '''
+
+    def __init__(self, path:Path, bbox, weight:float=1.0, offset:float=0.0):
+        self.path = Path(path)
+        self.bbox = bbox
+        self.weight = weight
+        self.offset = offset
+
+    def intersects(self, tile:tiling.Tile):
+        x0, x1, y0, y1 = self.bbox
+        return x0 < tile.core[1].stop and x1 > tile.core[1].start and y0 < tile.core[0].stop and y1 > tile.core[0].start
+
+
+def coadd(images:ImageFileCollection, reprojection, out_path:Path=None, tile_size:int=1024, workers:int=None,
+          match_backgrounds:bool=True, weights:dict=None, reproject_function=None) -> CCDData:
+    '''
+    Coadd solved images onto the output frame of a reprojection, one output tile at a time.
+
+    Parameters
+    ----------
+    images : ImageFileCollection
+        Solved images to combine.
+
+    reprojection : combine.Reprojection
+        Output frame.
+
+    out_path : Path
+        Directory for the disk backed coadd.npy and weight.npy arrays. A temporary directory is used if None.
+
+    tile_size : int
+        Size of the output tiles in pixels.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    match_backgrounds : bool
+        Subtract each frame's background level difference from the mean background level before combining.
+
+    weights : dict
+        Optional weight per filename, default 1.0.
+
+    reproject_function : callable
+        Function with the signature of reproject.reproject_interp, which is used if None.
+
+    Returns
+    -------
+    CCDData
+        The weighted mean of the images, backed by the coadd memmap. The path of the weight map is in
+        the 'wgtfile' entry of its meta.
+    '''
+    frames = get_frames(images, reprojection, weights)
+
+    if len(frames) == 0:
+        raise ValueError('No images to coadd')
+
+    if match_backgrounds:
+        levels = np.array(list(parallel.map_ordered(_background_level, [f.path for f in frames], workers)))
+        for frame, level in zip(frames, levels):
+            frame.offset = float(level - np.mean(levels))
+
+    if out_path is None:
+        out_path = Path(tempfile.mkdtemp())
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    data_path = out_path / 'coadd.npy'
+    weight_path = out_path / 'weight.npy'
+    np.lib.format.open_memmap(data_path, mode='w+', dtype=np.float32, shape=reprojection.shape)
+    np.lib.format.open_memmap(weight_path, mode='w+', dtype=np.float32, shape=reprojection.shape)
+
+    tiles = tiling.get_tiles(reprojection.shape, tile_size)
+    tasks = [(tile, [f for f in frames if f.intersects(tile)]) for tile in tiles]
+
+    # tiles no frame covers are NaN, as uncovered pixels of the other tiles are, not the memmap's zeros
+    data = np.load(data_path, mmap_mode='r+')
+    for tile, _ in [t for t in tasks if len(t[1]) == 0]:
+        data[tile.core] = np.nan
+    data.flush()
+    del data
+
+    tasks = [t for t in tasks if len(t[1]) > 0]
+
+    logging.info(f'Coadding {len(frames)} frames onto {reprojection.shape[1]}x{reprojection.shape[0]} px in {len(tasks)} tiles')
+
+    header = reprojection.wcs.to_header(relax=True)
+    initargs = (header.tostring(), str(data_path), str(weight_path), reproject_function)
+
+    for tile, count in parallel.map_ordered(_coadd_tile, tasks, workers, initializer=_init_worker, initargs=initargs):
+        logging.debug(f'Coadded {count} frames into {tile}')
+
+    data = np.load(data_path, mmap_mode='r+')
+
+    ccd = CCDData(data, unit=u.adu, wcs=reprojection.wcs)
+    ccd.meta['ncombine'] = len(frames)
+    ccd.meta['wgtfile'] = str(weight_path)
+
+    return ccd
+
+
+def get_frames(images, reprojection, weights:dict=None) -> list:
+    '''
+    Get the CoaddFrame of each image from its header only.
+    '''
+    frames = []
+
+    for header, fn in images.headers(return_fname=True):
+        wcs = WCS(header)
+        ra, dec = combine.get_footprint(wcs, (header['naxis2'], header['naxis1']))
+        x, y = reprojection.wcs.all_world2pix(ra, dec, 0)
+
+        bbox = (int(np.floor(np.min(x))) - 1, int(np.ceil(np.max(x))) + 2, int(np.floor(np.min(y))) - 1, int(np.ceil(np.max(y))) + 2)
+        weight = 1.0 if weights is None else weights.get(fn, 1.0)
+
+        frames.append(CoaddFrame(Path(images.location) / fn, bbox, weight))
+
+    return frames
+
+
+def _background_level(path):
+    with fits.open(path, memmap=True) as hdus:
+        data = np.asarray(hdus[0].data, dtype=np.float32)
+        return background.get_background(data, use_cache=False).median
+
+
+__worker = {}
+
+
+def _init_worker(header:str, data_path:str, weight_path:str, reproject_function):
+    if reproject_function is None:
+        from reproject import reproject_interp
+        reproject_function = reproject_interp
+
+    __worker['wcs'] = WCS(fits.Header.fromstring(header))
+    __worker['data_path'] = data_path
+    __worker['weight_path'] = weight_path
+    __worker['reproject'] = reproject_function
+
+
+def _coadd_tile(task):
+    tile, frames = task
+    (r0, r1), (c0, c1) = (tile.core[0].start, tile.core[0].stop), (tile.core[1].start, tile.core[1].stop)
+    shape = (r1 - r0, c1 - c0)
+
+    tile_wcs = __worker['wcs'][r0:r1, c0:c1]
+    total = np.zeros(shape, dtype=np.float64)
+    weight = np.zeros(shape, dtype=np.float64)
+    count = 0
+
+    for frame in frames:
+        with fits.open(frame.path, memmap=True) as hdus:
+            hdu = hdus[0]
+            frame_wcs = WCS(hdu.header)
+
+            section = get_input_section(frame_wcs, (hdu.header['naxis2'], hdu.header['naxis1']), tile_wcs, shape)
+            if section is None:
+                continue
+
+            (y0, y1), (x0, x1) = section
+            data = np.asarray(hdu.section[y0:y1, x0:x1], dtype=np.float32)
+
+        array, footprint = __worker['reproject']((data, frame_wcs[y0:y1, x0:x1]), tile_wcs, shape_out=shape)
+
+        valid = (footprint > 0) & np.isfinite(array)
+        w = np.where(valid, footprint * frame.weight, 0.0)
+        total += np.where(valid, array - frame.offset, 0.0) * w
+        weight += w
+        count += 1
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(weight > 0, total / weight, np.nan)
+
+    out = np.load(__worker['data_path'], mmap_mode='r+')
+    out[r0:r1, c0:c1] = mean
+    out.flush()
+
+    out_weight = np.load(__worker['weight_path'], mmap_mode='r+')
+    out_weight[r0:r1, c0:c1] = weight
+    out_weight.flush()
+
+    return tile, count
+
+
+def get_input_section(frame_wcs:WCS, frame_shape, tile_wcs:WCS, tile_shape, margin:int=3):
+    '''
+    Get the region ((y0, y1), (x0, x1)) of a frame needed to reproject onto a tile, or None if they don't overlap.
+    '''
+    ra, dec = combine.get_footprint(tile_wcs, tile_shape)
+
+    with np.errstate(invalid='ignore'):
+        x, y = frame_wcs.all_world2pix(ra, dec, 0, quiet=True)
+
+    if not np.all(np.isfinite(x)) or not np.all(np.isfinite(y)):
+        return ((0, frame_shape[0]), (0, frame_shape[1]))
+
+    x0 = max(int(np.floor(np.min(x))) - margin, 0)
+    x1 = min(int(np.ceil(np.max(x))) + margin + 1, frame_shape[1])
+    y0 = max(int(np.floor(np.min(y))) - margin, 0)
+    y1 = min(int(np.ceil(np.max(y))) + margin + 1, frame_shape[0])
+
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    return ((y0, y1), (x0, x1))
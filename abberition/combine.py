@@ -1,11 +1,17 @@
 from . import io
-from astropy import units as u
+from . import parallel
+from . import shared
+from . import wcs_helpers
+from astropy.io import fits
 from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
 from ccdproc import CCDData, ImageFileCollection, wcs_project
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from reproject import reproject_interp
-from reproject.mosaicking import reproject_and_coadd, find_optimal_celestial_wcs
 import logging
+import numpy as np
+import queue
 
 class Reprojection:
     def width(self):
@@ -19,39 +25,272 @@ class Reprojection:
         self.shape = shape
         
 
-def get_reprojection(ifc:ImageFileCollection, res_arcsec:float=1.0):
-    hdus = ifc.hdus()
-    wcs_out, shape_out = find_optimal_celestial_wcs(hdus, resolution=res_arcsec * u.arcsec, auto_rotate=True)
+def get_reprojection(images, res_arcsec:float=1.0, auto_rotate:bool=True, samples:int=8, projection:str='TAN'):
+    '''
+    Find the output frame that covers all images, using only their headers.
+
+    Each image's footprint on the sky is taken from samples along its edges (including the
+    corners), so no pixel data is read and memory use only grows with the number of samples.
+
+    Parameters
+    ----------
+    images : ImageFileCollection or iterable of Header
+        Solved images to cover.
+
+    res_arcsec : float
+        Output resolution in arcsec/px. If None, the finest input resolution is used.
+
+    auto_rotate : bool
+        Rotate the output frame to minimize its area, otherwise north is up.
+
+    samples : int
+        Number of samples along each edge of each image.
+
+    projection : str
+        Projection code of the output frame.
+
+    Returns
+    -------
+    Reprojection
+    '''
+    headers = images.headers() if isinstance(images, ImageFileCollection) else images
+
+    footprints = []
+    finest_res = np.inf
+
+    for header in headers:
+        wcs = WCS(header)
+
+        if not wcs.has_celestial:
+            logging.warning('Skipping image without a celestial WCS when planning reprojection')
+            continue
+
+        footprints.append(get_footprint(wcs, (header['naxis2'], header['naxis1']), samples))
+        finest_res = min(finest_res, np.min(proj_plane_pixel_scales(wcs.celestial)) * 3600.0)
+
+    if len(footprints) == 0:
+        raise ValueError('No images with a celestial WCS to plan reprojection from')
+
+    ra = np.concatenate([f[0] for f in footprints])
+    dec = np.concatenate([f[1] for f in footprints])
+
+    if res_arcsec is None:
+        res_arcsec = finest_res
+
+    # center on the mean direction of all samples
+    ra_rad, dec_rad = np.radians(ra), np.radians(dec)
+    x, y, z = np.mean(np.cos(dec_rad) * np.cos(ra_rad)), np.mean(np.cos(dec_rad) * np.sin(ra_rad)), np.mean(np.sin(dec_rad))
+    center_ra = np.degrees(np.arctan2(y, x)) % 360.0
+    center_dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+
+    wcs_out = WCS(naxis=2)
+    wcs_out.wcs.ctype = [f'RA---{projection}', f'DEC--{projection}']
+    wcs_out.wcs.crval = [center_ra, center_dec]
+    wcs_out.wcs.cdelt = [-res_arcsec / 3600.0, res_arcsec / 3600.0]
+    wcs_out.wcs.crpix = [1.0, 1.0]
+
+    xp, yp = wcs_out.wcs_world2pix(ra, dec, 0)
+
+    if auto_rotate:
+        angle = __min_area_angle(xp, yp)
+
+        if angle != 0.0:
+            c, s = np.cos(angle), np.sin(angle)
+            wcs_out.wcs.pc = [[c, -s], [s, c]]
+            xp, yp = wcs_out.wcs_world2pix(ra, dec, 0)
+
+    xmin, ymin = np.floor(np.min(xp)), np.floor(np.min(yp))
+    wcs_out.wcs.crpix = [1.0 - xmin, 1.0 - ymin]
+
+    shape_out = (int(np.ceil(np.max(yp) - ymin)) + 1, int(np.ceil(np.max(xp) - xmin)) + 1)
+    wcs_out.pixel_shape = (shape_out[1], shape_out[0])
+
+    logging.info(f'Planned reprojection of {len(footprints)} images onto {shape_out[1]}x{shape_out[0]} px at {res_arcsec:.3f}"/px')
+
     reprojection = Reprojection(wcs_out, shape_out)
     return reprojection
 
 
-def reproject_images(ifc:ImageFileCollection, reprojection:Reprojection, dest_path:Path=None):
-    files = []
-    
-    for ccd, fn in ifc.ccds(return_fname=True):
-        projected = wcs_project(ccd, reprojection.wcs, shape_out=reprojection.shape)
-        files.append(fn)
-        projected.write(dest_path / fn, overwrite=True)
+def __min_area_angle(x:np.ndarray, y:np.ndarray) -> float:
+    '''
+    Get the rotation of the output frame that minimizes the area of the frame covering the points, 0 if
+    no rotation gives a smaller frame than north up.
+
+    The minimum area rectangle around a set of points has a side along an edge of their convex hull
+    (rotating calipers), so only the angles of the hull's edges are tried.
+    '''
+    from scipy.spatial import ConvexHull, QhullError
+
+    points = np.column_stack([x, y])
+
+    try:
+        hull = points[ConvexHull(points).vertices]
+    except QhullError:
+        # collinear or too few points
+        return 0.0
+
+    edges = np.roll(hull, -1, axis=0) - hull
+    angles = np.concatenate([[0.0], np.arctan2(edges[:, 1], edges[:, 0]) % (np.pi / 2)])
+
+    # output pixels of the hull rotated by -angle, as the frame's PC matrix rotates by angle
+    c, s = np.cos(angles)[:, None], np.sin(angles)[:, None]
+    xr = c * hull[:, 0] + s * hull[:, 1]
+    yr = -s * hull[:, 0] + c * hull[:, 1]
+    areas = (np.ptp(xr, axis=1) + 1.0) * (np.ptp(yr, axis=1) + 1.0)
+
+    best = int(np.argmin(areas))
+    return float(angles[best]) if areas[best] < areas[0] * (1.0 - 1e-6) else 0.0
+
+
+def get_footprint(wcs:WCS, shape, samples:int=8):
+    '''
+    Get the sky coordinates (ra, dec in degrees) of samples along the edges of an image of shape (rows, cols),
+    including its corners.
+    '''
+    rows, cols = shape
+    t = np.linspace(0.0, 1.0, max(samples, 2))
+
+    x = np.concatenate([t * (cols - 1), np.full_like(t, cols - 1), t * (cols - 1), np.zeros_like(t)])
+    y = np.concatenate([np.zeros_like(t), t * (rows - 1), np.full_like(t, rows - 1), t * (rows - 1)])
+
+    ra, dec = wcs.all_pix2world(x, y, 0)
+
+    return ra, dec
+
+
+def reproject_images(ifc:ImageFileCollection, reprojection:Reprojection, dest_path:Path=None, workers:int=1):
+    '''
+    Reproject each image onto the reprojection's output frame and write it to dest_path.
+
+    With more than one worker (None for all cores) images are reprojected across a process pool. Each
+    worker builds the output frame once, and returns its result through a shared memory slot rather
+    than pickling the array. A single writer thread writes the results in order and frees their slots,
+    so the number of frames in memory is bounded by the number of slots. Uncertainties are not
+    reprojected in parallel mode.
+    '''
+    if workers == 1:
+        files = []
+        
+        for ccd, fn in ifc.ccds(return_fname=True):
+            projected = wcs_project(ccd, reprojection.wcs, target_shape=reprojection.shape)
+            files.append(fn)
+            projected.write(dest_path / fn, overwrite=True)
+    else:
+        files = __reproject_parallel(ifc, reprojection, dest_path, parallel.get_worker_count(workers))
     
     projected_ifc = ImageFileCollection(dest_path, filenames=files, keywords='*')
     return projected_ifc
 
-def combine_images(ifc:ImageFileCollection) -> CCDData:
-    raise NotImplementedError()
 
-def combine_solved_images(ifc:ImageFileCollection, reprojection:Reprojection, match_backgrounds:bool=True) -> CCDData:
-    hdus = list(ifc.hdus())
+def __reproject_parallel(ifc:ImageFileCollection, reprojection:Reprojection, dest_path:Path, workers:int):
+    files = list(ifc.files_filtered())
+    slots = [shared.SharedArray.create(reprojection.shape, np.float32) for _ in range(2 * workers)]
+
+    free_slots = queue.Queue()
+    for i in range(len(slots)):
+        free_slots.put(i)
+
+    initargs = (reprojection.wcs.to_header(relax=True).tostring(), reprojection.shape, [slot.spec() for slot in slots])
+
+    def write(future, slot, path):
+        try:
+            header = fits.Header.fromstring(future.result())
+            data = slots[slot].array
+            projected = CCDData(data, unit=header.get('bunit', 'adu'), meta=header, wcs=reprojection.wcs, mask=np.isnan(data))
+            projected.write(path, overwrite=True)
+        finally:
+            free_slots.put(slot)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_reproject_worker, initargs=initargs) as pool, \
+                ThreadPoolExecutor(max_workers=1) as writer:
+            writes = []
+
+            for fn in files:
+                # blocks until the writer has freed a slot
+                slot = free_slots.get()
+                future = pool.submit(_reproject_to_slot, str(Path(ifc.location) / fn), slot)
+                writes.append(writer.submit(write, future, slot, dest_path / fn))
+
+            for w in writes:
+                w.result()
+    finally:
+        for slot in slots:
+            slot.unlink()
+
+    return files
+
+
+__reproject_worker = {}
+
+
+def _init_reproject_worker(header:str, shape, slot_specs):
+    __reproject_worker['wcs'] = WCS(fits.Header.fromstring(header))
+    __reproject_worker['shape'] = shape
+    __reproject_worker['slots'] = [shared.SharedArray.attach(spec) for spec in slot_specs]
+
+
+def _reproject_to_slot(path:str, slot:int) -> str:
+    ccd = CCDData.read(path, unit='adu')
+    ccd.uncertainty = None
+
+    projected = wcs_project(ccd, __reproject_worker['wcs'], target_shape=__reproject_worker['shape'])
+    __reproject_worker['slots'][slot].array[...] = projected.data
+
+    header = fits.Header(projected.meta)
+    wcs_helpers.remove_wcs_header(header)
+
+    return header.tostring()
+
+
+def drizzle_solved_images(ifc:ImageFileCollection, reprojection:Reprojection=None, scale:float=2.0, pixfrac:float=0.8, match_backgrounds:bool=True,
+                          tile_size:int=1024, workers:int=None, out_path:Path=None) -> CCDData:
+    '''
+    Drizzle solved images onto an output frame finer than the inputs, scale times finer than the finest
+    input if reprojection is None. Suited to undersampled images. See drizzle.drizzle_images.
+    '''
+    from . import drizzle
+
+    filters = set(h['filter'] for h in ifc.headers())
+    if len(filters) > 1:
+        logging.warning(f'Drizzling images with different filters: {filters}')
+
+    return drizzle.drizzle_images(ifc, reprojection, scale=scale, pixfrac=pixfrac, out_path=out_path, tile_size=tile_size, workers=workers,
+                                  match_backgrounds=match_backgrounds)
+
+
+def combine_images(ifc:ImageFileCollection, method:str='sigma_clip', weights=None, match_backgrounds:bool=True, **kwargs) -> CCDData:
+    '''
+    Combine aligned images with per-pixel rejection, streaming over bands of rows. See stack.stack for
+    the rejection methods and their parameters.
+    '''
+    from . import stack
+
+    return stack.stack(ifc, method=method, weights=weights, match_backgrounds=match_backgrounds, **kwargs)
+
+def combine_solved_images(ifc:ImageFileCollection, reprojection:Reprojection, match_backgrounds:bool=True, tile_size:int=1024, workers:int=None,
+                          out_path:Path=None, mapping_error:float=None) -> CCDData:
+    '''
+    Reproject and combine solved images onto the reprojection's output frame.
+
+    The output is built tile by tile into disk backed arrays in out_path (a temporary directory if None),
+    so mosaics larger than memory can be combined. See coadd.coadd.
+
+    If mapping_error (pixels) is set, frames are reprojected with cached interpolated pixel mappings
+    (see mapping.reproject) instead of evaluating both WCS at every pixel.
+    '''
+    from . import coadd
+
+    reproject_function = None
+    if mapping_error is not None:
+        from . import mapping
+        reproject_function = partial(mapping.reproject, max_error=mapping_error)
 
-    filter = hdus[0].header['filter']
-    for h in hdus:
-        if h.header['filter'] != filter:
-            logging.warning()
-    # combine and align in one go
-    array, footprint = reproject_and_coadd(hdus, reprojection.wcs, shape_out=reprojection.shape, reproject_function=reproject_interp, match_background=match_backgrounds)
+    filters = set(h['filter'] for h in ifc.headers())
+    if len(filters) > 1:
+        logging.warning(f'Combining images with different filters: {filters}')
 
-    ccd = CCDData(array, unit=u.adu)
-    ccd.wcs = reprojection.wcs
+    ccd = coadd.coadd(ifc, reprojection, out_path=out_path, tile_size=tile_size, workers=workers, match_backgrounds=match_backgrounds,
+                      reproject_function=reproject_function)
     
     return ccd
-    
\ No newline at end of file
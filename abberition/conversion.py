@@ -6,12 +6,11 @@ from . import io
 def to_float32(image:CCDData):
     return to_type(image, np.float32, True)
 
-def to_type(images:CCDData|ImageFileCollection, dtype:np.dtype, copy:bool=True):
-    if images is CCDData:
-        if copy:
-            image = image.copy()
+def to_type(image:CCDData, dtype:np.dtype, copy:bool=True):
+    if copy:
+        image = image.copy()
 
-        image.data = image.data.astype(dtype)
+    image.data = np.asarray(image.data).astype(dtype, copy=False)
     return image
 
 def convert_all_to_type(images:ImageFileCollection, dtype:np.dtype, dest_path:Path, overwrite:bool=False):
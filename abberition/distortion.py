@@ -0,0 +1,339 @@
+'''
+Distortion model of an optical setup, fit jointly from many solved frames and kept in the library.
+
+The distortion of the optics is fixed to the sensor for an instrument, binning and rotator angle,
+while the pointing, rotation and scale differ from frame to frame. All frames of a setup are fit
+together, with SIP polynomials shared by the frames and a linear solution (CRVAL and CD) for each
+frame. With the linear part written inverted,
+
+    u + A(u, v) = M_f (xi, eta) + d_f
+
+is linear in all the unknowns, where (u, v) are pixel offsets from the reference pixel at the centre
+of the sensor and (xi, eta) the gnomonic projection of the matched gaia star about the frame's
+pointing. So the fit is one sparse least squares problem with a row per matched star, solved with
+LSQR, and the same for v with B.
+
+solve_wcs uses the model of a frame's setup as a fixed prior if the library has one, and only fits
+the linear WCS to the matched stars (see solver.refine_wcs).
+'''
+
+from astropy.io import fits
+from astropy.wcs import WCS, Sip
+import logging
+import numpy as np
+from pathlib import Path
+
+from abberition import library, matching, metrics, solver
+
+
+# header keywords of the rotator angle, the first one found is used
+rotator_keywords = ['rotatang', 'rotator', 'rotangle']
+
+
+def get_setup(header, rotator_step:float=1.0) -> dict:
+    '''
+    Get the optical setup of a frame, as header keywords and values of its distortion model.
+
+    The setup is the instrument, binning, frame size (imagew and imageh) and, if the header has one,
+    the rotator angle rounded to rotator_step degrees.
+    '''
+    setup = {'instrume': header.get('instrume', 'unknown'),
+             'xbinning': header.get('xbinning', 1),
+             'ybinning': header.get('ybinning', 1),
+             'imagew': header['naxis1'],
+             'imageh': header['naxis2']}
+
+    for keyword in rotator_keywords:
+        if keyword in header:
+            setup['rotatang'] = float(round(float(header[keyword]) / rotator_step) * rotator_step) % 360.0
+            break
+
+    return setup
+
+
+def get_model(header) -> WCS:
+    '''
+    Get the distortion model of the setup of a frame from the library, None if there is none.
+    '''
+    model, _ = library.select_distortion(get_setup(header))
+    if model is None:
+        return None
+
+    return WCS(model)
+
+
+def fit_distortion(frames:list, shape, order:int=3, iterations:int=4, clip:float=3.0):
+    '''
+    Fit one SIP distortion to many solved frames of a setup, with a linear WCS per frame.
+
+    Parameters
+    ----------
+    frames : list
+        (wcs, pixels, ra, dec) of each frame: its solved WCS, the (x, y) pixel positions of its
+        matched stars, shape (n, 2), and the sky positions of their gaia matches in degrees.
+
+    shape : tuple
+        (height, width) of the frames.
+
+    order : int
+        Order of the SIP polynomials.
+
+    iterations : int
+        Number of fits. Each moves the pointing of each frame to its reference pixel and rejects
+        matches more than clip robust standard deviations from the fit.
+
+    Returns
+    -------
+    model : WCS
+        TAN-SIP WCS of the first frame, with the reference pixel at the centre of the sensor.
+
+    rms : float
+        Rms residual of the matches kept in pixels.
+
+    n_stars : int
+        Number of matches kept.
+    '''
+    from scipy.sparse import coo_matrix, diags
+    from scipy.sparse.linalg import lsqr
+
+    crpix = np.array([(shape[1] + 1) / 2.0, (shape[0] + 1) / 2.0])
+    scale = max(shape) / 2.0
+    terms = [(p, n - p) for n in range(2, order + 1) for p in range(n, -1, -1)]
+
+    pixels = [np.asarray(f[1], dtype=np.float64).reshape(-1, 2) for f in frames]
+    xyz = [solver.radec_to_xyz(f[2], f[3]) for f in frames]
+    tangents = [solver.radec_to_xyz(*f[0].all_pix2world([crpix], 1)[0])[0] for f in frames]
+    keep = [np.ones(len(p), dtype=bool) for p in pixels]
+
+    offsets = np.concatenate(pixels) - (crpix - 1.0)
+    frame = np.concatenate([np.full(len(p), f) for f, p in enumerate(pixels)])
+
+    # a row per match, with the polynomial terms shared by all frames and (M_f, d_f) of its frame
+    poly = np.column_stack([(offsets[:, 0] / scale) ** p * (offsets[:, 1] / scale) ** q for p, q in terms])
+    cols = np.concatenate([np.tile(np.arange(len(terms)), (len(offsets), 1)),
+                           len(terms) + 3 * frame[:, None] + np.arange(3)[None, :]], axis=1)
+    rows = np.repeat(np.arange(len(offsets)), cols.shape[1])
+    unknowns = len(terms) + 3 * len(frames)
+
+    for _ in range(iterations):
+        plane = np.concatenate([solver.tan_project(x, t) for x, t in zip(xyz, tangents)])
+        values = np.concatenate([poly, -plane, -np.ones((len(offsets), 1))], axis=1)
+        design = coo_matrix((values.ravel(), (rows, cols.ravel())), shape=(len(offsets), unknowns)).tocsr()
+
+        # scale the columns to unit norm, as the plane columns are in degrees and the others in pixels
+        kept = np.concatenate(keep)
+        norms = np.sqrt(np.asarray(design[kept].multiply(design[kept]).sum(axis=0))).ravel()
+        norms[norms == 0] = 1.0
+        scaled = design[kept] @ diags(1.0 / norms)
+
+        solution = [lsqr(scaled, -offsets[kept, k], atol=1e-14, btol=1e-14, iter_lim=10000)[0] / norms for k in range(2)]
+        linear = [s[len(terms):].reshape(-1, 3) for s in solution]
+
+        residuals = np.hypot(*[design @ solution[k] + offsets[:, k] for k in range(2)])
+        sigma = 1.4826 * np.median(residuals[kept])
+        keep = np.split(residuals <= max(clip * sigma, 1e-3), np.cumsum([len(p) for p in pixels])[:-1])
+
+        # move each frame's pointing to where its reference pixel points
+        for f in range(len(frames)):
+            m = np.array([linear[0][f, :2], linear[1][f, :2]])
+            d = np.array([linear[0][f, 2], linear[1][f, 2]])
+            tangents[f] = solver.tan_deproject(-np.linalg.solve(m, d), tangents[f])[0]
+
+    a = np.zeros((order + 1, order + 1))
+    b = np.zeros((order + 1, order + 1))
+    for t, (p, q) in enumerate(terms):
+        a[p, q] = solution[0][t] / scale ** (p + q)
+        b[p, q] = solution[1][t] / scale ** (p + q)
+
+    ap, bp = __inverse_sip(a, b, shape, crpix, order + 1)
+
+    ra, dec = solver.xyz_to_radec(tangents[0])
+    model = WCS(naxis=2)
+    model.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+    model.wcs.crpix = crpix
+    model.wcs.crval = [ra[0], dec[0]]
+    model.wcs.cd = np.linalg.inv(np.array([linear[0][0, :2], linear[1][0, :2]]))
+    model.sip = Sip(a, b, ap, bp, crpix)
+    model.pixel_shape = (shape[1], shape[0])
+
+    kept = np.concatenate(keep)
+
+    return model, float(np.sqrt(np.mean(residuals[kept] ** 2))), int(np.count_nonzero(kept))
+
+
+def __inverse_sip(a:np.ndarray, b:np.ndarray, shape, crpix:np.ndarray, order:int):
+    # AP and BP polynomials fit to the forward distortion over a grid of the frame
+    u, v = np.meshgrid(np.linspace(0, shape[1] - 1, 50) - (crpix[0] - 1.0), np.linspace(0, shape[0] - 1, 50) - (crpix[1] - 1.0))
+    u, v = u.ravel(), v.ravel()
+
+    terms = [(p, n - p) for n in range(order + 1) for p in range(n, -1, -1)]
+    fu = u + sum(a[p, q] * u ** p * v ** q for p in range(a.shape[0]) for q in range(a.shape[1]) if a[p, q] != 0)
+    fv = v + sum(b[p, q] * u ** p * v ** q for p in range(b.shape[0]) for q in range(b.shape[1]) if b[p, q] != 0)
+
+    scale = max(shape) / 2.0
+    design = np.column_stack([(fu / scale) ** p * (fv / scale) ** q for p, q in terms])
+    ap = np.zeros((order + 1, order + 1))
+    bp = np.zeros((order + 1, order + 1))
+
+    for coefficients, target in [(ap, u - fu), (bp, v - fv)]:
+        solution = np.linalg.lstsq(design, target, rcond=None)[0]
+        for t, (p, q) in enumerate(terms):
+            coefficients[p, q] = solution[t] / scale ** (p + q)
+
+    return ap, bp
+
+
+def read_solved(path:Path):
+    '''
+    Read the WCS, header and matched stars of a frame solved by astrometry.solve_wcs.
+
+    Returns
+    -------
+    tuple
+        (header, wcs, pixels, ra, dec), with the (x, y) pixel positions of the matched stars, shape
+        (n, 2), and the sky positions of their gaia matches in degrees.
+    '''
+    with fits.open(path) as hdus:
+        header = hdus[0].header.copy()
+        stars = hdus[1].data
+
+        pixels = np.column_stack([stars['x'], stars['y']]).astype(np.float64)
+        ra = np.array(stars['gaia_ra'], dtype=np.float64)
+        dec = np.array(stars['gaia_dec'], dtype=np.float64)
+
+    return header, WCS(header), pixels, ra, dec
+
+
+def save_model(model:WCS, setup:dict, n_frames:int, n_stars:int, rms:float) -> Path:
+    '''
+    Save a distortion model to the library as a header only FITS file with imagetyp 'distortion',
+    replacing the model of the same setup.
+    '''
+    header = fits.Header()
+    header['imagetyp'] = 'distortion'
+    for key, value in setup.items():
+        header[key] = value
+
+    header['nframes'] = (n_frames, 'Frames the distortion was fit to')
+    header['nstars'] = (n_stars, 'Matched stars the distortion was fit to')
+    header['siprms'] = (rms, '[pixel] Rms residual of the fit')
+    header.update(model.to_header(relax=True))
+
+    return library.save_distortion(header)
+
+
+def fit_frames(paths:list, order:int=3, min_frames:int=5) -> list:
+    '''
+    Fit and save the distortion model of each setup with at least min_frames solved frames.
+
+    Parameters
+    ----------
+    paths : list
+        Paths of frames solved by astrometry.solve_wcs.
+
+    Returns
+    -------
+    list
+        Library paths of the saved models.
+    '''
+    setups = {}
+    for path in paths:
+        header, wcs, pixels, ra, dec = read_solved(path)
+        setup = get_setup(header)
+        setups.setdefault(tuple(sorted(setup.items())), []).append((wcs, pixels, ra, dec))
+
+    saved = []
+    for key, frames in setups.items():
+        setup = dict(key)
+        if len(frames) < min_frames:
+            logging.info(f'Not fitting distortion of {setup}, {len(frames)} of {min_frames} frames solved')
+            continue
+
+        model, rms, n_stars = fit_distortion(frames, (setup['imageh'], setup['imagew']), order)
+        logging.info(f'Fit distortion of {setup} to {n_stars} stars of {len(frames)} frames, rms {rms:.3f} px')
+
+        saved.append(save_model(model, setup, len(frames), n_stars, rms))
+
+    return saved
+
+
+def apply_model(wcs:WCS, model:WCS) -> WCS:
+    '''
+    Get a WCS with the reference pixel and distortion of the model, and the pointing, rotation and
+    scale of wcs at that reference pixel.
+    '''
+    crpix = model.wcs.crpix
+    ra, dec = wcs.all_pix2world([crpix], 1)[0]
+
+    prior = WCS(naxis=2)
+    prior.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+    prior.wcs.crpix = crpix
+    prior.wcs.crval = [ra, dec]
+    prior.wcs.cd = wcs.pixel_scale_matrix
+    prior.sip = model.sip
+    prior.pixel_shape = model.pixel_shape
+
+    return prior
+
+
+def refine_with_model(wcs:WCS, model:WCS, stars_px:np.ndarray, ra, dec, max_separation_px:float=25.0,
+                      tolerance_px:float=3.0, min_matches:int=8):
+    '''
+    Refine an initial WCS of a frame with the distortion model of its setup fixed, fitting only the
+    linear WCS.
+
+    Stars are matched with the gaias projected with the model applied to wcs, first within
+    max_separation_px and then within tolerance_px of the refined projections.
+
+    Parameters
+    ----------
+    wcs : WCS
+        Initial WCS of the frame, such as from solver.solve.
+
+    model : WCS
+        Distortion model of the frame's setup, as from get_model.
+
+    stars_px : ndarray
+        (x, y) positions of the stars found, brightest first, shape (n, 2).
+
+    ra, dec : array
+        Sky positions of the gaia stars in the frame in degrees.
+
+    Returns
+    -------
+    tuple
+        (wcs, matched star indices, matched gaia indices), or None if fewer than min_matches stars
+        match.
+    '''
+    wcs = apply_model(wcs, model)
+    stars_px = np.asarray(stars_px, dtype=np.float64)
+
+    for tolerance in [max_separation_px, 4 * tolerance_px, tolerance_px, tolerance_px]:
+        predicted = np.column_stack(wcs.all_world2pix(ra, dec, 0))
+        pairs, _ = matching.match_pairs(stars_px, predicted, tolerance)
+
+        if len(pairs) < min_matches:
+            return None
+
+        refined = solver.refine_wcs(wcs, stars_px[pairs[:, 0]], ra[pairs[:, 1]], dec[pairs[:, 1]])
+        if refined is None:
+            return None
+        wcs = refined
+
+    metrics.count('distortion_priors')
+
+    return wcs, pairs[:, 0], pairs[:, 1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fit the distortion model of each setup of solved frames and save it to the library.')
+    parser.add_argument('paths', nargs='+', type=Path, help='frames solved by astrometry.solve_wcs')
+    parser.add_argument('--order', type=int, default=3, help='order of the SIP polynomials')
+    parser.add_argument('--min-frames', type=int, default=5, help='fewest solved frames to fit a setup')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for path in fit_frames(args.paths, args.order, args.min_frames):
+        print(path)
@@ -0,0 +1,200 @@
+'''
+Drizzle solved images onto an output frame finer than the inputs, for undersampled data.
+
+Each input pixel is shrunk about its centre by pixfrac into a drop, and the drop's value is added
+to the output pixels it overlaps in proportion to the overlap area. Drops are squares aligned with
+the output pixels, sized from the local pixel scale (the 'turbo' kernel of drizzlepac), so overlaps
+are separable and every input pixel of a frame is dropped at once. Input pixel centres are mapped
+onto the output frame with cached pixel mappings (see mapping.py).
+
+The drizzle kernel has the signature of reproject.reproject_interp, returning the accumulated weight
+as the footprint, so the tiled disk backed accumulation of coadd.coadd is used for the output.
+'''
+
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from ccdproc import CCDData, ImageFileCollection
+from functools import partial
+import logging
+import numpy as np
+from pathlib import Path
+
+from abberition import coadd, combine, mapping
+
+
+def drizzle(input_data, output_projection, shape_out=None, pixfrac:float=1.0, max_error:float=0.01):
+    '''
+    Drizzle an image onto an output frame.
+
+    Parameters
+    ----------
+    input_data : tuple
+        (array, WCS or Header) of the input image.
+
+    output_projection : WCS or Header
+        Output frame.
+
+    shape_out : tuple
+        Output shape, required if output_projection doesn't define it.
+
+    pixfrac : float
+        Linear size of the drops as a fraction of the input pixels.
+
+    max_error : float
+        Maximum error in output pixels of the mapping of input pixel centres.
+
+    Returns
+    -------
+    array, weight : ndarray
+        Weighted mean of the drops on each output pixel (NaN where there are none), and the total
+        overlap area of the drops with each output pixel.
+    '''
+    data, wcs_in = input_data
+    wcs_in = wcs_in if isinstance(wcs_in, WCS) else WCS(wcs_in)
+    wcs_out = output_projection if isinstance(output_projection, WCS) else WCS(output_projection)
+
+    if shape_out is None:
+        shape_out = wcs_out.array_shape
+
+    rows, cols = shape_out
+    data = np.asarray(data, dtype=np.float32)
+
+    x, y = mapping.get_pixel_mapping(wcs_in, data.shape, wcs_out, max_error=max_error).evaluate()
+
+    # drop half size from the area of each input pixel on the output frame
+    if min(data.shape) < 2:
+        # sections thinner than 2 pixels have no gradient along the thin axis, so map the pixel edges
+        dx_dr, dx_dc, dy_dr, dy_dc = __edge_differences(wcs_in, wcs_out, data.shape)
+    else:
+        dx_dr, dx_dc = np.gradient(x)
+        dy_dr, dy_dc = np.gradient(y)
+    half = 0.5 * pixfrac * np.sqrt(np.abs(dx_dc * dy_dr - dx_dr * dy_dc))
+
+    valid = np.isfinite(data) & np.isfinite(x) & np.isfinite(y)
+    valid &= (x + half > -0.5) & (x - half < cols - 0.5) & (y + half > -0.5) & (y - half < rows - 0.5)
+
+    values, x, y, half = data[valid], x[valid], y[valid], half[valid]
+
+    total = np.zeros(rows * cols, dtype=np.float64)
+    weight = np.zeros(rows * cols, dtype=np.float64)
+
+    if len(values) > 0:
+        reach = int(np.ceil(2 * np.max(half))) + 1
+        x_overlaps = __overlaps(x, half, reach)
+        y_overlaps = __overlaps(y, half, reach)
+
+        for iy, oy in y_overlaps:
+            for ix, ox in x_overlaps:
+                area = oy * ox
+                inside = (area > 0) & (ix >= 0) & (ix < cols) & (iy >= 0) & (iy < rows)
+                index = iy[inside] * cols + ix[inside]
+
+                total += np.bincount(index, weights=area[inside] * values[inside], minlength=rows * cols)
+                weight += np.bincount(index, weights=area[inside], minlength=rows * cols)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        array = np.where(weight > 0, total / weight, np.nan)
+
+    return array.reshape(shape_out).astype(np.float32), weight.reshape(shape_out).astype(np.float32)
+
+
+def __edge_differences(wcs_in:WCS, wcs_out:WCS, shape):
+    '''
+    Get the derivatives of output x and y by input row and column of each input pixel, from the
+    differences between its opposite edges mapped through the WCS.
+    '''
+    rows, cols = np.indices(shape, dtype=np.float64)
+
+    def to_out(r, c):
+        ra, dec = wcs_in.all_pix2world(c, r, 0)
+        with np.errstate(invalid='ignore'):
+            return wcs_out.all_world2pix(ra, dec, 0, quiet=True)
+
+    (x_r0, y_r0), (x_r1, y_r1) = to_out(rows - 0.5, cols), to_out(rows + 0.5, cols)
+    (x_c0, y_c0), (x_c1, y_c1) = to_out(rows, cols - 0.5), to_out(rows, cols + 0.5)
+
+    return x_r1 - x_r0, x_c1 - x_c0, y_r1 - y_r0, y_c1 - y_c0
+
+
+def __overlaps(center:np.ndarray, half:np.ndarray, reach:int):
+    '''
+    Get (output pixel index, overlap length) of the drops along one axis, for each of the reach pixels
+    a drop can touch.
+    '''
+    lo, hi = center - half, center + half
+    first = np.floor(lo + 0.5).astype(np.int64)
+
+    overlaps = []
+    for k in range(reach):
+        index = first + k
+        overlaps.append((index, np.clip(np.minimum(hi, index + 0.5) - np.maximum(lo, index - 0.5), 0.0, None)))
+
+    return overlaps
+
+
+def get_reprojection(images, scale:float=2.0, **kwargs) -> combine.Reprojection:
+    '''
+    Get the output frame covering all images with pixels scale times finer than the finest input pixels.
+    Other arguments are passed to combine.get_reprojection.
+    '''
+    headers = list(images.headers() if isinstance(images, ImageFileCollection) else images)
+
+    finest_res = np.inf
+    for header in headers:
+        wcs = WCS(header)
+        if wcs.has_celestial:
+            finest_res = min(finest_res, np.min(proj_plane_pixel_scales(wcs.celestial)) * 3600.0)
+
+    if not np.isfinite(finest_res):
+        raise ValueError('No images with a celestial WCS to drizzle')
+
+    return combine.get_reprojection(headers, res_arcsec=finest_res / scale, **kwargs)
+
+
+def drizzle_images(images:ImageFileCollection, reprojection:combine.Reprojection=None, scale:float=2.0, pixfrac:float=0.8,
+                   out_path:Path=None, tile_size:int=1024, workers:int=None, match_backgrounds:bool=True, weights:dict=None,
+                   max_error:float=0.01) -> CCDData:
+    '''
+    Drizzle solved images onto a common output frame, one output tile at a time.
+
+    Parameters
+    ----------
+    images : ImageFileCollection
+        Solved images to combine.
+
+    reprojection : combine.Reprojection
+        Output frame. If None, a frame scale times finer than the finest input is planned.
+
+    scale : float
+        Ratio of input to output pixel size, used when reprojection is None.
+
+    pixfrac : float
+        Linear size of the drops as a fraction of the input pixels.
+
+    out_path, tile_size, workers, match_backgrounds, weights
+        See coadd.coadd.
+
+    max_error : float
+        Maximum error in output pixels of the mapping of input pixel centres.
+
+    Returns
+    -------
+    CCDData
+        The drizzled image, backed by the coadd memmap.
+    '''
+    if reprojection is None:
+        reprojection = get_reprojection(images, scale)
+    else:
+        scale = None
+
+    logging.info(f'Drizzling with pixfrac {pixfrac} onto {reprojection.shape[1]}x{reprojection.shape[0]} px')
+
+    reproject_function = partial(drizzle, pixfrac=pixfrac, max_error=max_error)
+    ccd = coadd.coadd(images, reprojection, out_path=out_path, tile_size=tile_size, workers=workers, match_backgrounds=match_backgrounds,
+                      weights=weights, reproject_function=reproject_function)
+
+    ccd.meta['pixfrac'] = pixfrac
+    if scale is not None:
+        ccd.meta['drizscal'] = scale
+
+    return ccd
@@ -1,9 +1,12 @@
 # processes to perform on images
 
+from collections import Counter
 import logging
 from ccdproc import CCDData
 from astropy.io.fits import HDUList
 
+from abberition import parallel
+
 
 def sanitize(header):
     '''
@@ -31,81 +34,160 @@ def sanitize(header):
         filter:   Filter name
         bitpix:   Bits per pixel
         localtim: Time of observation (local)
+
+    The rules for each keyword are defined in the header schema below. Returns a SanitizeSummary
+    of the defaults applied and casts performed, which has already been logged.
     '''
+    summary = SanitizeSummary()
+    apply_schema(header, summary)
+    summary.log()
+
+    return summary
 
-    # ensure mandatory keywords are present and valid
-    __ensure_str_field(header, 'instrume')
-    __ensure_int_field(header, 'xbinning')
-    __ensure_int_field(header, 'ybinning')
-    __ensure_int_field(header, 'naxis')
-    __ensure_int_field(header, 'naxis1')
-    __ensure_int_field(header, 'naxis2')
-    __ensure_float_field(header, 'xpixsz')
-    __ensure_float_field(header, 'ypixsz')
-    __ensure_str_field(header, 'bunit', 'adu')
-
-    # ensure optional keywords are present and valid
-    __validate_imagetyp(header)
-    __validate_quality(header)
-    __validate_gain(header)
-    __ensure_float_field(header, 'gainadu', 0.0)
-    __ensure_float_field(header, 'speed', 0.0)
-    __ensure_float_field(header, 'ccd-temp', 100.0)
-    __ensure_float_field(header, 'exptime', 0.0)
-    __ensure_str_field(header, 'filter', 'none')
-    __ensure_int_field(header, 'bitpix', 0)
-    __ensure_str_field(header, 'localtim', '')
-
-
-def __ensure_str_field(header, key:str, default:str=None):
+
+def sanitize_headers(headers, workers:int=1, summary=None, raise_errors:bool=True):
     '''
-    Ensure the specified key is a string.
+    Sanitize a collection of headers in one call, optionally across a pool of worker processes.
+
+    Headers are updated in place. Instead of logging each missing or cast keyword of each frame, a single
+    summary of the defaults applied and casts performed per keyword is logged and returned.
+
+    Parameters
+    ----------
+    headers : iterable of Header
+        Headers to sanitize.
+
+    workers : int
+        Number of worker processes, 1 to sanitize in the current process, None for all cores.
+
+    summary : SanitizeSummary
+        Summary to add results to, a new one is created if None.
+
+    raise_errors : bool
+        Raise a ValueError after all headers are processed if any header was missing a mandatory
+        keyword or had an invalid value.
+
+    Returns
+    -------
+    SanitizeSummary
     '''
-    if key not in header:
-        if default is not None:
-            logging.warning(f'Keyword \'{key}\' not found in header. Using default value of \'{default}\'.')
-            header[key] = default
-        else:
-            logging.error(f'Mandatory keyword \'{key}\' not found in header.')
-            raise ValueError(f'Mandatory keyword \'{key}\' not found in header.')
-    
-    if not isinstance(header[key], str):
-        logging.warning(f'Mandatory keyword \'{key}\' expected a string, found {header[key]}:{type(header[key])}. Casting to string.')
-        header[key] = str(header[key])
+    headers = list(headers)
+
+    if summary is None:
+        summary = SanitizeSummary()
+
+    if workers == 1 or len(headers) < 2:
+        for header in headers:
+            apply_schema(header, summary, raise_errors=False)
+    else:
+        chunk_count = parallel.get_worker_count(workers) * 4
+        chunk_size = -(-len(headers) // chunk_count)
+        chunks = [headers[i:i + chunk_size] for i in range(0, len(headers), chunk_size)]
+
+        i = 0
+        for sanitized, chunk_summary in parallel.map_ordered(_sanitize_chunk, chunks, workers):
+            # copy results back so headers are updated in place as in the serial case, keeping the
+            # structural cards (BITPIX, NAXIS...) which extend strips by default
+            for h in sanitized:
+                headers[i].clear()
+                headers[i].extend(h, strip=False)
+                i += 1
+
+            summary.merge(chunk_summary)
 
+    summary.log()
 
-def __ensure_int_field(header, key:str, default:int=None):
+    if raise_errors and summary.errors:
+        raise ValueError(f'Invalid headers: {summary.describe_errors()}')
+
+    return summary
+
+
+def _sanitize_chunk(headers):
+    summary = SanitizeSummary()
+
+    for header in headers:
+        apply_schema(header, summary, raise_errors=False)
+
+    return headers, summary
+
+
+class SanitizeSummary:
     '''
-    Ensure the specified key is an integer.
+    Per keyword counts of the changes made while sanitizing a set of headers.
+
+    frames: number of headers sanitized
+    defaults: keyword -> number of headers the default value was applied to
+    default_values: keyword -> default value applied
+    casts: keyword -> number of headers the value was cast or mapped to the standard form
+    errors: keyword -> [number of headers with the error, first error message]
     '''
-    if key not in header:
-        if default is not None:
-            logging.warning(f'Keyword \'{key}\' is not found. Using default value of {default}.')
-            header[key] = default
+
+    def __init__(self):
+        self.frames = 0
+        self.defaults = Counter()
+        self.default_values = {}
+        self.casts = Counter()
+        self.errors = {}
+
+    def add_default(self, key:str, value):
+        self.defaults[key] += 1
+        self.default_values[key] = value
+
+    def add_error(self, key:str, message:str):
+        if key in self.errors:
+            self.errors[key][0] += 1
         else:
-            logging.error(f'Mandatory keyword \'{key}\' not found in header.')
-            raise ValueError(f'Mandatory keyword \'{key}\' not found in header.')
-    
-    if not isinstance(header[key], int):
-        logging.error(f'Mandatory keyword \'{key}\' expected an integer, found {header[key]}.')
-        raise ValueError(f'Mandatory keyword \'{key}\' expected an integer, found {header[key]}')
-    
+            self.errors[key] = [1, message]
+
+    def merge(self, other):
+        self.frames += other.frames
+        self.defaults.update(other.defaults)
+        self.default_values.update(other.default_values)
+        self.casts.update(other.casts)
+
+        for key, (count, message) in other.errors.items():
+            if key in self.errors:
+                self.errors[key][0] += count
+            else:
+                self.errors[key] = [count, message]
+
+    def describe_errors(self):
+        return '; '.join(f'{message} ({count} of {self.frames} headers)' for key, (count, message) in self.errors.items())
+
+    def log(self):
+        for key, count in self.defaults.items():
+            logging.warning(f'Keyword \'{key}\' not found in {count} of {self.frames} headers. Using default value of {self.default_values[key]!r}.')
 
-def __ensure_float_field(header, key:str, default:float=None):
+        for key, count in self.casts.items():
+            logging.info(f'Keyword \'{key}\' cast to standard value in {count} of {self.frames} headers.')
+
+        for key, (count, message) in self.errors.items():
+            logging.error(f'{message} ({count} of {self.frames} headers)')
+
+    def __str__(self):
+        lines = [f'Sanitized {self.frames} headers']
+        for key in sorted(set(self.defaults) | set(self.casts) | set(self.errors)):
+            lines.append(f'  {key}: defaults={self.defaults[key]} casts={self.casts[key]} errors={self.errors.get(key, [0])[0]}')
+
+        return '\n'.join(lines)
+
+
+def apply_schema(header, summary, raise_errors:bool=True):
     '''
-    Ensure the specified key is a float.
+    Apply the compiled header schema to a single header, recording changes in summary.
     '''
-    if key not in header:
-        if default is not None:
-            logging.warning(f'Keyword \'{key}\' is not found. Using default value of {default}.')
-            header[key] = default
-        else:
-            logging.warning(f'Mandatory keyword \'{key}\' not found in header.')
-            raise ValueError(f'Mandatory keyword \'{key}\' not found in header.')
-    
-    if not isinstance(header[key], float):
-        logging.error(f'Mandatory keyword \'{key}\' expected a float, found {header[key]}.')
-        raise ValueError(f'Mandatory keyword \'{key}\' expected a float, found {header[key]}')
+    summary.frames += 1
+
+    for key, rule in __compiled_schema:
+        try:
+            rule(header, summary)
+        except ValueError as e:
+            if raise_errors:
+                logging.error(str(e))
+                raise
+            summary.add_error(key, str(e))
+            return
 
 __imagetyp_key = 'imagetyp'
 __imagetyp_default = 'unknown'
@@ -129,20 +211,6 @@ __imagetyp_valid = {
     'light': 'Light frame',
 }
 
-def __validate_imagetyp(header):
-    imagetyp = __imagetyp_default
-
-    if __imagetyp_key in header:
-        imagetyp = header[__imagetyp_key]
-
-    if imagetyp in __imagetyp_lookup.keys():
-        imagetyp = __imagetyp_lookup[imagetyp]
-    else:
-        imagetyp = __imagetyp_default
-
-    header[__imagetyp_key] = imagetyp
-
-
 __adc_quality_key = 'quality'
 __adc_quality_default = 'st'
 __adc_quality_lookup = {
@@ -160,40 +228,99 @@ __adc_quality_valid = {
     'em': 'Electron multiplied',
 }
 
-def __validate_quality(header):
-    quality = __adc_quality_default
-    
-    if __adc_quality_key in header:
-        quality = header[__adc_quality_key]
 
-    if quality in __adc_quality_lookup.keys():
-        quality = __adc_quality_lookup[quality]
-    else:
-        quality = __adc_quality_default
+def __gain_to_int(value):
+    if isinstance(value, str):
+        if value.lower() == 'high':
+            return 2
+        elif value.lower() == 'low':
+            return 0
+
+    return value
 
-    header[__adc_quality_key] = quality
 
-def __validate_gain(header):
+# Header schema. Each rule ensures a keyword is present and of the expected type:
+#   key:     keyword
+#   type:    str, int or float. str values are cast, other types must already match
+#   default: value used if the keyword is missing, None for mandatory keywords
+#   lookup:  map of accepted values to standard values, others are replaced with the default
+#   convert: function applied to the value before the type is checked
+__header_schema = [
+    # mandatory keywords
+    {'key': 'instrume', 'type': str},
+    {'key': 'xbinning', 'type': int},
+    {'key': 'ybinning', 'type': int},
+    {'key': 'naxis', 'type': int},
+    {'key': 'naxis1', 'type': int},
+    {'key': 'naxis2', 'type': int},
+    {'key': 'xpixsz', 'type': float},
+    {'key': 'ypixsz', 'type': float},
+    {'key': 'bunit', 'type': str, 'default': 'adu'},
+
+    # optional keywords
+    {'key': __imagetyp_key, 'lookup': __imagetyp_lookup, 'default': __imagetyp_default},
+    {'key': __adc_quality_key, 'lookup': __adc_quality_lookup, 'default': __adc_quality_default},
+    {'key': 'gain', 'type': int, 'default': -1, 'convert': __gain_to_int},
+    {'key': 'gainadu', 'type': float, 'default': 0.0},
+    {'key': 'speed', 'type': float, 'default': 0.0},
+    {'key': 'ccd-temp', 'type': float, 'default': 100.0},
+    {'key': 'exptime', 'type': float, 'default': 0.0},
+    {'key': 'filter', 'type': str, 'default': 'none'},
+    {'key': 'bitpix', 'type': int, 'default': 0},
+    {'key': 'localtim', 'type': str, 'default': ''},
+]
+
+
+def compile_schema(schema:list) -> list:
     '''
-    Ensure the specified key is an integer.
+    Compile a header schema into a list of (key, rule) pairs, where each rule is a function
+    taking (header, summary) that applies the keyword's rule to the header.
     '''
-    key = 'gain'
-
-    if key not in header:
-        default = -1
-        logging.warning(f'Keyword \'{key}\' is not found. Using default value of {default}.')
-        header[key] = default
-
-    val = header[key]
-
-    if isinstance(val, str):
-        if val.lower() == 'high':
-            header[key] = 2
-        elif val.lower() == 'low':
-            header[key] = 0
-
-    if not isinstance(header[key], int):
-        logging.error(f'Mandatory keyword \'{key}\' expected an integer, found {header[key]}.')
-        raise ValueError(f'Mandatory keyword \'{key}\' expected an integer, found {header[key]}')
- 
- 
\ No newline at end of file
+    return [(rule['key'], __compile_rule(**rule)) for rule in schema]
+
+
+def __compile_rule(key:str, type=None, default=None, lookup:dict=None, convert=None):
+    type_names = {str: 'a string', int: 'an integer', float: 'a float'}
+
+    if lookup is not None:
+        def apply_lookup(header, summary):
+            if key not in header:
+                summary.add_default(key, default)
+                header[key] = default
+                return
+
+            value = header[key]
+            standard = lookup.get(value, default) if isinstance(value, str) else default
+
+            if standard != value:
+                summary.casts[key] += 1
+                header[key] = standard
+
+        return apply_lookup
+
+    def apply_type(header, summary):
+        if key not in header:
+            if default is None:
+                raise ValueError(f'Mandatory keyword \'{key}\' not found in header.')
+
+            summary.add_default(key, default)
+            header[key] = default
+
+        value = header[key]
+
+        if convert is not None:
+            converted = convert(value)
+            if converted is not value:
+                summary.casts[key] += 1
+                header[key] = value = converted
+
+        if not isinstance(value, type):
+            if type is str:
+                summary.casts[key] += 1
+                header[key] = str(value)
+            else:
+                raise ValueError(f'Keyword \'{key}\' expected {type_names[type]}, found {value}.')
+
+    return apply_type
+
+__compiled_schema = compile_schema(__header_schema)
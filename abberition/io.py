@@ -9,12 +9,9 @@ from pathlib import Path
 import tempfile
 from ccdproc import CCDData, ImageFileCollection
 
-from astropy.visualization import make_lupton_rgb, ImageNormalize
-from astropy.visualization.stretch import HistEqStretch
 import numpy as np
-from skimage.io import imread, imsave
 
-from abberition import calibration, image, visualize
+from abberition import calibration, image
 
 
 def get_first_available_dirname(path,  pad_length: int=3, always_number: bool=True):
@@ -257,6 +254,7 @@ def save_mono_png(image:CCDData, path, overwrite:bool=True, bits=16, image_scale
         data = np.clip(image.data, 0, max_val)
 
     elif image_scale == ImageScale.HistEq:
+        from abberition import visualize
         data = visualize.hist_eq(image.data, max_val)
 
     # convert to proper data type if not already
@@ -267,6 +265,7 @@ def save_mono_png(image:CCDData, path, overwrite:bool=True, bits=16, image_scale
         path.unlink()
 
     # save image
+    from skimage.io import imsave
     imsave(path, data)
 
 
@@ -302,6 +301,7 @@ def save_rgb_jpg(r:CCDData, g:CCDData, b:CCDData, path:Path, overwrite:bool=True
     if (not overwrite) and (path.exists()):
         path = get_first_available_filename(path, 3, True)
 
+    from astropy.visualization import make_lupton_rgb
     rgb = make_lupton_rgb(r, g, b, minimum=minimum, Q=softening_param, stretch = stretch, filename=path)
 
     return path
@@ -380,19 +380,24 @@ def get_images(path:Path|str, target_dir:Path|str=None, filters:dict=None, sanit
     if filters is not None:
         ifc = ifc.filter(**filters)
 
+    # warnings are aggregated per keyword over the whole collection rather than logged per frame
+    summary = image.SanitizeSummary()
+
     if target_dir is not None:
         logging.debug(f'Copying images to target sanitization ({target_dir})')
         for h in ifc.headers(save_location=target_dir):
             if sanitize_headers:
-                logging.debug('sanitizing...')        
-                image.sanitize(h)
+                image.apply_schema(h, summary)
     else:
         logging.debug('Sanitizing images in-place')
         for h in ifc.headers(overwrite=overwrite):
             if sanitize_headers:
                 if not overwrite:
                     raise ValueError('Can\'t sanitize images in place if not overwritable')
-                image.sanitize(h)
+                image.apply_schema(h, summary)
+
+    if sanitize_headers:
+        summary.log()
 
     logging.debug('Creating ImageFileCollection from temp dir')
     ifc = ImageFileCollection(target_dir, keywords='*')
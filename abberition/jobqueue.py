@@ -0,0 +1,548 @@
+'''
+Queue of processing jobs shared by workers on several machines.
+
+Frames (or tiles) are put in a queue as jobs, and workers on any machine claim them, run the task and
+write the result. A claimed job is leased to its worker for a time, renewed while the task runs, and
+put back in the queue if the lease expires, so jobs of a worker that died are run by another.
+
+Two backends share the same interface:
+
+- DirectoryQueue keeps each job in a file, in a directory for each state. Jobs are claimed by renaming
+  their file, which is atomic on a shared file system, so only one worker gets each job.
+- SQLiteQueue keeps the jobs in an SQLite database, for workers on one machine (SQLite locking isn't
+  reliable over network file systems).
+
+Tasks read and write files by path, so all machines must see the same paths. Start workers with
+run_worker, run_local_workers, or from a shell on each machine:
+
+    python -m abberition.jobqueue <queue path> --workers 8
+'''
+
+from contextlib import closing
+from dataclasses import dataclass, field
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+job_states = ['pending', 'leased', 'done', 'failed']
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    args: dict
+    attempts: int = 0
+    lease: str = None
+    result: dict = field(default=None)
+    error: str = None
+
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}.{os.getpid()}'
+
+
+class DirectoryQueue:
+    '''
+    Queue of jobs as json files in directory path, one subdirectory per job state.
+
+    Parameters
+    ----------
+    path : Path
+        Queue directory, created if it doesn't exist.
+
+    lease_seconds : float
+        Time a worker has to finish or renew a job before it is put back in the queue.
+
+    max_attempts : int
+        Number of times a job is run before it is failed.
+    '''
+
+    def __init__(self, path:Path, lease_seconds:float=300.0, max_attempts:int=3):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        for state in job_states + ['tmp']:
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+
+    def put(self, kind:str, args:dict) -> str:
+        # ids sort in submission order
+        job = Job(f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}', kind, args)
+        self.__write('pending', f'{job.id}.json', job)
+
+        return job.id
+
+    def claim(self, worker:str=None) -> Job:
+        '''
+        Claim the oldest pending job for worker, or None if there are none.
+        '''
+        worker = worker if worker is not None else get_worker_id()
+
+        for name in sorted(os.listdir(self.path / 'pending')):
+            job_id = name[:-len('.json')]
+            lease = f'{job_id}~{worker}~{time.time() + self.lease_seconds:.3f}.json'
+
+            try:
+                os.rename(self.path / 'pending' / name, self.path / 'leased' / lease)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+
+            job = self.__read('leased', lease)
+            job.lease = lease
+
+            return job
+
+        return None
+
+    def renew(self, job:Job) -> bool:
+        '''
+        Extend the lease of a claimed job. Returns False if the lease was lost.
+        '''
+        job_id, worker, _ = job.lease[:-len('.json')].split('~')
+        lease = f'{job_id}~{worker}~{time.time() + self.lease_seconds:.3f}.json'
+
+        try:
+            os.rename(self.path / 'leased' / job.lease, self.path / 'leased' / lease)
+        except FileNotFoundError:
+            return False
+
+        job.lease = lease
+        return True
+
+    def complete(self, job:Job, result:dict=None) -> bool:
+        '''
+        Record the result of a job. Returns False, dropping the result, if the worker lost the lease of
+        the job, as it was put back in the queue and another worker may have run it since.
+        '''
+        taken = self.__take_lease(job)
+        if taken is None:
+            return False
+
+        job.result = result
+        job.error = None
+        self.__write('done', f'{job.id}.json', job)
+        taken.unlink()
+
+        return True
+
+    def fail(self, job:Job, error:str) -> bool:
+        '''
+        Record a failed attempt at a job. It is put back in the queue until it has failed max_attempts times.
+        Returns False, dropping the failure, if the worker lost the lease of the job.
+        '''
+        taken = self.__take_lease(job)
+        if taken is None:
+            return False
+
+        job.attempts += 1
+        job.error = error
+
+        state = 'pending' if job.attempts < self.max_attempts else 'failed'
+        self.__write(state, f'{job.id}.json', job)
+        taken.unlink()
+
+        return True
+
+    def requeue_expired(self) -> int:
+        '''
+        Put the jobs whose lease expired back in the queue. Returns the number of jobs requeued.
+        '''
+        requeued = 0
+        now = time.time()
+
+        for lease in os.listdir(self.path / 'leased'):
+            job_id, worker, expiry = lease[:-len('.json')].split('~')
+
+            if float(expiry) < now:
+                try:
+                    os.rename(self.path / 'leased' / lease, self.path / 'pending' / f'{job_id}.json')
+                    logging.warning(f'Requeued job {job_id}, the lease of {worker} expired')
+                    requeued += 1
+                except FileNotFoundError:
+                    pass
+
+        # leases taken to record a result by workers that stopped before writing it
+        for taken in os.listdir(self.path / 'tmp'):
+            if not taken.endswith('.taken'):
+                continue
+
+            job_id, worker, expiry = taken[:-len('.json.taken')].split('~')
+
+            if float(expiry) + self.lease_seconds < now:
+                try:
+                    os.rename(self.path / 'tmp' / taken, self.path / 'pending' / f'{job_id}.json')
+                    logging.warning(f'Requeued job {job_id}, {worker} stopped while recording its result')
+                    requeued += 1
+                except FileNotFoundError:
+                    pass
+
+        return requeued
+
+    def get(self, job_id:str) -> Job:
+        '''
+        Get a finished job, None if it isn't done or failed.
+        '''
+        for state in ['done', 'failed']:
+            if (self.path / state / f'{job_id}.json').exists():
+                return self.__read(state, f'{job_id}.json')
+
+        return None
+
+    def counts(self) -> dict:
+        return {state: len(os.listdir(self.path / state)) for state in job_states}
+
+    def __take_lease(self, job:Job) -> Path:
+        '''
+        Move the lease of a job out of leased, so it can't be requeued while the job's result is written.
+        Returns the taken lease, to be removed once the result is written, or None if the lease was lost.
+        '''
+        taken = self.path / 'tmp' / f'{job.lease}.taken'
+
+        try:
+            os.rename(self.path / 'leased' / job.lease, taken)
+        except FileNotFoundError:
+            logging.warning(f'Dropped the result of job {job.id}, its lease expired and it was put back in the queue')
+            return None
+        finally:
+            job.lease = None
+
+        return taken
+
+    def __read(self, state:str, name:str) -> Job:
+        with open(self.path / state / name, 'r') as f:
+            return Job(**json.load(f))
+
+    def __write(self, state:str, name:str, job:Job):
+        tmp_path = self.path / 'tmp' / f'{uuid.uuid4().hex}.json'
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'id': job.id, 'kind': job.kind, 'args': job.args, 'attempts': job.attempts, 'result': job.result, 'error': job.error}, f)
+
+        os.replace(tmp_path, self.path / state / name)
+
+
+class SQLiteQueue:
+    '''
+    Queue of jobs in an SQLite database at path, for workers on one machine. See DirectoryQueue for
+    the parameters.
+    '''
+
+    def __init__(self, path:Path, lease_seconds:float=300.0, max_attempts:int=3):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.__connect()) as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE, kind TEXT, args TEXT, state TEXT, attempts INTEGER,
+                              worker TEXT, expiry REAL, result TEXT, error TEXT)''')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)')
+
+    def __connect(self):
+        return sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+
+    def put(self, kind:str, args:dict) -> str:
+        job_id = uuid.uuid4().hex
+
+        with closing(self.__connect()) as db:
+            db.execute("INSERT INTO jobs (id, kind, args, state, attempts) VALUES (?, ?, ?, 'pending', 0)", (job_id, kind, json.dumps(args)))
+
+        return job_id
+
+    def claim(self, worker:str=None) -> Job:
+        worker = worker if worker is not None else get_worker_id()
+        db = self.__connect()
+
+        try:
+            # take the write lock before selecting, so no two workers select the same job
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute("SELECT id, kind, args, attempts FROM jobs WHERE state = 'pending' ORDER BY seq LIMIT 1").fetchone()
+
+            if row is not None:
+                db.execute("UPDATE jobs SET state = 'leased', worker = ?, expiry = ? WHERE id = ?", (worker, time.time() + self.lease_seconds, row[0]))
+
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+        if row is None:
+            return None
+
+        return Job(row[0], row[1], json.loads(row[2]), row[3], lease=worker)
+
+    def renew(self, job:Job) -> bool:
+        with closing(self.__connect()) as db:
+            cursor = db.execute("UPDATE jobs SET expiry = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                                (time.time() + self.lease_seconds, job.id, job.lease))
+
+        return cursor.rowcount > 0
+
+    def complete(self, job:Job, result:dict=None) -> bool:
+        job.result = result
+        job.error = None
+
+        # only while the worker holds the lease, as DirectoryQueue.complete
+        with closing(self.__connect()) as db:
+            cursor = db.execute("UPDATE jobs SET state = 'done', result = ?, error = NULL, worker = NULL, expiry = NULL "
+                                "WHERE id = ? AND state = 'leased' AND worker = ?", (json.dumps(result), job.id, job.lease))
+
+        return self.__recorded(job, cursor)
+
+    def fail(self, job:Job, error:str) -> bool:
+        job.attempts += 1
+        job.error = error
+        state = 'pending' if job.attempts < self.max_attempts else 'failed'
+
+        with closing(self.__connect()) as db:
+            cursor = db.execute("UPDATE jobs SET state = ?, attempts = ?, error = ?, worker = NULL, expiry = NULL "
+                                "WHERE id = ? AND state = 'leased' AND worker = ?", (state, job.attempts, error, job.id, job.lease))
+
+        return self.__recorded(job, cursor)
+
+    def __recorded(self, job:Job, cursor) -> bool:
+        if cursor.rowcount == 0:
+            logging.warning(f'Dropped the result of job {job.id}, its lease expired and it was put back in the queue')
+
+        job.lease = None
+        return cursor.rowcount > 0
+
+    def requeue_expired(self) -> int:
+        with closing(self.__connect()) as db:
+            cursor = db.execute("UPDATE jobs SET state = 'pending', worker = NULL, expiry = NULL WHERE state = 'leased' AND expiry < ?",
+                                (time.time(),))
+
+        if cursor.rowcount > 0:
+            logging.warning(f'Requeued {cursor.rowcount} jobs with expired leases')
+
+        return cursor.rowcount
+
+    def get(self, job_id:str) -> Job:
+        with closing(self.__connect()) as db:
+            row = db.execute("SELECT id, kind, args, attempts, result, error FROM jobs WHERE id = ? AND state IN ('done', 'failed')",
+                             (job_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        return Job(row[0], row[1], json.loads(row[2]), row[3], result=json.loads(row[4]) if row[4] is not None else None, error=row[5])
+
+    def counts(self) -> dict:
+        with closing(self.__connect()) as db:
+            rows = dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+        return {state: rows.get(state, 0) for state in job_states}
+
+
+def open_queue(path:Path, **kwargs):
+    '''
+    Open the queue at path: an SQLiteQueue if path ends in .sqlite or .db, otherwise a DirectoryQueue.
+    Other arguments are passed to the queue.
+    '''
+    if Path(path).suffix in ['.sqlite', '.db']:
+        return SQLiteQueue(path, **kwargs)
+
+    return DirectoryQueue(path, **kwargs)
+
+
+def _calibrate_task(args:dict) -> dict:
+    from ccdproc import CCDData, ImageFileCollection
+    from abberition import calibration, conversion
+
+    flats = ImageFileCollection(args['flats'], filenames=args['flat_files']) if args.get('flats') is not None else None
+
+    light = CCDData.read(args['src'], unit='adu')
+    calibrated = calibration.calibrate_light(light, flats, remove_cosmics=args.get('remove_cosmics', False), workers=1)
+    conversion.to_float32(calibrated).write(args['dest'], overwrite=True)
+
+    return {'dest': args['dest']}
+
+
+def _solve_task(args:dict) -> dict:
+    from ccdproc import CCDData
+    from abberition import astrometry
+
+    astrometry.solve_wcs(CCDData.read(args['src'], unit='adu'), Path(args['dest']))
+
+    return {'dest': args['dest']}
+
+
+def _reproject_task(args:dict) -> dict:
+    '''
+    Reproject an image onto an output frame, writing the data and footprint as a 2 HDU FITS file.
+    '''
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from ccdproc import CCDData
+    import numpy as np
+    from reproject import reproject_interp
+
+    ccd = CCDData.read(args['src'], unit='adu')
+    header = fits.Header.fromstring(args['header'])
+
+    array, footprint = reproject_interp((ccd.data, ccd.wcs), WCS(header), shape_out=tuple(args['shape']))
+
+    hdus = fits.HDUList([fits.PrimaryHDU(array.astype(np.float32), header), fits.ImageHDU(footprint.astype(np.float32), name='footprint')])
+    hdus.writeto(args['dest'], overwrite=True)
+
+    return {'dest': args['dest']}
+
+
+# tasks that can be queued, by job kind
+tasks = {
+    'calibrate': _calibrate_task,
+    'solve': _solve_task,
+    'reproject': _reproject_task,
+}
+
+
+def run_job(queue, job:Job):
+    '''
+    Run a claimed job, renewing its lease while the task runs, and record its result or failure.
+    '''
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(queue.lease_seconds / 3):
+            if not queue.renew(job):
+                logging.warning(f'Lost the lease of job {job.id}')
+                return
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+
+    try:
+        result = tasks[job.kind](job.args)
+    except Exception as e:
+        logging.warning(f'Job {job.id} ({job.kind}) failed: {e}')
+        stop.set()
+        renewer.join()
+        queue.fail(job, str(e))
+        return
+
+    stop.set()
+    renewer.join()
+    queue.complete(job, result)
+
+
+def run_worker(path:Path, worker:str=None, poll_interval:float=1.0, idle_timeout:float=None, stop=None, **kwargs) -> int:
+    '''
+    Claim and run jobs from the queue at path until none have been pending for idle_timeout seconds,
+    or forever if None, or until the stop event is set. A job already claimed is finished first. Other
+    arguments are passed to open_queue. Returns the number of jobs run.
+    '''
+    queue = open_queue(path, **kwargs)
+    worker = worker if worker is not None else get_worker_id()
+
+    done = 0
+    idle_since = time.monotonic()
+
+    while idle_timeout is None or time.monotonic() - idle_since < idle_timeout:
+        if stop is not None and stop.is_set():
+            break
+
+        queue.requeue_expired()
+        job = queue.claim(worker)
+
+        if job is None:
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+
+        logging.debug(f'{worker} running job {job.id} ({job.kind})')
+        run_job(queue, job)
+
+        done += 1
+        idle_since = time.monotonic()
+
+    return done
+
+
+def run_local_workers(path:Path, workers:int=None, idle_timeout:float=5.0, **kwargs) -> list:
+    '''
+    Start workers processes on this machine running run_worker on the queue at path, None for all cores.
+    They stop once the queue has been idle for idle_timeout seconds, or when the stop event (a
+    multiprocessing.Event) is set, or run until terminated if neither. Returns the processes.
+    '''
+    from abberition import parallel
+
+    processes = []
+    for i in range(parallel.get_worker_count(workers)):
+        process = multiprocessing.Process(target=run_worker, args=(str(path),), kwargs=dict(idle_timeout=idle_timeout, **kwargs), daemon=True)
+        process.start()
+        processes.append(process)
+
+    return processes
+
+
+def map_jobs(path:Path, kind:str, args:list, local_workers:int=0, poll_interval:float=1.0, timeout:float=None, **kwargs) -> list:
+    '''
+    Queue a job of kind for each of args and wait for them all to finish, with local_workers workers
+    on this machine (None for all cores) as well as any others on the queue. Once the jobs are finished
+    the local workers are asked to stop and finish the job they are running, which may be one put by
+    another process on a shared queue.
+
+    Returns
+    -------
+    list
+        The finished Job of each of args, in the same order. Failed jobs have their error set.
+    '''
+    if len(args) == 0:
+        return []
+
+    queue = open_queue(path, **kwargs)
+    ids = [queue.put(kind, a) for a in args]
+
+    stop = multiprocessing.Event()
+    processes = run_local_workers(path, local_workers, idle_timeout=None, poll_interval=poll_interval, stop=stop, **kwargs) if local_workers != 0 else []
+    start = time.monotonic()
+
+    try:
+        jobs = {}
+        while len(jobs) < len(ids):
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'{len(ids) - len(jobs)} of {len(ids)} jobs not finished after {timeout} s')
+
+            queue.requeue_expired()
+            for job_id in ids:
+                if job_id not in jobs:
+                    job = queue.get(job_id)
+                    if job is not None:
+                        jobs[job_id] = job
+
+            if len(jobs) < len(ids):
+                time.sleep(poll_interval)
+    finally:
+        stop.set()
+        for process in processes:
+            process.join()
+
+    return [jobs[job_id] for job_id in ids]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run job queue workers on this machine')
+    parser.add_argument('queue', help='queue directory, or SQLite database ending in .sqlite or .db')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, all cores if not set')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='stop after this many seconds without jobs')
+    parser.add_argument('--lease', type=float, default=300.0, help='job lease in seconds')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for process in run_local_workers(options.queue, options.workers, idle_timeout=options.idle_timeout, lease_seconds=options.lease):
+        process.join()
@@ -1,5 +1,7 @@
 '''
 Create a library of reference frames (bias, dark, flat), that can be requested based on the properties of an image.
+The library also keeps the distortion model of each optical setup (see distortion.py), in its distortion
+subdirectory so models don't change the library key the calibrated flats depend on.
 
 Images are selected through filters, so filenames are 
 '''
@@ -9,14 +11,47 @@ from ccdproc import CCDData, ImageFileCollection
 from pathlib import Path
 from os.path import exists
 
-from abberition import io
+from abberition import cache, io, metrics
 
 __library_path = Path(__file__).parent / 'library/'
-__library_ifc = ImageFileCollection(__library_path)
+__library_ifcs = {}
+
+# header keywords of the setup of a distortion model, the rotator angle is optional
+distortion_setup_keys = ['instrume', 'xbinning', 'ybinning', 'imagew', 'imageh', 'rotatang']
 
 def get_library_path():
     return __library_path
 
+def get_distortion_path():
+    return __library_path / 'distortion'
+
+def get_library_key():
+    '''
+    Key of the library contents, from the name, size and modification time of its files. Changes
+    whenever a frame is added to, removed from or rewritten in the library. Distortion models are
+    in a subdirectory and don't change the key.
+    '''
+    return __get_files_key(__library_path)
+
+def __get_files_key(path:Path):
+    files = sorted(p for p in path.glob('*') if p.is_file())
+    return cache.hash_params([(p.name, p.stat().st_size, p.stat().st_mtime_ns) for p in files])
+
+def __get_ifc(path:Path) -> ImageFileCollection:
+    # collection of the frames in path, read on first use rather than on import and again whenever
+    # the files change
+    key = __get_files_key(path)
+    cached = __library_ifcs.get(path)
+
+    if cached is None or cached[0] != key:
+        cached = (key, ImageFileCollection(path))
+        __library_ifcs[path] = cached
+
+    return cached[1]
+
+def __get_library_ifc() -> ImageFileCollection:
+    return __get_ifc(__library_path)
+
 def save_image(image: CCDData):
     filename = io.generate_filename(image)
     filepath = __library_path / filename
@@ -68,7 +103,7 @@ def save_flat(image:CCDData):
     raise NotImplementedError
 
 
-def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
+def select_bias(image, ignore_temp=True, temp_threshold = 0.25, load:bool=True):
     """
     Select a bias frame from the library that matches the parameters of the input ref image. 
     TODO: enable cropped images by splitting out the naxis1, naxis2 and adding xorgsubf and yorgsubf.
@@ -95,6 +130,8 @@ def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
     light_filename : str
         The filename of the light for logging purposes
         TODO: remove once replaced with exceptions on failure
+    load : bool
+        Load the bias, otherwise only its header is read and returned.
 
     Returns
     -------
@@ -105,6 +142,8 @@ def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
 
     """        
 
+    metrics.count('library_lookups')
+
     filters = {}
     filters['imagetyp'] = 'bias|bias frame'
     filters['instrume'] = image.header['instrume']
@@ -131,7 +170,7 @@ def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
 
     print('filters: ' + str(filters))
 
-    ifc_biases = __library_ifc.filter(regex_match=True, **filters)
+    ifc_biases = __get_library_ifc().filter(regex_match=True, **filters)
 
     num_biases = 0
     if ifc_biases.summary:
@@ -143,12 +182,12 @@ def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
         if not ignore_temp:
             ref_temp = float(image.header['ccd-temp'])
     
-        for bias, bias_filename in ifc_biases.ccds(return_fname=True):
+        for bias, bias_filename in __frames(ifc_biases, load):
 
             if ignore_temp:
                 return bias, bias_filename
     
-            bias_temp = float(bias.header['ccd-temp'])
+            bias_temp = float(__header(bias)['ccd-temp'])
             
             if bias_temp > ref_temp - temp_threshold and bias_temp < ref_temp + temp_threshold:
                 return bias, bias_filename
@@ -161,7 +200,7 @@ def select_bias(image, ignore_temp=True, temp_threshold = 0.25):
 
 
 
-def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
+def select_dark(image, ignore_temp=False, temp_threshold = 0.25, load:bool=True):
     """
     Select a dark frame from the library that matches the parameters of the input reference image. 
     
@@ -185,6 +224,8 @@ def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
     light_filename : str
         The filename of the light for logging purposes
         TODO: remove once replaced with exceptions on failure
+    load : bool
+        Load the dark, otherwise only its header is read and returned.
 
     Returns
     -------
@@ -194,6 +235,8 @@ def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
         Filename of the returned dark CCDData.
 
     """        
+
+    metrics.count('library_lookups')
     
     filters = {}
     filters['imagetyp'] = 'dark|dark frame'
@@ -219,7 +262,7 @@ def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
         filters['gain'] = gain
 
     
-    ifc_darks = __library_ifc.filter(regex_match=True, **filters)
+    ifc_darks = __get_library_ifc().filter(regex_match=True, **filters)
 
     num_darks = 0
     if ifc_darks.summary:
@@ -230,11 +273,11 @@ def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
         if not ignore_temp:
             ref_temp = float(image.header['ccd-temp'])
         
-        for dark, dark_filename in ifc_darks.ccds(return_fname=True):
+        for dark, dark_filename in __frames(ifc_darks, load):
             if ignore_temp:
                 return dark, dark_filename
             
-            dark_temp = float(dark.header['ccd-temp'])
+            dark_temp = float(__header(dark)['ccd-temp'])
             
             if dark_temp > ref_temp - temp_threshold and dark_temp < ref_temp + temp_threshold:
                 return dark, dark_filename
@@ -246,7 +289,7 @@ def select_dark(image, ignore_temp=False, temp_threshold = 0.25):
     raise Exception('No darks found matching light')
 
 
-def select_flat(image, flats:ImageFileCollection=None):
+def select_flat(image, flats:ImageFileCollection=None, load:bool=True):
     """
     Select a flat frame from the ifc that matches the parameters of the input light frame. 
     
@@ -270,6 +313,8 @@ def select_flat(image, flats:ImageFileCollection=None):
     light_filename : str
         The filename of the light for logging purposes
         TODO: remove once replaced with exceptions on failure
+    load : bool
+        Load the flat, otherwise only its header is read and returned.
 
     Returns
     -------
@@ -280,8 +325,10 @@ def select_flat(image, flats:ImageFileCollection=None):
 
     """
 
+    metrics.count('library_lookups')
+
     if flats == None:
-        flats = __library_ifc
+        flats = __get_library_ifc()
 
     filters = {}
     filters['imagetyp'] = 'flat'
@@ -303,7 +350,84 @@ def select_flat(image, flats:ImageFileCollection=None):
     if num_flats > 0:
         # choose the first image that satisfies requirements
         # TODO: choose the best one (closest date? etc...)
-        flat, flat_filename = next(filt_flats.ccds(return_fname=True, ccd_kwargs={'unit':'adu'}))
+        flat, flat_filename = next(__frames(filt_flats, load, ccd_kwargs={'unit':'adu'}))
         return flat, flat_filename
     
     return None, None
+
+
+def save_distortion(header) -> Path:
+    """
+    Save a distortion model to the distortion subdirectory of the library, replacing the model of the
+    same setup.
+
+    Parameters
+    ----------
+    header : Header
+        Header of the model with imagetyp 'distortion', its setup keywords and its SIP WCS (see
+        distortion.save_model).
+
+    Returns
+    -------
+    Path
+        Path of the saved model.
+    """
+    from astropy.io import fits
+
+    instrument = str(header.get('instrume', 'unknown')).replace(' ', '_').replace(':', '').replace('/', '').replace('\'','')
+    filename = f'distortion.{instrument}.b{header["xbinning"]}x{header["ybinning"]}.{header["imagew"]}x{header["imageh"]}'
+    if 'rotatang' in header:
+        filename += f'.r{header["rotatang"]:g}'
+
+    io.mkdirs(get_distortion_path())
+    filepath = get_distortion_path() / f'{filename}.fits'
+    logging.info('Saving distortion model to library file ' + str(filepath))
+
+    fits.PrimaryHDU(header=header).writeto(filepath, overwrite=True)
+
+    return filepath
+
+def select_distortion(setup:dict):
+    """
+    Select the distortion model of an optical setup from the library. The model must have the same
+    setup keywords, so a setup without a rotator angle doesn't match the model of any angle.
+
+    Parameters
+    ----------
+    setup : dict
+        Header keywords and values of the setup, as from distortion.get_setup.
+
+    Returns
+    -------
+    header : Header
+        Header of the model, or None if the library has none for the setup.
+    filename : str
+        Filename of the model.
+    """
+
+    metrics.count('library_lookups')
+
+    if not get_distortion_path().is_dir():
+        return None, None
+
+    models = __get_ifc(get_distortion_path()).filter(imagetyp='distortion', **setup)
+    if not models.files:
+        return None, None
+
+    for header, filename in __frames(models, load=False):
+        if set(k for k in distortion_setup_keys if k in header) == set(setup):
+            return header, filename
+
+    return None, None
+
+
+def __frames(ifc:ImageFileCollection, load:bool, ccd_kwargs:dict=None):
+    # (CCDData, filename) of the frames, or (header, filename) if not loading
+    if load:
+        return ifc.ccds(return_fname=True, ccd_kwargs=ccd_kwargs)
+
+    return ifc.headers(return_fname=True)
+
+
+def __header(frame):
+    return frame.header if isinstance(frame, CCDData) else frame
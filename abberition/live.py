@@ -0,0 +1,391 @@
+'''
+Live stacking of short exposures for near real time viewing.
+
+Each frame is calibrated with masters prepared once and held in memory, registered in pixel space to
+the first frame by its star pattern (see registration.py), and added to a running accumulator on the
+first frame's pixel grid. The accumulator is a few arrays of the frame size, so memory doesn't grow
+with the number of frames:
+
+- 'mean' keeps a running mean.
+- 'kappa_sigma' keeps a running mean and variance per pixel (Welford's method), and once warmup
+  frames are in, pixels more than kappa standard deviations from the mean aren't added, which
+  rejects satellites, planes and cosmic rays.
+
+The time of each step is recorded per frame, and frames taking longer than the latency budget are
+reported.
+'''
+
+from astropy.io import fits
+from ccdproc import CCDData
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import logging
+import numpy as np
+from pathlib import Path
+import time
+
+from abberition import background, library, metrics, registration, visualize
+
+
+live_methods = ['mean', 'kappa_sigma']
+
+# header keywords that select the masters of a frame, besides ccd-temp which is checked against the
+# temperature of the selected dark
+master_keys = ['instrume', 'naxis1', 'naxis2', 'xbinning', 'ybinning', 'filter', 'gain', 'speed']
+
+
+@dataclass
+class FrameTiming:
+    name: str
+    calibrate: float = 0.0
+    register: float = 0.0
+    accumulate: float = 0.0
+    total: float = 0.0
+    stars: int = 0
+    accepted: bool = False
+
+
+class CalibrationCache:
+    '''
+    Masters selected from the library for each combination of master_keys, prepared once so frames
+    are calibrated with a few array operations: the bias, the dark current per second of exposure
+    and the reciprocal of the normalized flat.
+
+    Masters are selected again only if a frame's ccd-temp drifts out of range of the selected dark's
+    (as library.select_dark checks it), and the prepared masters are kept by their filenames, so
+    frames of drifting temperatures share them. At most max_masters sets of masters are kept, the
+    least recently used are dropped.
+
+    If prepare is False the masters are kept as read, for calibration.calibrate_light.
+    '''
+
+    def __init__(self, flats=None, max_masters:int=4, temp_threshold:float=0.25, prepare:bool=True):
+        self.flats = flats
+        self.max_masters = max_masters
+        self.temp_threshold = temp_threshold
+        self.prepare = prepare
+        self.selected = OrderedDict()
+        self.masters = OrderedDict()
+
+    def get(self, header):
+        key = tuple(header.get(k) for k in master_keys)
+        selected = self.selected.get(key)
+
+        if selected is None or not self.__in_range(selected[1], header):
+            selected = self.__select(header)
+        self.__remember(self.selected, key, selected)
+
+        filenames = selected[0]
+        if filenames not in self.masters:
+            bias, dark, flat = [CCDData.read(path, unit=unit) if path is not None else None for path, unit in selected[2]]
+            logging.info(f'Calibrating with masters {", ".join(str(fn) for fn in filenames)}')
+
+            masters = (bias, dark, flat) if not self.prepare else (
+                np.asarray(bias.data, dtype=np.float32) if bias is not None else None,
+                np.asarray(dark.data, dtype=np.float32) / float(dark.header['exptime']) if dark is not None else None,
+                self.__reciprocal_flat(flat) if flat is not None else None,
+            )
+        else:
+            masters = self.masters[filenames]
+        self.__remember(self.masters, filenames, masters)
+
+        return masters
+
+    def __select(self, header):
+        # (filenames, dark temperature, (path, unit) of each master) of the masters selected from headers only
+        light = CCDData(np.zeros((1, 1), dtype=np.float32), unit='adu', meta=header)
+        library_path = library.get_library_path()
+        flats_path = self.flats.location if self.flats is not None else library_path
+
+        selected = [(library_path, library.select_bias(light, load=False)),
+                    (library_path, library.select_dark(light, load=False, temp_threshold=self.temp_threshold)),
+                    (flats_path, library.select_flat(light, flats=self.flats, load=False))]
+
+        filenames = tuple(filename for _, (_, filename) in selected)
+        paths = tuple((Path(location) / filename, h.get('bunit', 'adu')) if h is not None else (None, None) for location, (h, filename) in selected)
+        dark = selected[1][1][0]
+
+        return filenames, float(dark['ccd-temp']) if dark is not None else None, paths
+
+    def __in_range(self, dark_temp, header) -> bool:
+        return dark_temp is None or abs(float(header['ccd-temp']) - dark_temp) < self.temp_threshold
+
+    def __remember(self, cache:OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+
+        while len(cache) > self.max_masters:
+            cache.popitem(last=False)
+
+    def calibrate(self, data:np.ndarray, header) -> np.ndarray:
+        '''
+        Calibrate frame data as calibration.calibrate_light does.
+        '''
+        bias, dark_rate, flat = self.get(header)
+        data = np.asarray(data, dtype=np.float32)
+
+        if bias is not None:
+            data = data - bias
+        if dark_rate is not None:
+            data = data - dark_rate * float(header['exptime'])
+        if flat is not None:
+            data = data * flat
+
+        return data
+
+    def __reciprocal_flat(self, flat:CCDData) -> np.ndarray:
+        data = np.asarray(flat.data, dtype=np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nanmean(data) / data
+
+
+class MeanAccumulator:
+    def __init__(self, shape):
+        self.total = np.zeros(shape, dtype=np.float32)
+        self.count = np.zeros(shape, dtype=np.float32)
+
+    def add(self, data:np.ndarray):
+        valid = np.isfinite(data)
+        self.total += np.where(valid, data, 0.0)
+        self.count += valid
+
+    def mean(self) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / self.count, np.nan)
+
+
+class KappaSigmaAccumulator:
+    '''
+    Running mean and variance per pixel, rejecting values more than kappa standard deviations from
+    the mean once a pixel has warmup values.
+    '''
+
+    def __init__(self, shape, kappa:float=3.0, warmup:int=5):
+        self.kappa = kappa
+        self.warmup = warmup
+        self.count = np.zeros(shape, dtype=np.float32)
+        self.running_mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32)
+
+    def add(self, data:np.ndarray):
+        valid = np.isfinite(data)
+        delta = np.where(valid, data - self.running_mean, 0.0)
+
+        warm = self.count >= self.warmup
+        if np.any(warm):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sigma = np.sqrt(self.m2 / (self.count - 1))
+            valid &= ~(warm & (np.abs(delta) > self.kappa * sigma))
+
+        self.count += valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = np.where(valid, delta / self.count, 0.0)
+
+        self.running_mean += step
+        self.m2 += np.where(valid, delta * (np.where(valid, data, 0.0) - self.running_mean), 0.0)
+
+    def mean(self) -> np.ndarray:
+        return np.where(self.count > 0, self.running_mean, np.nan)
+
+
+class LiveStacker:
+    '''
+    Stacks frames as they arrive onto the pixel grid of the first frame.
+
+    Parameters
+    ----------
+    method : str
+        Accumulator, one of live_methods.
+
+    kappa, warmup
+        Rejection threshold in standard deviations and the number of frames before rejecting, for
+        the 'kappa_sigma' method.
+
+    model : str
+        Registration transform model, see registration.transform_models.
+
+    n_stars : int
+        Number of the brightest stars used to register each frame.
+
+    flats : ImageFileCollection
+        Calibrated flats, the library flats are used if None.
+
+    calibrate : bool
+        Calibrate frames with the library masters, otherwise frames are stacked as they are.
+
+    latency_budget : float
+        Seconds a frame should take to add, longer frames are logged.
+
+    history : int
+        Number of recent frame timings kept.
+    '''
+
+    def __init__(self, method:str='mean', kappa:float=3.0, warmup:int=5, model:str='similarity', n_stars:int=30, flats=None,
+                 calibrate:bool=True, latency_budget:float=1.0, history:int=1000):
+        if method not in live_methods:
+            raise ValueError(f'Unknown live stacking method \'{method}\', expected one of {live_methods}')
+
+        self.method = method
+        self.kappa = kappa
+        self.warmup = warmup
+        self.model = model
+        self.n_stars = n_stars
+        self.latency_budget = latency_budget
+
+        self.masters = CalibrationCache(flats) if calibrate else None
+        self.accumulator = None
+        self.reference_stars = None
+        self.reference_level = None
+        self.header = None
+
+        self.frames = 0
+        self.rejected = 0
+        self.over_budget = 0
+        self.timings = deque(maxlen=history)
+
+    def add(self, data:np.ndarray, header=None, name:str=None) -> bool:
+        '''
+        Calibrate, register and add a frame. Returns False if the frame couldn't be registered.
+        '''
+        header = header if header is not None else fits.Header()
+        timing = FrameTiming(name if name is not None else f'frame {self.frames + self.rejected}')
+        start = time.perf_counter()
+
+        if self.masters is not None:
+            data = self.masters.calibrate(data, header)
+        else:
+            data = np.asarray(data, dtype=np.float32)
+
+        calibrated = time.perf_counter()
+        timing.calibrate = calibrated - start
+
+        bkg = background.get_background(data, use_cache=False)
+        accepted = True
+
+        if self.accumulator is None:
+            self.__start(data, header, bkg)
+        else:
+            try:
+                stars = registration.detect_stars(data, self.n_stars, bkg=bkg)
+                transform, inliers = registration.find_transform(stars, self.reference_stars, self.model)
+                data = registration.warp(data, transform, self.accumulator.count.shape)
+                timing.stars = len(inliers)
+            except ValueError as e:
+                logging.warning(f'Could not register {timing.name}: {e}')
+                accepted = False
+
+        registered = time.perf_counter()
+        timing.register = registered - calibrated
+
+        if accepted:
+            # match the background level of the first frame
+            self.accumulator.add(data - (bkg.median - self.reference_level))
+            self.frames += 1
+            metrics.count('live_frames')
+        else:
+            self.rejected += 1
+            metrics.count('live_rejected')
+
+        end = time.perf_counter()
+        timing.accumulate = end - registered
+        timing.total = end - start
+        timing.accepted = accepted
+        self.timings.append(timing)
+
+        if timing.total > self.latency_budget:
+            self.over_budget += 1
+            logging.warning(f'{timing.name} took {timing.total:.2f} s, over the {self.latency_budget:.2f} s budget '
+                            f'(calibrate {timing.calibrate:.2f} s, register {timing.register:.2f} s, accumulate {timing.accumulate:.2f} s)')
+        else:
+            logging.info(f'Live stacked {timing.name} in {timing.total:.2f} s ({self.frames} frames)')
+
+        return accepted
+
+    def add_file(self, path:Path) -> bool:
+        with fits.open(path) as hdus:
+            return self.add(hdus[0].data, hdus[0].header, Path(path).name)
+
+    def __start(self, data:np.ndarray, header, bkg:background.Background):
+        self.reference_stars = registration.detect_stars(data, self.n_stars, bkg=bkg)
+        self.reference_level = bkg.median
+        self.header = fits.Header(header)
+
+        if self.method == 'kappa_sigma':
+            self.accumulator = KappaSigmaAccumulator(data.shape, self.kappa, self.warmup)
+        else:
+            self.accumulator = MeanAccumulator(data.shape)
+
+        logging.info(f'Live stacking onto the first frame with {len(self.reference_stars)} stars')
+
+    def mean(self) -> np.ndarray:
+        if self.accumulator is None:
+            raise ValueError('No frames stacked')
+
+        return self.accumulator.mean()
+
+    def result(self) -> CCDData:
+        ccd = CCDData(self.mean().astype(np.float32), unit='adu', meta=self.header.copy())
+        ccd.meta['ncombine'] = self.frames
+
+        return ccd
+
+    def preview(self, binning:int=1) -> np.ndarray:
+        '''
+        Auto stretched 8 bit preview of the stack (see visualize.auto_stretch), binned by binning pixels.
+        '''
+        data = self.mean()
+
+        if binning > 1:
+            rows, cols = (data.shape[0] // binning) * binning, (data.shape[1] // binning) * binning
+            data = np.nanmean(data[:rows, :cols].reshape(rows // binning, binning, cols // binning, binning), axis=(1, 3))
+
+        return (visualize.auto_stretch(data) * 255.0 + 0.5).astype(np.uint8)
+
+    def save_preview(self, path:Path, binning:int=1):
+        from skimage.io import imsave
+
+        # display with the first row at the bottom, as the frames are drawn elsewhere
+        imsave(path, self.preview(binning)[::-1], check_contrast=False)
+
+    def timing_summary(self) -> dict:
+        '''
+        Median and maximum time of each step over the recent accepted frames.
+        '''
+        timings = [t for t in self.timings if t.accepted]
+        summary = {'frames': self.frames, 'rejected': self.rejected, 'over_budget': self.over_budget}
+
+        for step in ['calibrate', 'register', 'accumulate', 'total']:
+            values = [getattr(t, step) for t in timings]
+            summary[step] = {'median': float(np.median(values)) if values else 0.0, 'max': float(np.max(values)) if values else 0.0}
+
+        return summary
+
+
+def live_stack(capture_path:Path, preview_path:Path=None, interval:float=0.2, settle:float=0.5, backend:str='auto', idle_timeout:float=None,
+               binning:int=1, **kwargs) -> LiveStacker:
+    '''
+    Live stack frames as they are captured to capture_path, writing the preview to preview_path after each
+    frame, until interrupted or idle for idle_timeout seconds. Other arguments are passed to LiveStacker.
+    See watch.FolderWatcher for interval, settle and backend.
+    '''
+    from abberition import watch
+
+    stacker = LiveStacker(**kwargs)
+    watcher = watch.FolderWatcher(capture_path, settle=settle, backend=backend, include_existing=True)
+    last_frame = time.monotonic()
+
+    try:
+        while idle_timeout is None or time.monotonic() - last_frame < idle_timeout:
+            for path in watcher.poll():
+                if stacker.add_file(path) and preview_path is not None:
+                    stacker.save_preview(preview_path, binning)
+
+                last_frame = time.monotonic()
+
+            watcher.wait(interval)
+    except KeyboardInterrupt:
+        logging.info('Stopped live stacking')
+    finally:
+        watcher.close()
+
+    return stacker
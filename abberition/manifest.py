@@ -0,0 +1,133 @@
+'''
+Content addressed records of the outputs of processing stages.
+
+Each stage directory holds a manifest.json recording, for every output file, the key of the inputs
+it was made from: a hash of the input frame content, the masters used and the stage parameters.
+An output is reused if it still exists and was made with the same key, so a rerun or an interrupted
+run only redoes the outputs whose inputs changed.
+
+Outputs of a stage are inputs to the next. Their keys are recorded, so downstream stages key on the
+recorded key rather than hashing the output again.
+'''
+
+import json
+import logging
+import os
+from pathlib import Path
+
+from abberition import cache
+
+
+manifest_filename = 'manifest.json'
+
+
+class StageManifest:
+    '''
+    Manifest of the outputs of a stage in the directory path.
+    '''
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self.entries = {}
+
+        manifest_path = self.path / manifest_filename
+        if manifest_path.exists():
+            try:
+                with open(manifest_path, 'r') as f:
+                    self.entries = json.load(f).get('entries', {})
+            except (OSError, ValueError) as e:
+                logging.warning(f'Ignoring unreadable manifest {manifest_path}: {e}')
+
+    def is_valid(self, filename:str, key:str) -> bool:
+        '''
+        Check if the output filename exists and was made from inputs with key.
+        '''
+        entry = self.entries.get(str(filename))
+        if entry is None or entry['key'] != key:
+            return False
+
+        output_path = self.path / filename
+        return output_path.exists() and output_path.stat().st_size == entry['size']
+
+    def outputs(self, key:str) -> list:
+        '''
+        Get the valid outputs made from inputs with key, or None if there are none. Used by stages that
+        make several outputs from one set of inputs.
+        '''
+        filenames = [fn for fn, entry in self.entries.items() if entry['key'] == key]
+
+        if len(filenames) == 0 or not all(self.is_valid(fn, key) for fn in filenames):
+            return None
+
+        return filenames
+
+    def get_key(self, filename:str) -> str:
+        '''
+        Get the recorded key of a valid output, or None.
+        '''
+        entry = self.entries.get(str(filename))
+        if entry is None or not self.is_valid(filename, entry['key']):
+            return None
+
+        return entry['key']
+
+    def record(self, filename:str, key:str):
+        '''
+        Record that the output filename was made from inputs with key. The manifest is saved straight
+        away, so outputs finished before an interruption are kept.
+        '''
+        self.entries[str(filename)] = {'key': key, 'size': (self.path / filename).stat().st_size}
+        self.save()
+
+    def forget(self, filename:str):
+        self.entries.pop(str(filename), None)
+
+    def prune(self, keep):
+        '''
+        Remove the outputs, and their entries, that are not in keep.
+        '''
+        keep = set(str(fn) for fn in keep)
+
+        for filename in list(self.entries):
+            if filename not in keep:
+                output_path = self.path / filename
+                if output_path.exists():
+                    logging.debug(f'Removing stale output {output_path}')
+                    output_path.unlink()
+                self.forget(filename)
+
+        self.save()
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        manifest_path = self.path / manifest_filename
+        tmp_path = manifest_path.with_suffix(f'.{os.getpid()}.tmp')
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'entries': self.entries}, f, indent=1, sort_keys=True)
+
+        tmp_path.replace(manifest_path)
+
+
+def get_file_keys(location:Path, filenames) -> dict:
+    '''
+    Get the content key of each input file in location: its recorded key if it is the output of a stage,
+    otherwise a hash of its content.
+    '''
+    location = Path(location)
+    manifest = StageManifest(location) if (location / manifest_filename).exists() else None
+
+    keys = {}
+    for filename in filenames:
+        key = manifest.get_key(filename) if manifest is not None else None
+        keys[str(filename)] = key if key is not None else cache.hash_file(location / filename)
+
+    return keys
+
+
+def get_stage_key(*args, **kwargs) -> str:
+    '''
+    Combine input keys and stage parameters into an output key.
+    '''
+    return cache.hash_params(*args, **kwargs)
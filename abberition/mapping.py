@@ -0,0 +1,282 @@
+'''
+Cached pixel to pixel mappings between WCS for fast reprojection.
+
+Evaluating a WCS (including its SIP polynomials) for every output pixel often costs more than the
+interpolation itself. The mapping from one frame's pixels to another's is smooth, so it is evaluated
+exactly on a coarse grid of nodes and interpolated to full resolution. The grid is refined until the
+interpolation error is below a set bound.
+
+Node grids are cached by the pair of WCS headers, and the sky coordinates of a grid's nodes are cached
+by its WCS alone. Repeated reprojections of the same frames reuse the whole mapping, and frames
+reprojected onto the same output grid only evaluate their own WCS on the coarse nodes.
+'''
+
+from collections import OrderedDict
+from astropy.wcs import WCS
+import logging
+import numpy as np
+
+from abberition import cache
+
+
+class PixelMapping:
+    '''
+    Mapping from the pixels of a grid of shape (rows, cols) to pixel coordinates of another WCS,
+    known exactly at nodes (node_y, node_x) and interpolated bilinearly between them.
+    '''
+
+    def __init__(self, shape, node_y:np.ndarray, node_x:np.ndarray, map_x:np.ndarray, map_y:np.ndarray):
+        self.shape = tuple(shape)
+        self.node_y = node_y
+        self.node_x = node_x
+        self.map_x = map_x
+        self.map_y = map_y
+
+    def step(self):
+        return int(self.node_x[1] - self.node_x[0]) if len(self.node_x) > 1 else 1
+
+    def evaluate(self, rows:slice=None):
+        '''
+        Get the full resolution (x, y) mapped coordinates, optionally for a band of rows.
+        '''
+        rows = rows if rows is not None else slice(0, self.shape[0])
+        wy = linear_weights(np.arange(rows.start, rows.stop), self.node_y)
+        wx = linear_weights(np.arange(self.shape[1]), self.node_x)
+
+        x = wy @ self.map_x @ wx.T
+        y = wy @ self.map_y @ wx.T
+
+        return x, y
+
+
+def linear_weights(positions:np.ndarray, nodes:np.ndarray) -> np.ndarray:
+    '''
+    Linear interpolation weights of positions between increasing nodes, shape (len(positions), len(nodes)).
+    '''
+    weights = np.zeros((len(positions), len(nodes)), dtype=np.float64)
+
+    if len(nodes) == 1:
+        weights[:, 0] = 1.0
+        return weights
+
+    i = np.clip(np.searchsorted(nodes, positions, side='right') - 1, 0, len(nodes) - 2)
+    t = (positions - nodes[i]) / (nodes[i + 1] - nodes[i])
+    rows = np.arange(len(positions))
+
+    weights[rows, i] = 1.0 - t
+    weights[rows, i + 1] = t
+
+    return weights
+
+
+__mapping_cache = OrderedDict()
+__world_cache = OrderedDict()
+__memory_cache_size = 32
+
+
+def get_pixel_mapping(wcs_from:WCS, shape_from, wcs_to:WCS, max_error:float=0.01, initial_step:int=128, use_cache:bool=True) -> PixelMapping:
+    '''
+    Get the mapping from each pixel of the wcs_from grid of shape_from (rows, cols) to wcs_to pixel coordinates.
+
+    Parameters
+    ----------
+    wcs_from : WCS
+        WCS of the grid being mapped, for reprojection the output frame.
+
+    shape_from : tuple
+        Shape of the grid being mapped.
+
+    wcs_to : WCS
+        WCS the grid is mapped to, for reprojection the input frame.
+
+    max_error : float
+        Maximum interpolation error in pixels, checked at the centers of the grid cells.
+
+    initial_step : int
+        Node spacing to start from. It is halved until the error bound is met.
+
+    use_cache : bool
+        Reuse and store mappings in the cache.
+
+    Returns
+    -------
+    PixelMapping
+    '''
+    from_header = __header_string(wcs_from)
+    to_header = __header_string(wcs_to)
+    shape_from = tuple(int(s) for s in shape_from)
+
+    key = None
+    if use_cache:
+        key = cache.hash_params(from_header, shape_from, to_header, max_error, initial_step)
+
+        if key in __mapping_cache:
+            __mapping_cache.move_to_end(key)
+            return __mapping_cache[key]
+
+        stored = cache.load_array('mapping', key)
+        if stored is not None:
+            mapping = __unpack(stored, shape_from)
+            __remember(__mapping_cache, key, mapping)
+            return mapping
+
+    step = max(int(initial_step), 1)
+
+    while True:
+        node_y = __nodes(shape_from[0], step)
+        node_x = __nodes(shape_from[1], step)
+
+        ra, dec = __node_world(wcs_from, from_header, shape_from, node_y, node_x, use_cache)
+        map_x, map_y = __world_to_pixel(wcs_to, ra, dec)
+
+        if step == 1:
+            break
+
+        error = __interpolation_error(wcs_from, wcs_to, node_y, node_x, map_x, map_y)
+
+        if error <= max_error:
+            break
+
+        logging.debug(f'Pixel mapping error {error:.4f}px at step {step}, refining')
+        step = max(step // 2, 1)
+
+    mapping = PixelMapping(shape_from, node_y, node_x, map_x, map_y)
+
+    if use_cache:
+        cache.save_array('mapping', key, __pack(mapping))
+        __remember(__mapping_cache, key, mapping)
+
+    return mapping
+
+
+def reproject(input_data, output_projection, shape_out=None, max_error:float=0.01, order:int=1, use_cache:bool=True):
+    '''
+    Reproject an image with a cached, interpolated pixel mapping. Has the signature of reproject.reproject_interp
+    for the common case, so it can be used as the reproject_function of coadd.coadd.
+
+    Parameters
+    ----------
+    input_data : tuple
+        (array, WCS or Header) of the input image.
+
+    output_projection : WCS or Header
+        Output frame.
+
+    shape_out : tuple
+        Output shape, required if output_projection doesn't define it.
+
+    max_error : float
+        Maximum error of the mapping in pixels.
+
+    order : int
+        Spline order of the interpolation of the input image, 1 is bilinear.
+
+    Returns
+    -------
+    array, footprint : ndarray
+        Reprojected image (NaN outside the input) and footprint (1 inside the input, 0 outside).
+    '''
+    from scipy.ndimage import map_coordinates
+
+    data, wcs_in = input_data
+    wcs_in = wcs_in if isinstance(wcs_in, WCS) else WCS(wcs_in)
+    wcs_out = output_projection if isinstance(output_projection, WCS) else WCS(output_projection)
+
+    if shape_out is None:
+        shape_out = wcs_out.array_shape
+
+    mapping = get_pixel_mapping(wcs_out, shape_out, wcs_in, max_error=max_error, use_cache=use_cache)
+    x, y = mapping.evaluate()
+
+    data = np.asarray(data, dtype=np.float32)
+    inside = (x >= -0.5) & (x <= data.shape[1] - 0.5) & (y >= -0.5) & (y <= data.shape[0] - 0.5)
+
+    array = map_coordinates(data, [y, x], order=order, mode='nearest')
+    array = np.where(inside, array, np.nan).astype(np.float32)
+
+    return array, inside.astype(np.float32)
+
+
+def clear_cache():
+    __mapping_cache.clear()
+    __world_cache.clear()
+
+
+def __nodes(size:int, step:int) -> np.ndarray:
+    nodes = np.arange(0, size, step, dtype=np.float64)
+    if nodes[-1] != size - 1:
+        nodes = np.append(nodes, size - 1)
+    return nodes
+
+
+def __node_world(wcs_from:WCS, from_header:str, shape_from, node_y, node_x, use_cache:bool):
+    key = (from_header, shape_from, len(node_y), len(node_x))
+
+    if use_cache and key in __world_cache:
+        __world_cache.move_to_end(key)
+        return __world_cache[key]
+
+    gx, gy = np.meshgrid(node_x, node_y)
+    world = wcs_from.all_pix2world(gx, gy, 0)
+
+    if use_cache:
+        __remember(__world_cache, key, world)
+
+    return world
+
+
+def __world_to_pixel(wcs_to:WCS, ra:np.ndarray, dec:np.ndarray):
+    with np.errstate(invalid='ignore'):
+        x, y = wcs_to.all_world2pix(ra, dec, 0, quiet=True)
+
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+def __interpolation_error(wcs_from:WCS, wcs_to:WCS, node_y, node_x, map_x, map_y) -> float:
+    '''
+    Largest difference between the exact mapping at the cell centers and its bilinear interpolation.
+    '''
+    if len(node_y) < 2 or len(node_x) < 2:
+        return 0.0
+
+    cy = 0.5 * (node_y[:-1] + node_y[1:])
+    cx = 0.5 * (node_x[:-1] + node_x[1:])
+    gx, gy = np.meshgrid(cx, cy)
+
+    exact_x, exact_y = __world_to_pixel(wcs_to, *wcs_from.all_pix2world(gx, gy, 0))
+
+    interp_x = 0.25 * (map_x[:-1, :-1] + map_x[1:, :-1] + map_x[:-1, 1:] + map_x[1:, 1:])
+    interp_y = 0.25 * (map_y[:-1, :-1] + map_y[1:, :-1] + map_y[:-1, 1:] + map_y[1:, 1:])
+
+    error = np.hypot(exact_x - interp_x, exact_y - interp_y)
+    error = error[np.isfinite(error)]
+
+    return float(np.max(error)) if error.size else 0.0
+
+
+def __header_string(wcs:WCS) -> str:
+    return wcs.to_header(relax=True).tostring()
+
+
+def __pack(mapping:PixelMapping) -> np.ndarray:
+    # stored as one array: [len(node_y), len(node_x), node_y, node_x, map_x, map_y]
+    ny, nx = len(mapping.node_y), len(mapping.node_x)
+    return np.concatenate([[ny, nx], mapping.node_y, mapping.node_x, mapping.map_x.ravel(), mapping.map_y.ravel()])
+
+
+def __unpack(stored:np.ndarray, shape) -> PixelMapping:
+    ny, nx = int(stored[0]), int(stored[1])
+    i = 2
+    node_y = stored[i:i + ny]; i += ny
+    node_x = stored[i:i + nx]; i += nx
+    map_x = stored[i:i + ny * nx].reshape(ny, nx); i += ny * nx
+    map_y = stored[i:i + ny * nx].reshape(ny, nx)
+
+    return PixelMapping(shape, node_y, node_x, map_x, map_y)
+
+
+def __remember(memory_cache:OrderedDict, key, value):
+    memory_cache[key] = value
+
+    while len(memory_cache) > __memory_cache_size:
+        memory_cache.popitem(last=False)
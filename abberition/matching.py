@@ -0,0 +1,78 @@
+'''
+Match two sets of positions, such as detected stars and projected catalog stars.
+
+Each source point is paired with its nearest target point using a KD-tree, within a maximum
+separation. A target point claimed by several source points keeps only the mutual nearest
+neighbour, the source point that is itself nearest to the target. A source point that loses its
+nearest target this way is paired with its second nearest target instead, when that match is mutual.
+The work is O((n + m) log m) for n source and m target points, rather than O(n m) for comparing
+every pair.
+'''
+
+import numpy as np
+
+
+def match_nearest(source, target, max_separation:float=np.inf):
+    '''
+    Match source points to target points.
+
+    Parameters
+    ----------
+    source, target : array
+        (x, y) positions, shape (n, 2) and (m, 2).
+
+    max_separation : float
+        Maximum distance between matched points.
+
+    Returns
+    -------
+    indices : ndarray
+        Index of the matched target point of each source point, m if unmatched.
+
+    separations : ndarray
+        Distance to the matched target point of each source point, NaN if unmatched.
+    '''
+    from scipy.spatial import cKDTree
+
+    source = np.asarray(source, dtype=np.float64).reshape(-1, 2)
+    target = np.asarray(target, dtype=np.float64).reshape(-1, 2)
+
+    indices = np.full(len(source), len(target), dtype=np.int64)
+    separations = np.full(len(source), np.nan)
+
+    if len(source) == 0 or len(target) == 0:
+        return indices, separations
+
+    # nearest and second nearest targets of each source, and the nearest source of each target
+    dist, idx = cKDTree(target).query(source, k=2, distance_upper_bound=max_separation)
+    _, nearest_source = cKDTree(source).query(target)
+
+    rows = np.arange(len(source))
+    for k in range(2):
+        found = np.isfinite(dist[:, k]) & (indices == len(target))
+        mutual = np.zeros(len(source), dtype=bool)
+        mutual[found] = nearest_source[idx[found, k]] == rows[found]
+
+        # a target's nearest source is unique, so mutual pairs never share a target
+        indices[mutual] = idx[mutual, k]
+        separations[mutual] = dist[mutual, k]
+
+    return indices, separations
+
+
+def match_pairs(source, target, max_separation:float=np.inf):
+    '''
+    Match source points to target points as with match_nearest, returning only the matches.
+
+    Returns
+    -------
+    pairs : ndarray
+        (source index, target index) of each match, shape (k, 2), in order of source index.
+
+    separations : ndarray
+        Distance between the points of each match.
+    '''
+    indices, separations = match_nearest(source, target, max_separation)
+    matched = np.flatnonzero(np.isfinite(separations))
+
+    return np.column_stack([matched, indices[matched]]), separations[matched]
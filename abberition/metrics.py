@@ -0,0 +1,344 @@
+'''
+Instrumentation of processing stages and frames.
+
+Wall time, CPU time, bytes read and written and peak RSS are recorded for each stage and frame, with
+counters such as library lookups and cache hits. Measuring reads the process's resource usage and,
+where available, /proc/self/io, so it is cheap enough to leave enabled.
+
+Peak RSS is the peak during the stage or frame: the kernel's high-water mark is reset at the start of
+each with /proc/self/clear_refs and read from /proc/self/status at the end. Where the mark can't be
+reset (other than Linux) it is the process's peak since it started.
+
+Frames processed in worker processes are measured there and the FrameRecord returned with the result,
+then added with Metrics.add_frame. Stage CPU time and IO include worker processes once they have
+exited, and a stage's peak RSS is the largest of its own and of the frames recorded in it.
+'''
+
+from contextlib import contextmanager
+import csv
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+@dataclass
+class Usage:
+    '''
+    Resource usage of the process at a point in time.
+    '''
+    wall: float = 0.0
+    cpu: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+
+
+@dataclass
+class FrameRecord:
+    stage: str
+    name: str
+    wall: float = 0.0
+    cpu: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    peak_rss: int = 0
+    pid: int = 0
+    counters: dict = field(default_factory=dict)
+
+
+@dataclass
+class StageRecord:
+    name: str
+    wall: float = 0.0
+    cpu: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    peak_rss: int = 0
+    frames: int = 0
+    counters: dict = field(default_factory=dict)
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.frames / self.wall if self.wall > 0 else 0.0
+
+
+def get_usage(children:bool=False) -> Usage:
+    '''
+    Get the resource usage of this process, including its exited child processes if children is set.
+    Bytes are those read and written by the process, including reads served from the page cache.
+    '''
+    usage = Usage(wall=time.perf_counter())
+
+    if resource is not None:
+        scopes = [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN] if children else [resource.RUSAGE_SELF]
+        for scope in scopes:
+            ru = resource.getrusage(scope)
+            usage.cpu += ru.ru_utime + ru.ru_stime
+    else:
+        usage.cpu = time.process_time()
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io_counters = dict(line.split(':') for line in f.read().splitlines())
+        usage.read_bytes = int(io_counters['rchar'])
+        usage.write_bytes = int(io_counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    return usage
+
+
+class PeakRss:
+    '''
+    Peak RSS of this process over nested scopes, such as a stage and the frames processed in it. The
+    high-water mark is reset at the start of each scope, once the peak so far is added to the scopes
+    already open.
+    '''
+
+    def __init__(self):
+        self.__scopes = []
+        self.__resettable = True
+
+    def start(self) -> list:
+        peak = self.__read()
+        for scope in self.__scopes:
+            scope[0] = max(scope[0], peak)
+
+        scope = [0 if self.__reset() else peak]
+        self.__scopes.append(scope)
+
+        return scope
+
+    def end(self, scope:list) -> int:
+        '''
+        Close a scope returned by start, returning its peak RSS in bytes.
+        '''
+        scope[0] = max(scope[0], self.__read())
+        self.__scopes.remove(scope)
+
+        return scope[0]
+
+    def __reset(self) -> bool:
+        if self.__resettable:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+            except OSError:
+                self.__resettable = False
+
+        return self.__resettable
+
+    def __read(self) -> int:
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+
+        # ru_maxrss is in kB on Linux, the peak since the process started
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else 0
+
+
+# peak RSS scopes of the stages and frames measured in this process
+rss_peaks = PeakRss()
+
+
+class Metrics:
+    '''
+    Records of the stages and frames processed, and counters.
+    '''
+
+    def __init__(self, enabled:bool=True):
+        self.enabled = enabled
+        self.stages = []
+        self.frames = []
+        self.counters = {}
+        self.__open_stages = []
+
+    def count(self, name:str, n:int=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name:str):
+        '''
+        Measure a stage. Frames and counters recorded while the stage is open are attributed to it.
+        '''
+        if not self.enabled:
+            yield None
+            return
+
+        record = StageRecord(name)
+        start = get_usage(children=True)
+        peak = rss_peaks.start()
+        start_frames = len(self.frames)
+        start_counters = dict(self.counters)
+
+        self.__open_stages.append(record)
+        try:
+            yield record
+        finally:
+            self.__open_stages.pop()
+            end = get_usage(children=True)
+
+            # the usage of worker processes is added to this process's once they exit
+            record.wall = end.wall - start.wall
+            record.cpu = end.cpu - start.cpu
+            record.read_bytes = end.read_bytes - start.read_bytes
+            record.write_bytes = end.write_bytes - start.write_bytes
+            frames = [f for f in self.frames[start_frames:] if f.stage == name]
+            record.peak_rss = max([rss_peaks.end(peak)] + [f.peak_rss for f in frames])
+            record.frames = len(frames)
+            record.counters = _difference(self.counters, start_counters)
+
+            self.stages.append(record)
+            logging.info(f'Stage {name}: {record.wall:.2f} s wall, {record.cpu:.2f} s cpu, {record.frames} frames')
+
+    @contextmanager
+    def frame(self, name:str, stage:str=None):
+        '''
+        Measure the processing of one frame in this process, added to the frame records. In worker
+        processes use measure_frame instead and add the returned record in the main process.
+        '''
+        with measure_frame(name, stage or self.__current_stage(), self) as record:
+            yield record
+
+        if self.enabled:
+            self.frames.append(record)
+
+    def add_frame(self, record:FrameRecord):
+        '''
+        Add a frame measured in a worker process, with the counters it incremented.
+        '''
+        if self.enabled and record is not None:
+            self.frames.append(record)
+
+            if record.pid != os.getpid():
+                for name, n in record.counters.items():
+                    self.count(name, n)
+
+    def reset(self):
+        self.stages = []
+        self.frames = []
+        self.counters = {}
+
+    def __current_stage(self) -> str:
+        return self.__open_stages[-1].name if len(self.__open_stages) > 0 else None
+
+    def to_dict(self) -> dict:
+        return {
+            'stages': [dict(asdict(s), frames_per_second=s.frames_per_second) for s in self.stages],
+            'frames': [asdict(f) for f in self.frames],
+            'counters': dict(self.counters),
+        }
+
+    def write_json(self, path:Path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def write_csv(self, path:Path):
+        '''
+        Write one row per stage and per frame, with a kind column telling them apart.
+        '''
+        fields = ['kind', 'stage', 'name', 'wall', 'cpu', 'read_bytes', 'write_bytes', 'peak_rss', 'frames', 'counters']
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+
+            for s in self.stages:
+                writer.writerow({'kind': 'stage', 'stage': s.name, 'name': s.name, 'wall': s.wall, 'cpu': s.cpu, 'read_bytes': s.read_bytes,
+                                 'write_bytes': s.write_bytes, 'peak_rss': s.peak_rss, 'frames': s.frames, 'counters': json.dumps(s.counters)})
+
+            for r in self.frames:
+                writer.writerow({'kind': 'frame', 'stage': r.stage, 'name': r.name, 'wall': r.wall, 'cpu': r.cpu, 'read_bytes': r.read_bytes,
+                                 'write_bytes': r.write_bytes, 'peak_rss': r.peak_rss, 'frames': 1, 'counters': json.dumps(r.counters)})
+
+    def summary(self) -> str:
+        '''
+        Human readable table of the stages and the counters.
+        '''
+        lines = [f'{"stage":<20} {"wall s":>9} {"cpu s":>9} {"frames":>7} {"frames/s":>9} {"read MB":>9} {"write MB":>9} {"peak MB":>9}']
+
+        for s in self.stages:
+            lines.append(f'{s.name:<20} {s.wall:9.2f} {s.cpu:9.2f} {s.frames:7d} {s.frames_per_second:9.2f} {s.read_bytes / 1e6:9.1f} '
+                         f'{s.write_bytes / 1e6:9.1f} {s.peak_rss / 1e6:9.1f}')
+
+        if len(self.frames) > 0:
+            slowest = max(self.frames, key=lambda f: f.wall)
+            lines.append(f'slowest frame: {slowest.name} ({slowest.stage}) {slowest.wall:.2f} s')
+
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'{name}: {n}')
+
+        return '\n'.join(lines)
+
+
+@contextmanager
+def measure_frame(name:str, stage:str=None, counters:Metrics=None):
+    '''
+    Measure the processing of one frame in the current process, yielding the FrameRecord filled in
+    on exit. Counters incremented on counters (the module metrics if None) are included.
+    '''
+    counters = counters if counters is not None else metrics
+    record = FrameRecord(stage, name, pid=os.getpid())
+
+    if not counters.enabled:
+        yield record
+        return
+
+    start = get_usage()
+    peak = rss_peaks.start()
+    start_counters = dict(counters.counters)
+
+    try:
+        yield record
+    finally:
+        end = get_usage()
+        record.peak_rss = rss_peaks.end(peak)
+
+        record.wall = end.wall - start.wall
+        record.cpu = end.cpu - start.cpu
+        record.read_bytes = end.read_bytes - start.read_bytes
+        record.write_bytes = end.write_bytes - start.write_bytes
+        record.counters = _difference(counters.counters, start_counters)
+
+
+def _difference(counters:dict, start:dict) -> dict:
+    return {name: n - start.get(name, 0) for name, n in counters.items() if n != start.get(name, 0)}
+
+
+# metrics of the current process, recorded by the library and the processor. Set metrics.enabled to
+# False to stop recording.
+metrics = Metrics()
+
+
+def count(name:str, n:int=1):
+    metrics.count(name, n)
+
+
+def add_frame(record:FrameRecord):
+    metrics.add_frame(record)
+
+
+def stage(name:str):
+    '''
+    Measure a stage of the module metrics, as a context manager or a function decorator.
+    '''
+    return metrics.stage(name)
+
+
+def frame(name:str, stage:str=None):
+    '''
+    Measure a frame processed in this process with the module metrics.
+    '''
+    return metrics.frame(name, stage)
@@ -0,0 +1,57 @@
+# helpers for running work across a pool of worker processes
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def get_worker_count(workers:int=None) -> int:
+    '''
+    Get the number of worker processes to use. None or values less than 1 use all available cores.
+    '''
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+
+    return workers
+
+
+def map_ordered(fn, items, workers:int=None, initializer=None, initargs=(), chunksize:int=1):
+    '''
+    Map fn over items across a process pool, yielding results in the same order as items.
+
+    fn, initializer and the items must be picklable. If only one worker is used the work is
+    done in the current process without starting a pool.
+
+    Parameters
+    ----------
+    fn : callable
+        Module level function called with each item.
+
+    items : iterable
+        Items to process.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    initializer : callable
+        Called once in each worker before any items are processed.
+
+    initargs : tuple
+        Arguments passed to initializer.
+
+    chunksize : int
+        Number of items sent to a worker at a time.
+
+    '''
+    items = list(items)
+    workers = min(get_worker_count(workers), max(len(items), 1))
+
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+
+        for item in items:
+            yield fn(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        yield from executor.map(fn, items, chunksize=chunksize)
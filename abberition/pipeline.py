@@ -0,0 +1,264 @@
+'''
+Streaming processing of lights, one frame at a time.
+
+Each light is calibrated, solved and reprojected by a worker, passing the frame between steps in
+memory. Only the part of the output frame covered by a light is reprojected and returned, and it is
+added to the running stack of its filter as soon as it arrives. The first aligned frame is available
+as soon as the first light is done, and no stage directories are written unless checkpoints are
+requested.
+
+The output frame is planned from the first solved light, padded by a margin for dithering, since the
+footprint of unsolved lights isn't known in advance. Masters are selected for every light up front
+and shared once with the workers (see calibration.SharedMasters).
+'''
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from ccdproc import CCDData, ImageFileCollection
+import logging
+import numpy as np
+from pathlib import Path
+
+from abberition import astrometry, background, calibration, combine, conversion, parallel
+
+
+class RunningStack:
+    '''
+    Running weighted mean of reprojected frames on a reference grid.
+    '''
+
+    def __init__(self, reprojection:combine.Reprojection):
+        self.reprojection = reprojection
+        self.total = np.zeros(reprojection.shape, dtype=np.float64)
+        self.weight = np.zeros(reprojection.shape, dtype=np.float32)
+        self.count = 0
+        self.levels = []
+
+    def add(self, data:np.ndarray, footprint:np.ndarray, origin=(0, 0), weight:float=1.0, level:float=None):
+        '''
+        Add a frame covering the part of the grid starting at origin (row, col). If the frame's background
+        level is given it is subtracted, and the mean level of all frames is restored in the result.
+        '''
+        y0, x0 = origin
+        region = (slice(y0, y0 + data.shape[0]), slice(x0, x0 + data.shape[1]))
+
+        if level is not None:
+            data = data - level
+            self.levels.append(level)
+
+        valid = (footprint > 0) & np.isfinite(data)
+        w = np.where(valid, footprint * weight, 0.0)
+
+        self.total[region] += np.where(valid, data, 0.0) * w
+        self.weight[region] += w
+        self.count += 1
+
+    def mean(self) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.weight > 0, self.total / self.weight, np.nan)
+
+        if len(self.levels) > 0:
+            mean += np.mean(self.levels)
+
+        return mean.astype(np.float32)
+
+    def result(self) -> CCDData:
+        ccd = CCDData(self.mean(), unit=u.adu, wcs=self.reprojection.wcs)
+        ccd.meta['ncombine'] = self.count
+
+        return ccd
+
+
+def get_reference_grid(wcs:WCS, shape, res_arcsec:float=None, margin:float=0.25) -> combine.Reprojection:
+    '''
+    Plan an output frame covering an image of shape (rows, cols) with its WCS, padded on each side by
+    margin times its size. res_arcsec is the output resolution, the image's resolution if None.
+    '''
+    header = wcs.to_header(relax=True)
+    header['naxis2'], header['naxis1'] = shape
+
+    reprojection = combine.get_reprojection([header], res_arcsec)
+
+    rows, cols = reprojection.shape
+    pad_y, pad_x = int(np.ceil(margin * rows)), int(np.ceil(margin * cols))
+
+    reprojection.wcs.wcs.crpix = reprojection.wcs.wcs.crpix + np.array([pad_x, pad_y])
+    reprojection.shape = (rows + 2 * pad_y, cols + 2 * pad_x)
+    reprojection.wcs.pixel_shape = (reprojection.shape[1], reprojection.shape[0])
+
+    return reprojection
+
+
+def stream_lights(lights:ImageFileCollection, flats:ImageFileCollection=None, res_arcsec:float=None, margin:float=0.25, workers:int=None,
+                  remove_cosmics:bool=False, match_backgrounds:bool=True, calib_path:Path=None, solved_path:Path=None) -> dict:
+    '''
+    Calibrate, solve and stack lights one frame at a time.
+
+    Parameters
+    ----------
+    lights : ImageFileCollection
+        Source lights.
+
+    flats : ImageFileCollection
+        Calibrated flats, the library flats are used if None.
+
+    res_arcsec : float
+        Output resolution in arcsec/px, the resolution of the first light if None.
+
+    margin : float
+        Padding of the output frame around the first light, as a fraction of its size.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    remove_cosmics : bool
+        Clean cosmic rays from each calibrated light.
+
+    match_backgrounds : bool
+        Subtract each light's background level before stacking.
+
+    calib_path, solved_path : Path
+        If set, calibrated and solved lights are checkpointed to these directories.
+
+    Returns
+    -------
+    dict
+        RunningStack of each filter.
+    '''
+    masters = calibration.SharedMasters()
+
+    try:
+        files = [(str(Path(lights.location) / fn), masters.select(header, flats)) for header, fn in lights.headers(return_fname=True)]
+        if len(files) == 0:
+            raise ValueError('No lights to process')
+
+        return __stream(files, masters, res_arcsec, margin, workers, remove_cosmics, match_backgrounds, calib_path, solved_path)
+    finally:
+        masters.unlink()
+
+
+def __stream(files:list, masters:calibration.SharedMasters, res_arcsec, margin, workers, remove_cosmics, match_backgrounds, calib_path, solved_path) -> dict:
+    state = {
+        'masters': masters.specs(),
+        'remove_cosmics': remove_cosmics,
+        'match_backgrounds': match_backgrounds,
+        'calib_path': str(calib_path) if calib_path is not None else None,
+        'solved_path': str(solved_path) if solved_path is not None else None,
+    }
+
+    # the first light is processed here to plan the output frame
+    _init_worker(state)
+    solved = None
+    while solved is None and len(files) > 0:
+        path, names = files.pop(0)
+        try:
+            solved = _calibrate_and_solve(path, names)
+        except Exception as e:
+            logging.warning(f'Could not process \'{Path(path).name}\': {e}')
+
+    if solved is None:
+        raise ValueError('No lights could be solved')
+
+    reprojection = get_reference_grid(solved.wcs, solved.shape, res_arcsec, margin)
+    state['reference'] = (reprojection.wcs.to_header(relax=True).tostring(), reprojection.shape)
+    logging.info(f'Streaming {len(files) + 1} lights onto {reprojection.shape[1]}x{reprojection.shape[0]} px')
+
+    _init_worker(state)
+    stacks = {}
+    __add(stacks, reprojection, (Path(path).name,) + reproject_light(solved, reprojection, match_backgrounds))
+
+    for result in parallel.map_ordered(_process_light, files, workers, initializer=_init_worker, initargs=(state,)):
+        __add(stacks, reprojection, result)
+
+    return stacks
+
+
+def __add(stacks:dict, reprojection, result):
+    filename, result = result[0], result[1:]
+
+    if len(result) == 1:
+        logging.warning(f'Could not process \'{filename}\': {result[0]}')
+        return
+
+    filter, origin, data, footprint, level = result
+    if data is None:
+        logging.warning(f'\'{filename}\' is outside the output frame')
+        return
+
+    if filter not in stacks:
+        stacks[filter] = RunningStack(reprojection)
+
+    stacks[filter].add(data, footprint, origin, level=level)
+    logging.info(f'Stacked \'{filename}\' ({filter}, {stacks[filter].count} frames)')
+
+
+__worker = {}
+
+
+def _init_worker(state:dict):
+    __worker.clear()
+    __worker.update(state)
+    __worker['masters'], __worker['shared'] = calibration.SharedMasters.attach(state['masters'])
+
+    if state.get('reference') is not None:
+        header, shape = state['reference']
+        __worker['reprojection'] = combine.Reprojection(WCS(fits.Header.fromstring(header)), tuple(shape))
+
+
+def _process_light(task):
+    path, names = task
+    try:
+        solved = _calibrate_and_solve(path, names)
+        return (Path(path).name,) + reproject_light(solved, __worker['reprojection'], __worker['match_backgrounds'])
+    except Exception as e:
+        return (Path(path).name, str(e))
+
+
+def _calibrate_and_solve(path:str, names:tuple) -> CCDData:
+    filename = Path(path).name
+    light = CCDData.read(path, unit='adu')
+
+    bias, dark, flat = (__worker['masters'].get(name) for name in names)
+    calibrated = calibration.calibrate_light(light, flat, bias, dark, remove_cosmics=__worker['remove_cosmics'], workers=1)
+    calibrated = conversion.to_float32(calibrated)
+
+    if __worker['calib_path'] is not None:
+        calibrated.write(Path(__worker['calib_path']) / filename, overwrite=True)
+
+    solved_fn = Path(__worker['solved_path']) / filename if __worker['solved_path'] is not None else None
+
+    # lights reach each worker in order of capture, so the last light it solved seeds the next
+    solved = astrometry.solve_wcs(calibrated, solved_fn, seed=__worker.get('seed'))
+    __worker['seed'] = solved.wcs
+
+    return solved
+
+
+def reproject_light(solved:CCDData, reprojection:combine.Reprojection, match_backgrounds:bool=True):
+    '''
+    Reproject a solved light onto the part of the output frame it covers, to add to a RunningStack.
+
+    Returns (filter, origin, data, footprint, background level), with data None if the light is outside
+    the frame. The level is None unless match_backgrounds is set.
+    '''
+    from reproject import reproject_interp
+
+    wcs, shape = reprojection.wcs, reprojection.shape
+    filter = solved.header.get('filter', 'NONE')
+
+    ra, dec = combine.get_footprint(solved.wcs, solved.shape)
+    x, y = wcs.all_world2pix(ra, dec, 0)
+
+    x0, x1 = max(int(np.floor(np.min(x))) - 1, 0), min(int(np.ceil(np.max(x))) + 2, shape[1])
+    y0, y1 = max(int(np.floor(np.min(y))) - 1, 0), min(int(np.ceil(np.max(y))) + 2, shape[0])
+
+    if x1 <= x0 or y1 <= y0:
+        return filter, None, None, None, None
+
+    data = np.asarray(solved.data, dtype=np.float32)
+    level = background.get_background(data, use_cache=False).median if match_backgrounds else None
+
+    array, footprint = reproject_interp((data, solved.wcs), wcs[y0:y1, x0:x1], shape_out=(y1 - y0, x1 - x0))
+
+    return filter, (y0, x0), array.astype(np.float32), footprint.astype(np.float32), level
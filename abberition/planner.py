@@ -0,0 +1,340 @@
+'''
+Dry run planning of Processor runs from headers only.
+
+Lights are grouped by the keywords that select their masters, and the masters of each group are
+matched in the library (or the flats) without loading them, so a missing master is reported before
+any frame is processed. Darks are also matched by temperature, once per distinct temperature of the
+lights of each group, so lights that drift to a temperature without a dark are reported too. The number of frames each stage processes, the output frame of each filter
+and an estimate of the CPU time, peak memory and disk space used are worked out from the headers and
+per stage cost coefficients.
+
+The default coefficients are rough figures for a desktop CPU. Coefficients measured on the machine
+that will do the run are obtained from the metrics of an earlier run with coefficients_from_metrics.
+'''
+
+from astropy.wcs import WCS
+from ccdproc import CCDData, ImageFileCollection
+from dataclasses import asdict, dataclass, field
+import logging
+import numpy as np
+
+from abberition import combine, library, parallel
+
+
+# keywords that select the masters of a light
+group_keys = ['instrume', 'naxis1', 'naxis2', 'xbinning', 'ybinning', 'gain', 'filter', 'exptime']
+
+# per stage costs: cpu seconds per frame and per megapixel, peak memory in frame sizes per worker
+# (float32), and bytes written per pixel
+cost_coefficients = {
+    'calibrate_flats': {'cpu_frame': 0.05, 'cpu_mpx': 0.15, 'memory_frames': 6.0, 'disk_px': 0.0},
+    'calibrate_lights': {'cpu_frame': 0.05, 'cpu_mpx': 0.08, 'memory_frames': 6.0, 'disk_px': 4.0},
+    'remove_cosmics': {'cpu_frame': 0.0, 'cpu_mpx': 1.5, 'memory_frames': 8.0, 'disk_px': 0.0},
+    'solve_astrometry': {'cpu_frame': 8.0, 'cpu_mpx': 0.3, 'memory_frames': 4.0, 'disk_px': 4.0},
+    'register_lights': {'cpu_frame': 0.05, 'cpu_mpx': 0.25, 'memory_frames': 5.0, 'disk_px': 5.0},
+    'stack_lights': {'cpu_frame': 0.05, 'cpu_mpx': 0.2, 'memory_frames': 4.0, 'disk_px': 0.0},
+}
+
+
+@dataclass
+class GroupPlan:
+    '''
+    Lights sharing masters, with the masters matched for them. Darks are also matched by ccd-temp, which
+    isn't a group key, so the dark of each temperature of the group's lights is in darks, and the lights
+    without a master are in missing_lights.
+    '''
+    keys: dict
+    frames: int = 0
+    exposure: float = 0.0
+    bias: str = None
+    dark: str = None
+    flat: str = None
+    missing: list = field(default_factory=list)
+    darks: dict = field(default_factory=dict)
+    missing_lights: list = field(default_factory=list)
+
+
+@dataclass
+class StagePlan:
+    name: str
+    frames: int = 0
+    megapixels: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_memory: int = 0
+    disk_bytes: int = 0
+
+
+@dataclass
+class Plan:
+    groups: list = field(default_factory=list)
+    stages: list = field(default_factory=list)
+    outputs: dict = field(default_factory=dict)
+    workers: int = 1
+    warnings: list = field(default_factory=list)
+
+    @property
+    def cpu_seconds(self) -> float:
+        return sum(s.cpu_seconds for s in self.stages)
+
+    @property
+    def wall_seconds(self) -> float:
+        return self.cpu_seconds / self.workers
+
+    @property
+    def peak_memory(self) -> int:
+        return max([s.peak_memory for s in self.stages] + [0])
+
+    @property
+    def disk_bytes(self) -> int:
+        return sum(s.disk_bytes for s in self.stages)
+
+    @property
+    def missing_masters(self) -> bool:
+        return any(len(g.missing) > 0 for g in self.groups)
+
+    def to_dict(self) -> dict:
+        return dict(asdict(self), cpu_seconds=self.cpu_seconds, wall_seconds=self.wall_seconds, peak_memory=self.peak_memory,
+                    disk_bytes=self.disk_bytes)
+
+    def summary(self) -> str:
+        lines = [f'{len(self.groups)} groups of lights']
+
+        for g in self.groups:
+            keys = ', '.join(f'{k}={v}' for k, v in g.keys.items())
+            lines.append(f'  [{keys}] {g.frames} frames, {g.exposure:.0f} s: bias {g.bias}, dark {g.dark}, flat {g.flat}')
+            if len(g.missing) > 0:
+                lines.append(f'    MISSING: {", ".join(g.missing)}')
+            if 0 < len(g.missing_lights) < g.frames:
+                more = f' and {len(g.missing_lights) - 5} more' if len(g.missing_lights) > 5 else ''
+                lines.append(f'    lights without masters: {", ".join(g.missing_lights[:5])}{more}')
+
+        lines.append(f'{"stage":<20} {"frames":>7} {"cpu s":>10} {"peak MB":>9} {"disk MB":>9}')
+        for s in self.stages:
+            lines.append(f'{s.name:<20} {s.frames:7d} {s.cpu_seconds:10.1f} {s.peak_memory / 1e6:9.1f} {s.disk_bytes / 1e6:9.1f}')
+
+        for filter, shape in self.outputs.items():
+            lines.append(f'output {filter}: {shape[1]}x{shape[0]} px' if shape is not None else f'output {filter}: unknown until solved')
+
+        lines.append(f'estimated {self.cpu_seconds / 3600:.2f} cpu hours, {self.wall_seconds / 3600:.2f} hours on {self.workers} workers, '
+                     f'peak memory {self.peak_memory / 1e9:.2f} GB, disk {self.disk_bytes / 1e9:.2f} GB')
+        lines.extend(f'warning: {w}' for w in self.warnings)
+
+        return '\n'.join(lines)
+
+
+def group_lights(headers) -> list:
+    '''
+    Group light headers by group_keys. Returns a list of (keys, headers), in order of first appearance.
+    '''
+    groups = {}
+
+    for header in headers:
+        keys = tuple((k, header.get(k)) for k in group_keys)
+        groups.setdefault(keys, []).append(header)
+
+    return [(dict(keys), headers) for keys, headers in groups.items()]
+
+
+def match_masters(header, flats_src:ImageFileCollection=None, flats_calib:ImageFileCollection=None) -> GroupPlan:
+    '''
+    Match the masters of a light from its header, without loading them. Flats are matched in the
+    calibrated flats if given, then among the source flats (made by calibrate_flats), then in the library.
+    '''
+    plan = GroupPlan({k: header.get(k) for k in group_keys})
+    light = CCDData(np.zeros((1, 1), dtype=np.float32), unit='adu', meta=header)
+
+    for kind, select in [('bias', library.select_bias), ('dark', library.select_dark)]:
+        try:
+            _, filename = select(light, load=False)
+            setattr(plan, kind, filename)
+        except Exception as e:
+            plan.missing.append(f'{kind} ({e})')
+
+    try:
+        if flats_calib is not None:
+            _, plan.flat = library.select_flat(light, flats=flats_calib, load=False)
+        elif flats_src is not None and __has_source_flats(header, flats_src):
+            plan.flat = 'from source flats'
+
+        if plan.flat is None:
+            _, plan.flat = library.select_flat(light, load=False)
+    except Exception as e:
+        logging.debug(f'Could not match flat: {e}')
+
+    if plan.flat is None:
+        plan.missing.append('flat')
+
+    return plan
+
+
+def match_dark_temperatures(group_plan:GroupPlan, headers:list, filenames:list):
+    '''
+    Match the darks of the lights of a group at each of their temperatures, once per distinct ccd-temp
+    rounded to 0.01 C, after match_masters matched the group's first light. Temperatures without a
+    dark are added to the group's missing masters, and their lights to its missing lights.
+    '''
+    temperatures = {}
+    for header, filename in zip(headers, filenames):
+        temperatures.setdefault(__temperature(header), []).append(filename)
+
+    first = __temperature(headers[0])
+
+    for temperature, names in temperatures.items():
+        if temperature == first:
+            group_plan.darks[temperature] = group_plan.dark
+            if group_plan.dark is None:
+                group_plan.missing_lights.extend(names)
+            continue
+
+        header = next(h for h in headers if __temperature(h) == temperature)
+        light = CCDData(np.zeros((1, 1), dtype=np.float32), unit='adu', meta=header)
+
+        try:
+            _, group_plan.darks[temperature] = library.select_dark(light, load=False)
+        except Exception as e:
+            group_plan.darks[temperature] = None
+            group_plan.missing.append(f'dark at {temperature}C for {len(names)} lights ({e})')
+            group_plan.missing_lights.extend(names)
+
+
+def __temperature(header):
+    temperature = header.get('ccd-temp')
+    return round(float(temperature), 2) if temperature is not None else None
+
+
+def __has_source_flats(header, flats_src:ImageFileCollection) -> bool:
+    for flat in flats_src.headers():
+        if all(flat.get(k) == header.get(k) for k in ['instrume', 'naxis1', 'naxis2', 'xbinning', 'ybinning', 'filter']):
+            return True
+
+    return False
+
+
+def plan(lights:ImageFileCollection, flats_src:ImageFileCollection=None, flats_calib:ImageFileCollection=None, register:bool=False,
+         remove_cosmics:bool=False, resolution:float=1.0, workers:int=None, coefficients:dict=None) -> Plan:
+    '''
+    Plan the processing of lights from their headers, as Processor.process would run it.
+
+    Parameters
+    ----------
+    lights : ImageFileCollection
+        Source lights.
+
+    flats_src, flats_calib : ImageFileCollection
+        Source flats to be calibrated, or calibrated flats.
+
+    register : bool
+        Plan registration instead of plate solving.
+
+    remove_cosmics : bool
+        Plan cosmic ray removal.
+
+    resolution : float
+        Output resolution in arcsec/px of the solved stacks.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    coefficients : dict
+        Per stage costs replacing those of cost_coefficients, see coefficients_from_metrics.
+
+    Returns
+    -------
+    Plan
+    '''
+    costs = {name: dict(c) for name, c in cost_coefficients.items()}
+    for name, c in (coefficients or {}).items():
+        costs.setdefault(name, {'cpu_frame': 0.0, 'cpu_mpx': 0.0, 'memory_frames': 0.0, 'disk_px': 0.0}).update(c)
+
+    result = Plan(workers=parallel.get_worker_count(workers))
+    entries = list(lights.headers(return_fname=True))
+    headers = [header for header, _ in entries]
+    filenames = {id(header): filename for header, filename in entries}
+
+    if len(headers) == 0:
+        result.warnings.append('no lights')
+        return result
+
+    for keys, group in group_lights(headers):
+        names = [filenames[id(h)] for h in group]
+
+        group_plan = match_masters(group[0], flats_src, flats_calib)
+        match_dark_temperatures(group_plan, group, names)
+        if group_plan.bias is None or group_plan.flat is None:
+            group_plan.missing_lights = names
+
+        group_plan.frames = len(group)
+        group_plan.exposure = float(sum(h.get('exptime', 0.0) for h in group))
+        result.groups.append(group_plan)
+
+        if len(group_plan.missing) > 0:
+            result.warnings.append(f'{len(group_plan.missing_lights)} of {len(group)} lights in group {keys} have missing masters: '
+                                   f'{", ".join(group_plan.missing)}')
+
+    pixels = [h.get('naxis1', 0) * h.get('naxis2', 0) for h in headers]
+
+    if flats_src is not None and flats_calib is None:
+        flat_pixels = [h.get('naxis1', 0) * h.get('naxis2', 0) for h in flats_src.headers()]
+        result.stages.append(__stage('calibrate_flats', flat_pixels, 0, costs, result.workers))
+
+    result.stages.append(__stage('calibrate_lights', pixels, 0, costs, result.workers))
+    if remove_cosmics:
+        result.stages.append(__stage('remove_cosmics', pixels, 0, costs, result.workers))
+
+    filters = sorted(set(str(h.get('filter')) for h in headers))
+
+    if register:
+        result.stages.append(__stage('register_lights', pixels, 0, costs, result.workers))
+        reference = headers[0]
+        result.outputs = {f: (reference['naxis2'], reference['naxis1']) for f in filters}
+    else:
+        result.stages.append(__stage('solve_astrometry', pixels, 0, costs, result.workers))
+        result.outputs = {f: __output_shape([h for h in headers if str(h.get('filter')) == f], resolution) for f in filters}
+
+    # each stack is written once with its weights, from the tiled coadd's disk backed arrays
+    output_pixels = sum(int(np.prod(s)) if s is not None else max(pixels) for s in result.outputs.values())
+    result.stages.append(__stage('stack_lights', pixels, 12 * output_pixels, costs, result.workers))
+
+    if any(s is None for s in result.outputs.values()):
+        result.warnings.append('lights have no WCS, output sizes are unknown until they are solved')
+
+    return result
+
+
+def __stage(name:str, pixels:list, extra_disk:int, costs:dict, workers:int) -> StagePlan:
+    c = costs[name]
+    megapixels = float(np.sum(pixels)) / 1e6
+
+    stage = StagePlan(name, len(pixels), megapixels)
+    stage.cpu_seconds = c['cpu_frame'] * len(pixels) + c['cpu_mpx'] * megapixels
+    stage.peak_memory = int(c['memory_frames'] * 4 * max(pixels) * min(workers, len(pixels)))
+    stage.disk_bytes = int(c['disk_px'] * np.sum(pixels)) + extra_disk
+
+    return stage
+
+
+def __output_shape(headers:list, resolution:float):
+    # the output frame of the solved stack, None if the lights have no celestial WCS
+    if not all(WCS(h).has_celestial for h in headers):
+        return None
+
+    try:
+        return tuple(combine.get_reprojection(headers, resolution).shape)
+    except Exception as e:
+        logging.debug(f'Could not plan output frame: {e}')
+        return None
+
+
+def coefficients_from_metrics(metrics_data:dict, megapixels:float) -> dict:
+    '''
+    Get per stage CPU coefficients measured in an earlier run, from its metrics (metrics.Metrics.to_dict
+    or the metrics.json written by Processor.write_metrics) and the frame size in megapixels. The
+    measured CPU time per frame is attributed to the frame size.
+    '''
+    coefficients = {}
+
+    for stage in metrics_data['stages']:
+        if stage['frames'] > 0 and stage['name'] in cost_coefficients:
+            coefficients[stage['name']] = {'cpu_frame': 0.0, 'cpu_mpx': stage['cpu'] / (stage['frames'] * megapixels)}
+
+    return coefficients
@@ -1,20 +1,33 @@
-from ccdproc import ImageFileCollection
+from ccdproc import CCDData, ImageFileCollection
 import logging
 import numpy as np
 from pathlib import Path
 
 from . import astrometry
+from . import cache
 from . import calibration
 from . import combine
 from . import conversion
+from . import distortion
+from . import drizzle
 from . import io
+from . import jobqueue
+from . import library
+from . import manifest
+from . import metrics
+from . import parallel
+from . import pipeline
+from . import planner
+from . import registration
 from . import standard
+from . import watch as watcher
 
 
 class Processor:
     lights_src:ImageFileCollection = None
     lights_calib:ImageFileCollection = None
     lights_solved:ImageFileCollection = None
+    lights_registered:ImageFileCollection = None
     lights_stacked:ImageFileCollection = None
 
     flats_src:ImageFileCollection = None
@@ -24,26 +37,44 @@ class Processor:
     light_src_path:Path = None
     light_calib_path:Path = None
     light_solved_path:Path = None
+    light_registered_path:Path = None
     light_stacked_path:Path = None
     flat_src_path:Path = None
     flat_calib_path:Path = None   
 
+    workers:int = None
+    queue:Path = None
 
-    def __init__(self, dest_path:Path):
+
+    def __init__(self, dest_path:Path, workers:int=None, queue:Path=None):
+        '''
+        Stages run across workers processes, None for all cores. Each stage's results are the same and
+        in the same order whatever the number of workers.
+
+        If queue is set, lights are calibrated and solved as jobs in the job queue at that path (see
+        jobqueue.py), run by workers on any machine sharing dest_path as well as workers local ones.
+        '''
         self.set_dest_path(dest_path)
+        self.workers = workers
+        self.queue = queue
 
 
     def set_dest_path(self, dest_path:Path, overwrite:bool=False):
-        if dest_path is not None and dest_path.exists() and overwrite:
+        '''
+        Set the directory stage outputs are written to. Existing stage outputs are kept and reused by
+        the stages where their inputs are unchanged, unless overwrite is set.
+        '''
+        if overwrite:
             io.mkdirs_rm_existing(dest_path)
         else:
-            io.mkdirs_rm_existing(dest_path)
+            io.mkdirs(dest_path)
 
         self.dest_path = dest_path
 
         self.light_src_path = self.dest_path / 'lights_source'
         self.light_calib_path = self.dest_path / 'lights_calibrated'
         self.light_solved_path = self.dest_path / 'lights_solved'
+        self.light_registered_path = self.dest_path / 'lights_registered'
         self.light_stacked_path = self.dest_path / 'lights_stacked'
 
         self.flat_src_path = self.dest_path / 'flats_src'
@@ -57,66 +88,78 @@ class Processor:
         # if path is the intended source path, don't copy - just get an ifc
         copy_files = dest_path.absolute() != self.light_src_path.absolute()
 
+        # stage outputs are kept, they are reused where their inputs are unchanged
         if copy_files:
-            self.clear_lights()
+            self.clear_lights(remove_files=False)
             io.mkdirs_rm_existing(self.light_src_path)
             self.lights_src = self.__get_ifc(path, ifc, self.light_src_path, filters)
         else:
             # don't clear the source lights
-            self.clear_lights(clear_src=False)
+            self.clear_lights(clear_src=False, remove_files=False)
             self.lights_src = self.__get_ifc(path, ifc, self.light_src_path, filters)
 
 
     def set_calibrated_lights(self, path:Path=None, ifc:ImageFileCollection=None, filters:dict=None):
-        self.clear_lights()
+        self.clear_lights(remove_files=False)
         io.mkdirs_rm_existing(self.light_calib_path)
         self.lights_calib = self.__get_ifc(path, ifc, self.light_calib_path, filters)
 
     
     def set_solved_lights(self, path:Path=None, ifc:ImageFileCollection=None, filters:dict=None):
-        self.clear_lights()
+        self.clear_lights(remove_files=False)
         io.mkdirs_rm_existing(self.light_solved_path)
         self.lights_solved = self.__get_ifc(path, ifc, self.light_solved_path, filters)
 
 
-    def clear_lights(self, clear_src:bool=True, clear_calib:bool=True, clear_solved:bool=True, clear_stacked:bool=True):
+    def clear_lights(self, clear_src:bool=True, clear_calib:bool=True, clear_solved:bool=True, clear_registered:bool=True, clear_stacked:bool=True,
+                     remove_files:bool=True):
         if clear_src:
             self.lights_src = None
-            io.rmdir(self.light_src_path)
+            if remove_files:
+                io.rmdir(self.light_src_path)
 
         if clear_calib:
             self.lights_calib = None
-            io.rmdir(self.light_calib_path)
+            if remove_files:
+                io.rmdir(self.light_calib_path)
         
         if clear_solved:
             self.lights_solved = None
-            io.rmdir(self.light_solved_path)
+            if remove_files:
+                io.rmdir(self.light_solved_path)
+
+        if clear_registered:
+            self.lights_registered = None
+            if remove_files:
+                io.rmdir(self.light_registered_path)
     
         if clear_stacked:
             self.lights_stacked = None
-            io.rmdir(self.light_stacked_path)
+            if remove_files:
+                io.rmdir(self.light_stacked_path)
 
 
     def set_source_flats(self, path:Path=None, ifc:ImageFileCollection=None, filters:dict=None):
-        self.clear_flats()
+        self.clear_flats(remove_files=False)
         io.mkdirs_rm_existing(self.flat_src_path)
 
         self.flats_src = self.__get_ifc(path, ifc, self.flat_src_path, filters)
 
 
     def set_calibrated_flats(self, path:Path=None, ifc:ImageFileCollection=None, filters:dict=None):
-        self.clear_flats()
+        self.clear_flats(remove_files=False)
         io.mkdirs_rm_existing(self.flat_calib_path)
 
         self.flats_calib = self.__get_ifc(path, ifc, self.flat_calib_path, filters)
         
 
-    def clear_flats(self):
+    def clear_flats(self, remove_files:bool=True):
         self.flats_src = None
         self.flats_calib = None
 
-        io.rmdir(self.flat_src_path)
-        io.rmdir(self.flat_calib_path)
+        if remove_files:
+            io.rmdir(self.flat_src_path)
+            io.rmdir(self.flat_calib_path)
 
 
     def __get_ifc(self, src_path:Path=None, ifc:ImageFileCollection=None, target_path:Path=None, filters:dict=None) -> ImageFileCollection:
@@ -132,41 +175,145 @@ class Processor:
         return ifc
     
 
+    @metrics.stage('calibrate_flats')
     def calibrate_flats(self):
+        '''
+        Create the flats of each filter from the source flats. Flats made from the same source flats and
+        library are reused.
+        '''
+        if self.flats_src is None:
+            raise ValueError('Must call set source flats before calibrate_flats')
+
+        params = {'min_exp': 1.5, 'reject_too_dark': False, 'ignore_temp': True}
+        src_keys = manifest.get_file_keys(self.flats_src.location, self.flats_src.files_filtered())
+        key = manifest.get_stage_key(sorted(src_keys.items()), library.get_library_key(), stage='flats', **params)
+
+        stage = manifest.StageManifest(self.flat_calib_path)
+        outputs = stage.outputs(key)
+
+        if outputs is not None:
+            logging.info(f'Reusing {len(outputs)} calibrated flats')
+            self.flats_calib = ImageFileCollection(self.flat_calib_path, filenames=outputs)
+            return
+
         logging.debug('Deleting existing flat calib dir if it exists')
         io.mkdirs_rm_existing(self.flat_calib_path)
 
-        if self.flats_src is None:
-            raise ValueError('Must call set source flats before calibrate_flats')
-        else:
-            self.flats_calib = standard.create_flats(self.flats_src, out_path=self.flat_calib_path, min_exp=1.5, reject_too_dark=False, ignore_temp=True, overwrite=True)
+        self.flats_calib = standard.create_flats(self.flats_src, out_path=self.flat_calib_path, overwrite=True, **params)
 
+        stage = manifest.StageManifest(self.flat_calib_path)
+        for fn in self.flats_calib.files:
+            stage.record(fn, key)
 
-    def calibrate_lights(self):
+
+    @metrics.stage('calibrate_lights')
+    def calibrate_lights(self, remove_cosmics:bool=False, workers:int=None):
         '''
         Calibrates the lights by applying bias, dark and flat field correction to each light image.
 
         If flats are to be used, they must be created first 
 
+        If remove_cosmics is set, cosmic rays are cleaned from each calibrated light.
+
+        Lights are calibrated across workers processes, the processor's workers if None. The masters
+        are loaded once and shared with the workers (see calibration.SharedMasters), unless the lights
+        are queued as jobs.
+
+        Lights already calibrated from the same source content, masters and parameters are reused.
+
         Returns:
             None
         '''
-        io.mkdirs_rm_existing(self.light_calib_path)
+        io.mkdirs(self.light_calib_path)
     
         if self.lights_src is not None:
+            stage = manifest.StageManifest(self.light_calib_path)
+            src_keys = manifest.get_file_keys(self.lights_src.location, self.lights_src.files_filtered())
+            # queued jobs select their masters again, so they're only shared with local workers
+            masters = calibration.SharedMasters(share=self.queue is None)
+
             calib_fns = []
+            tasks = []
+
+            try:
+                for header, src_fn in self.lights_src.headers(return_fname=True):
+                    names = masters.select(header, self.flats_calib)
+                    key = manifest.get_stage_key(src_keys[src_fn], [masters.key(name) for name in names],
+                                                 stage='calibrate', remove_cosmics=remove_cosmics)
+
+                    if not stage.is_valid(src_fn, key):
+                        tasks.append((str(Path(self.lights_src.location) / src_fn), str(self.light_calib_path / src_fn), names, remove_cosmics, key))
+
+                    calib_fns.append(src_fn)
+
+                logging.info(f'Calibrating {len(tasks)} lights, reusing {len(calib_fns) - len(tasks)}')
 
-            for src, src_fn in self.lights_src.ccds(return_fname=True):
-                print('foo')
-                calib_light = calibration.calibrate_light(src, self.flats_calib)
-                calib_light = conversion.to_float32(calib_light)
-                calib_light.write(self.light_calib_path / src_fn)
-                calib_fns.append(src_fn)
+                if self.queue is not None:
+                    flats = self.flats_calib
+                    args = [{'src': str(Path(src).absolute()), 'dest': str(Path(dest).absolute()), 'remove_cosmics': remove_cosmics,
+                             'flats': str(Path(flats.location).absolute()) if flats is not None else None,
+                             'flat_files': list(flats.files) if flats is not None else None} for src, dest, _, _, _ in tasks]
+
+                    for (_, dest, _, _, key), job in zip(tasks, self.__run_jobs('calibrate', args, workers)):
+                        if job.error is None:
+                            stage.record(Path(dest).name, key)
+                        else:
+                            calib_fns.remove(Path(dest).name)
+                else:
+                    # outputs are recorded in order as they finish, so an interrupted run keeps them
+                    for calib_fn, key, record in parallel.map_ordered(_calibrate_light, tasks, self.__workers(workers),
+                                                                      initializer=_init_calibrate_worker, initargs=(masters.specs(),)):
+                        stage.record(calib_fn, key)
+                        metrics.add_frame(record)
+            finally:
+                masters.unlink()
+
+            stage.prune(calib_fns)
+            cache.prune()
 
             self.lights_calib = ImageFileCollection(self.light_calib_path, filenames=calib_fns)
 
-    def stack_lights(self, resolution:float=1.0):
-        io.mkdirs_rm_existing(self.light_stacked_path)
+    def __workers(self, workers:int) -> int:
+        return workers if workers is not None else self.workers
+
+    def __run_jobs(self, kind:str, args:list, workers:int) -> list:
+        # run tasks as jobs in the queue, with local workers alongside those of other machines
+        jobs = jobqueue.map_jobs(self.queue, kind, args, local_workers=self.__workers(workers))
+
+        for job in jobs:
+            if job.error is not None:
+                logging.warning(f'Could not {job.kind} \'{Path(job.args["src"]).name}\': {job.error}')
+
+        return jobs
+
+    @metrics.stage('stack_lights')
+    def stack_lights(self, resolution:float=1.0, tile_size:int=1024, workers:int=None, rejection:str=None, mapping_error:float=None,
+                     method:str='interpolate', drizzle_scale:float=2.0, pixfrac:float=0.8):
+        '''
+        Stack the most processed lights available, per filter.
+
+        Solved lights are combined on a common output frame at resolution arcsec/px. Without rejection they
+        are coadded tile by tile, otherwise they are reprojected and combined with per-pixel rejection
+        (see stack.rejection_methods). Setting mapping_error (pixels) coadds with cached pixel mappings.
+
+        With method 'drizzle', solved lights are drizzled instead onto a frame drizzle_scale times finer than
+        the finest light, with drops pixfrac the size of the input pixels. resolution and rejection don't apply.
+
+        Registered lights are already on a common pixel grid and are combined directly, with sigma clipping
+        if rejection isn't set.
+
+        A filter's stack is reused if its lights and the stacking parameters are unchanged.
+        '''
+        if method not in ['interpolate', 'drizzle']:
+            raise ValueError(f'Unknown stacking method \'{method}\', expected \'interpolate\' or \'drizzle\'')
+
+        if method == 'drizzle' and rejection is not None:
+            raise ValueError('Rejection is not supported when drizzling')
+
+        io.mkdirs(self.light_stacked_path)
+        stage = manifest.StageManifest(self.light_stacked_path)
+        params = {'resolution': resolution, 'tile_size': tile_size, 'rejection': rejection, 'mapping_error': mapping_error,
+                  'method': method, 'drizzle_scale': drizzle_scale, 'pixfrac': pixfrac}
         
         images = None
         reprojection = None
@@ -176,7 +323,14 @@ class Processor:
         if self.lights_solved is not None:
             logging.info('Stacking solved lights')
             images = self.lights_solved
-            reprojection = combine.get_reprojection(images, resolution)
+
+            if method == 'drizzle':
+                reprojection = drizzle.get_reprojection(images, drizzle_scale)
+            else:
+                reprojection = combine.get_reprojection(images, resolution)
+        elif self.lights_registered is not None:
+            logging.info('Stacking registered lights')
+            images = self.lights_registered
         elif self.lights_calib is not None:
             logging.info('Stacking calibrated lights')
             images = self.lights_calib
@@ -189,31 +343,109 @@ class Processor:
         if images is not None:
             # get all optical filters from keywords
             filters = set(h['filter'] for h in images.headers())
+            image_keys = manifest.get_file_keys(images.location, images.files_filtered())
 
             # for each filter
             for filter in filters:
                 # get all images for that filter
                 filter_images = images.filter(filter=filter)
 
+                fn = f'{filter}.fits'
+                key = manifest.get_stage_key(sorted((Path(f).name, image_keys[Path(f).name]) for f in filter_images.files_filtered()), stage='stack',
+                                             aligned=images.location, **params)
+
+                if stage.is_valid(fn, key):
+                    logging.info(f'Reusing stack of filter {filter}')
+                    stacked_images.append(fn)
+                    continue
+
                 ccd = None
 
-                if reprojection is not None:
-                    ccd = combine.combine_solved_images(filter_images, reprojection)
+                # disk backed working arrays for the tiled coadd
+                work_path = self.light_stacked_path / f'{filter}.work'
+
+                if reprojection is not None and method == 'drizzle':
+                    ccd = combine.drizzle_solved_images(filter_images, reprojection, pixfrac=pixfrac, tile_size=tile_size, workers=self.__workers(workers),
+                                                        out_path=work_path)
+                elif reprojection is not None and rejection is not None:
+                    io.mkdirs(work_path)
+                    aligned = combine.reproject_images(filter_images, reprojection, work_path, workers=self.__workers(workers))
+                    ccd = combine.combine_images(aligned, method=rejection)
+                elif reprojection is not None:
+                    ccd = combine.combine_solved_images(filter_images, reprojection, tile_size=tile_size, workers=self.__workers(workers), out_path=work_path,
+                                                       mapping_error=mapping_error)
                 else:
-                    ccd = combine.combine_solved_images(filter_images) 
+                    ccd = combine.combine_images(filter_images, method=rejection if rejection is not None else 'sigma_clip')
 
                 if ccd is not None:
-                    fn = self.light_stacked_path / f'{filter}.fits'
-                    ccd = conversion.to_float32(ccd)
-                    ccd.write(fn)
+                    # without a copy, so a memmap backed coadd is written from disk rather than loaded
+                    ccd = conversion.to_type(ccd, np.float32, copy=False)
+                    ccd.meta.pop('wgtfile', None)
+                    ccd.write(self.light_stacked_path / fn, overwrite=True)
+                    stage.record(fn, key)
                     stacked_images.append(fn)
 
+                ccd = None
+                io.rmdir(work_path)
+
+        stage.prune(stacked_images)
+        cache.prune()
         self.lights_stacked = ImageFileCollection(location=self.light_stacked_path, filenames=stacked_images)
 
         return self.lights_stacked
 
-    def solve_astrometry(self):
-        io.mkdirs_rm_existing(self.light_solved_path)
+    @metrics.stage('register_lights')
+    def register_lights(self, reference:str=None, model:str='similarity', workers:int=None):
+        '''
+        Register the lights onto the pixel grid of a reference light by matching star patterns, without
+        plate solving. All filters are registered to the same reference. See registration.register_images.
+
+        The registered lights are reused if the lights and parameters are unchanged.
+        '''
+        if self.lights_calib is not None:
+            logging.info('Registering calibrated lights')
+            lights = self.lights_calib
+        elif self.lights_src is not None:
+            logging.info('Registering source lights')
+            lights = self.lights_src
+        else:
+            raise ValueError('Must have lights to register')
+
+        keys = manifest.get_file_keys(lights.location, lights.files_filtered())
+        key = manifest.get_stage_key(sorted(keys.items()), stage='register', reference=reference, model=model)
+
+        outputs = manifest.StageManifest(self.light_registered_path).outputs(key)
+        if outputs is not None:
+            logging.info(f'Reusing {len(outputs)} registered lights')
+            self.lights_registered = ImageFileCollection(location=self.light_registered_path, filenames=outputs)
+            return self.lights_registered
+
+        io.mkdirs_rm_existing(self.light_registered_path)
+        self.lights_registered = registration.register_images(lights, self.light_registered_path, reference=reference, model=model,
+                                                         workers=self.__workers(workers))
+
+        stage = manifest.StageManifest(self.light_registered_path)
+        for fn in self.lights_registered.files:
+            stage.record(fn, key)
+
+        cache.prune()
+
+        return self.lights_registered
+
+    @metrics.stage('solve_astrometry')
+    def solve_astrometry(self, workers:int=None, sequence:bool=True):
+        '''
+        Solve the WCS of each light across workers processes, the processor's workers if None. Lights
+        already solved from the same content are reused, so an interrupted solve continues from where
+        it stopped.
+
+        If sequence is set, lights of the same object and filter are solved in order of observation in
+        a run per worker, each seeded with the WCS of the light before, so only the first light of each
+        run is solved blind (see astrometry.solve_wcs). Runs are solved in chunks of solve_chunk_size
+        lights, each seeded with the last WCS of the chunk before, and lights are recorded as their chunk
+        finishes, so an interrupted solve only redoes the unfinished chunks.
+        '''
+        io.mkdirs(self.light_solved_path)
 
         if self.lights_calib is not None:
             logging.info('Solving astrometry for calibrated lights')
@@ -224,34 +456,266 @@ class Processor:
         else:
             raise ValueError('Must have lights to solve')
         
-        solved_images = []
+        stage = manifest.StageManifest(self.light_solved_path)
+        keys = manifest.get_file_keys(lights.location, lights.files_filtered())
+        keys = {fn: manifest.get_stage_key(k, stage='solve') for fn, k in keys.items()}
 
-        for light, light_fn in lights.ccds(return_fname=True):
-            logging.info(f'Solving \'{light_fn}\'')
-            light_dest = self.light_solved_path / light_fn
+        solved_images = list(keys)
+        pending = [fn for fn in solved_images if not stage.is_valid(fn, keys[fn])]
+        logging.info(f'Solving {len(pending)} lights, reusing {len(solved_images) - len(pending)}')
 
-            solved_image = astrometry.solve_wcs(light, light_dest)
-            solved_images.append(light_fn)
-        
+        tasks = [(str(Path(lights.location) / fn), str(self.light_solved_path / fn)) for fn in pending]
+
+        if self.queue is not None:
+            args = [{'src': str(Path(src).absolute()), 'dest': str(Path(dest).absolute())} for src, dest in tasks]
+
+            for light_fn, job in zip(pending, self.__run_jobs('solve', args, workers)):
+                if job.error is None:
+                    stage.record(light_fn, keys[light_fn])
+                else:
+                    solved_images.remove(light_fn)
+        else:
+            workers = self.__workers(workers)
+            runs = _get_sequences(tasks, parallel.get_worker_count(workers)) if sequence else [[task] for task in tasks]
+
+            seeds = [None] * len(runs)
+            for start in range(0, max((len(run) for run in runs), default=0), solve_chunk_size):
+                active = [i for i, run in enumerate(runs) if start < len(run)]
+                chunks = [(runs[i][start:start + solve_chunk_size], seeds[i]) for i in active]
+
+                for i, (records, seed) in zip(active, parallel.map_ordered(_solve_sequence, chunks, workers)):
+                    seeds[i] = seed
+
+                    for light_fn, record in records:
+                        stage.record(light_fn, keys[light_fn])
+                        metrics.add_frame(record)
+
+        stage.prune(solved_images)
+        cache.prune()
         self.lights_solved = ImageFileCollection(location=self.light_solved_path, filenames=solved_images)
 
+    @metrics.stage('fit_distortion')
+    def fit_distortion(self, order:int=3, min_frames:int=5) -> list:
+        '''
+        Fit the distortion model of each optical setup from the solved lights and save it to the
+        library, so later solves of that setup only fit the linear WCS (see distortion.py). Returns the
+        paths of the saved models.
+        '''
+        if self.lights_solved is None:
+            raise ValueError('Must have solved lights to fit distortion')
+
+        paths = [Path(self.lights_solved.location) / fn for fn in self.lights_solved.files_filtered()]
+        return distortion.fit_frames(paths, order=order, min_frames=min_frames)
 
-    def summary(self):
+
+    def summary(self) -> str:
+        '''
+        Log the image collections of each stage and the time, IO and memory used by the stages run (see
+        metrics.py). Returns the stage summary.
+        '''
         self.__log_ifc(self.lights_src, 'lights_src')
         self.__log_ifc(self.lights_calib, 'lights_calib')
         self.__log_ifc(self.lights_solved, 'lights_solved')
+        self.__log_ifc(self.lights_registered, 'lights_registered')
         self.__log_ifc(self.lights_stacked, 'lights_stacked')
         self.__log_ifc(self.flats_src, 'flats_src')
         self.__log_ifc(self.flats_calib, 'flats_calib')
 
+        summary = metrics.metrics.summary()
+        logging.info(f'Stage metrics:\n{summary}')
+
+        return summary
+
+    def write_metrics(self, path:Path=None):
+        '''
+        Write the stage and frame metrics as metrics.json and metrics.csv in path, dest_path if None.
+        '''
+        path = Path(path) if path is not None else self.dest_path
+        io.mkdirs(path)
+
+        metrics.metrics.write_json(path / 'metrics.json')
+        metrics.metrics.write_csv(path / 'metrics.csv')
+
     def __log_ifc(self, ifc:ImageFileCollection, name:str):
         if ifc is not None:
             logging.info(f'{name} collection {str(ifc.location)} has {len(ifc.files)} images\nSummary:\n{ifc.summary}')
         else:
             logging.info(f'{name} collection is None')
 
-    def process(self):
+    @metrics.stage('stream_lights')
+    def stream_lights(self, resolution:float=None, margin:float=0.25, workers:int=None, remove_cosmics:bool=False, checkpoint:bool=False):
+        '''
+        Calibrate, solve and stack the source lights one frame at a time, without writing the stages to
+        disk in between. Each light is stacked per filter as soon as it is done, onto an output frame
+        planned from the first light and padded by margin. See pipeline.stream_lights.
+
+        If checkpoint is set, calibrated and solved lights are also written to their stage directories.
+        '''
+        if self.lights_src is None:
+            raise ValueError('Must have source lights to stream')
+
+        calib_path, solved_path = None, None
+        if checkpoint:
+            calib_path, solved_path = self.light_calib_path, self.light_solved_path
+            io.mkdirs(calib_path)
+            io.mkdirs(solved_path)
+
+        stacks = pipeline.stream_lights(self.lights_src, self.flats_calib, res_arcsec=resolution, margin=margin, workers=self.__workers(workers),
+                                        remove_cosmics=remove_cosmics, calib_path=calib_path, solved_path=solved_path)
+
+        io.mkdirs(self.light_stacked_path)
+        stacked_images = []
+
+        for filter, stack in stacks.items():
+            fn = f'{filter}.fits'
+            stack.result().write(self.light_stacked_path / fn, overwrite=True)
+            stacked_images.append(fn)
+
+        if checkpoint:
+            self.lights_calib = ImageFileCollection(calib_path)
+            self.lights_solved = ImageFileCollection(solved_path)
+
+        cache.prune()
+        self.lights_stacked = ImageFileCollection(location=self.light_stacked_path, filenames=stacked_images)
+
+        return self.lights_stacked
+
+    def watch(self, capture_path:Path, register:bool=False, resolution:float=None, margin:float=0.25, remove_cosmics:bool=False,
+              interval:float=1.0, settle:float=2.0, idle_timeout:float=None, backend:str='auto', include_existing:bool=True) -> ImageFileCollection:
+        '''
+        Process lights as they are captured to capture_path, until interrupted or idle for idle_timeout
+        seconds. Each new light is sanitized, calibrated, solved (or registered to the first light if
+        register is set) and added to the running stack of its filter, which is written to the stacked
+        lights within seconds of the light arriving. See watch.watch_lights.
+
+        Calibrated flats are used if set, otherwise the library flats.
+        '''
+        watcher.watch_lights(self, capture_path, register=register, interval=interval, settle=settle, backend=backend,
+                             include_existing=include_existing, idle_timeout=idle_timeout, resolution=resolution, margin=margin,
+                             remove_cosmics=remove_cosmics)
+
+        return self.lights_stacked
+
+    def plan(self, register:bool=False, remove_cosmics:bool=False, resolution:float=1.0, workers:int=None, coefficients:dict=None) -> planner.Plan:
+        '''
+        Plan a process() run from the headers of the source lights and flats without processing anything:
+        the groups of lights with their masters (and any missing), the frames of each stage, the output
+        sizes and an estimate of the CPU time, peak memory and disk space. See planner.plan.
+        '''
+        if self.lights_src is None:
+            raise ValueError('Must have source lights to plan')
+
+        result = planner.plan(self.lights_src, self.flats_src, self.flats_calib, register=register, remove_cosmics=remove_cosmics,
+                              resolution=resolution, workers=self.__workers(workers), coefficients=coefficients)
+        logging.info(f'Plan:\n{result.summary()}')
+
+        return result
+
+    def resume(self, remove_cosmics:bool=False, register:bool=False):
+        '''
+        Continue an interrupted process() run in dest_path. Source lights and flats are loaded from
+        dest_path if they aren't set, and every stage reuses the outputs recorded in its manifest
+        whose inputs are unchanged, so only unfinished work is done.
+        '''
+        if self.lights_src is None:
+            if not self.light_src_path.exists():
+                raise ValueError(f'No source lights to resume from in {self.dest_path}')
+            self.lights_src = ImageFileCollection(self.light_src_path)
+
+        if self.flats_src is None and self.flat_src_path.exists():
+            self.flats_src = ImageFileCollection(self.flat_src_path)
+
+        self.process(remove_cosmics=remove_cosmics, register=register)
+
+    def process(self, remove_cosmics:bool=False, register:bool=False, streaming:bool=False, checkpoint:bool=False, workers:int=None):
+        '''
+        Calibrate, align and stack the lights. Lights are plate solved, or registered to each other by
+        their star patterns if register is set, which needs no network access.
+
+        Each stage runs across workers processes, the processor's workers if None. If streaming is set,
+        each light is calibrated, solved and stacked in turn instead of running each stage over all lights
+        (see stream_lights), and the calibrated and solved lights are only written if checkpoint is set.
+        '''
         self.calibrate_flats()
-        self.calibrate_lights()
-        self.solve_astrometry()
-        self.stack_lights()
+
+        if streaming:
+            if register:
+                raise ValueError('Registration is not supported when streaming')
+
+            self.stream_lights(workers=workers, remove_cosmics=remove_cosmics, checkpoint=checkpoint)
+            return
+
+        self.calibrate_lights(remove_cosmics=remove_cosmics, workers=workers)
+
+        if register:
+            self.register_lights(workers=workers)
+        else:
+            self.solve_astrometry(workers=workers)
+
+        self.stack_lights(workers=workers)
+
+
+# lights of a sequence solved per pool task, the most lights an interrupted solve redoes per run
+solve_chunk_size = 8
+
+__worker = {}
+
+
+def _init_calibrate_worker(master_specs:dict):
+    __worker['masters'], __worker['shared'] = calibration.SharedMasters.attach(master_specs)
+
+
+def _calibrate_light(task):
+    src_path, dest_path, (bias, dark, flat), remove_cosmics, key = task
+    masters = __worker['masters']
+
+    with metrics.measure_frame(Path(src_path).name, 'calibrate_lights') as record:
+        light = CCDData.read(src_path, unit='adu')
+
+        # lights are already spread over the workers, cosmic ray tiles are cleaned in the same process
+        calib_light = calibration.calibrate_light(light, masters.get(flat), masters.get(bias), masters.get(dark), remove_cosmics=remove_cosmics,
+                                                  workers=1)
+        calib_light = conversion.to_float32(calib_light)
+        calib_light.write(dest_path, overwrite=True)
+
+    return Path(dest_path).name, key, record
+
+
+def _get_sequences(tasks:list, runs:int) -> list:
+    # group lights by object and filter in order of observation, and split each group into up to
+    # runs contiguous runs
+    from astropy.io import fits
+
+    groups = {}
+    for task in tasks:
+        header = fits.getheader(task[0])
+        groups.setdefault((str(header.get('object')), str(header.get('filter'))), []).append((str(header.get('date-obs', '')), task))
+
+    sequences = []
+    for group in groups.values():
+        group = [task for _, task in sorted(group)]
+        size = -(-len(group) // runs)
+        sequences.extend(group[i:i + size] for i in range(0, len(group), size))
+
+    return sequences
+
+
+def _solve_sequence(chunk):
+    # solve a chunk of a run in order, seeded with the header of the last WCS of the chunk before, and
+    # return the header of the last WCS of this chunk to seed the next
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    tasks, seed = chunk
+    seed = WCS(fits.Header.fromstring(seed)) if seed is not None else None
+    records = []
+
+    for src_path, dest_path in tasks:
+        logging.info(f'Solving \'{Path(src_path).name}\'')
+
+        with metrics.measure_frame(Path(src_path).name, 'solve_astrometry') as record:
+            seed = astrometry.solve_wcs(CCDData.read(src_path, unit='adu'), Path(dest_path), seed=seed).wcs
+
+        records.append((Path(dest_path).name, record))
+
+    return records, seed.to_header(relax=True).tostring()
@@ -0,0 +1,375 @@
+'''
+Align frames of the same target by matching star patterns, without plate solving.
+
+The brightest stars of each frame are grouped into triangles of near neighbours. Triangle shapes
+are described by the ratios of their sides, which don't change with translation, rotation or
+scale, so triangles are matched between frames with a KD-tree on those ratios. The point pairs of
+the matched triangles are then fit with RANSAC to get a similarity or affine transform to the
+reference frame, and the frame is warped onto the reference pixel grid directly.
+'''
+
+from astropy.io import fits
+from ccdproc import CCDData, ImageFileCollection
+from itertools import combinations
+import logging
+import numpy as np
+from pathlib import Path
+
+from abberition import background, parallel, wcs_helpers
+
+
+transform_models = ['similarity', 'affine']
+
+
+def detect_stars(data:np.ndarray, n_stars:int=50, threshold:float=5.0, mask:np.ndarray=None, bkg:background.Background=None) -> np.ndarray:
+    '''
+    Get the positions of the brightest stars of an image, brightest first.
+
+    Stars are local maxima at least threshold background standard deviations above the background,
+    centroided over their 5x5 neighbourhood. Single pixel peaks (hot pixels, cosmic rays) are ignored.
+
+    Returns
+    -------
+    ndarray
+        (x, y) pixel positions, shape (n, 2) with n <= n_stars.
+    '''
+    from scipy.ndimage import maximum_filter
+
+    data = np.asarray(data, dtype=np.float32)
+    if bkg is None:
+        bkg = background.get_background(data, mask=mask)
+
+    residual = data - bkg.median
+    if mask is not None:
+        residual[mask] = 0.0
+    residual[~np.isfinite(residual)] = 0.0
+
+    level = threshold * bkg.std
+    above = residual > level
+
+    # local maxima away from the border, so their 5x5 neighbourhoods are inside the image
+    peaks = above & (residual == maximum_filter(residual, size=5, mode='constant'))
+    peaks[:2, :] = peaks[-2:, :] = False
+    peaks[:, :2] = peaks[:, -2:] = False
+
+    y, x = np.nonzero(peaks)
+    offsets = [(dy, dx) for dy in range(-2, 3) for dx in range(-2, 3)]
+    window = np.array([residual[y + dy, x + dx] for dy, dx in offsets])
+
+    # real stars have neighbours above the threshold too
+    keep = np.sum(window > level, axis=0) >= 3
+    y, x, window = y[keep], x[keep], window[:, keep]
+
+    flux = np.sum(np.maximum(window, 0.0), axis=0)
+    order = np.argsort(flux)[::-1][:n_stars]
+
+    dy = np.array([o[0] for o in offsets])[:, None]
+    dx = np.array([o[1] for o in offsets])[:, None]
+    w = np.maximum(window[:, order], 0.0)
+    cx = x[order] + np.sum(w * dx, axis=0) / flux[order]
+    cy = y[order] + np.sum(w * dy, axis=0) / flux[order]
+
+    return np.column_stack([cx, cy])
+
+
+def get_triangles(points:np.ndarray, neighbours:int=5):
+    '''
+    Get the triangles formed by each star and its nearest neighbours, with their invariants.
+
+    Vertices of each triangle are ordered by the length of their opposite side, shortest first, so
+    matched triangles give matched vertices.
+
+    Returns
+    -------
+    invariants : ndarray
+        (longest / middle, middle / shortest) side ratios, shape (m, 2).
+
+    triangles : ndarray
+        Ordered vertex indices into points, shape (m, 3).
+    '''
+    from scipy.spatial import cKDTree
+
+    if len(points) < 3:
+        return np.empty((0, 2)), np.empty((0, 3), dtype=np.int64)
+
+    k = min(neighbours + 1, len(points))
+    _, nearest = cKDTree(points).query(points, k=k)
+
+    triangles = set()
+    for group in nearest:
+        for tri in combinations(sorted(group), 3):
+            triangles.add(tri)
+
+    triangles = np.array(sorted(triangles), dtype=np.int64)
+    p = points[triangles]
+
+    # side i is opposite vertex i
+    sides = np.stack([
+        np.hypot(*(p[:, 1] - p[:, 2]).T),
+        np.hypot(*(p[:, 0] - p[:, 2]).T),
+        np.hypot(*(p[:, 0] - p[:, 1]).T)], axis=1)
+
+    order = np.argsort(sides, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    triangles = np.take_along_axis(triangles, order, axis=1)
+
+    valid = sides[:, 0] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        invariants = np.column_stack([sides[:, 2] / sides[:, 1], sides[:, 1] / sides[:, 0]])
+
+    return invariants[valid], triangles[valid]
+
+
+def match_triangles(source:np.ndarray, target:np.ndarray, tolerance:float=0.02, neighbours:int=5):
+    '''
+    Match the triangles of source and target stars with the nearest invariants within tolerance.
+
+    Returns
+    -------
+    source_triangles, target_triangles : ndarray
+        Matched triangles as ordered vertex indices, shape (m, 3) each. May contain false matches.
+    '''
+    from scipy.spatial import cKDTree
+
+    src_inv, src_tri = get_triangles(source, neighbours)
+    tgt_inv, tgt_tri = get_triangles(target, neighbours)
+
+    if len(src_inv) == 0 or len(tgt_inv) == 0:
+        return np.empty((0, 3), dtype=np.int64), np.empty((0, 3), dtype=np.int64)
+
+    dist, idx = cKDTree(tgt_inv).query(src_inv, distance_upper_bound=tolerance)
+    matched = np.isfinite(dist)
+
+    return src_tri[matched], tgt_tri[idx[matched]]
+
+
+def find_transform(source:np.ndarray, target:np.ndarray, model:str='similarity', tolerance:float=0.02, residual_threshold:float=2.0,
+                   min_matches:int=5):
+    '''
+    Find the transform from source to target star positions.
+
+    Every matched triangle gives a candidate transform. As in RANSAC, the candidate consistent with
+    the most star pairs of all matched triangles is kept, then refit on those pairs. All candidates
+    are scored at once rather than sampled, as most triangle matches are false when frames only
+    partly overlap.
+
+    Parameters
+    ----------
+    source, target : ndarray
+        (x, y) star positions, brightest first.
+
+    model : str
+        'similarity' (shift, rotation and scale) or 'affine'.
+
+    tolerance : float
+        Maximum distance between matched triangle invariants.
+
+    residual_threshold : float
+        Maximum distance in pixels of a transformed source star from its target star to count as an inlier.
+
+    min_matches : int
+        Minimum number of inliers for the transform to be accepted.
+
+    Returns
+    -------
+    transform : skimage.transform.ProjectiveTransform
+        SimilarityTransform or AffineTransform mapping source (x, y) to target (x, y).
+
+    inliers : ndarray
+        Pairs of (source index, target index) consistent with the transform.
+    '''
+    from skimage.transform import AffineTransform, SimilarityTransform
+
+    if model not in transform_models:
+        raise ValueError(f'Unknown transform model \'{model}\', expected one of {transform_models}')
+
+    src_tri, tgt_tri = match_triangles(source, target, tolerance)
+    pairs = np.unique(np.stack([src_tri.ravel(), tgt_tri.ravel()], axis=1), axis=0)
+
+    if len(pairs) < min_matches:
+        raise ValueError(f'Only {len(pairs)} candidate star matches, need at least {min_matches}')
+
+    # score the transform of every matched triangle against all candidate pairs
+    candidates = fit_transforms(source[src_tri], target[tgt_tri], model)
+    residuals = __residuals(candidates, source[pairs[:, 0]], target[pairs[:, 1]])
+    best = np.argmax(np.sum(residuals < residual_threshold, axis=1))
+    params = candidates[best]
+
+    for _ in range(3):
+        residual = __residuals(params[None], source[pairs[:, 0]], target[pairs[:, 1]])[0]
+        inliers = __unique_pairs(pairs[residual < residual_threshold], residual[residual < residual_threshold])
+
+        if len(inliers) < min_matches:
+            raise ValueError(f'Only {len(inliers)} stars consistent with a transform, need at least {min_matches}')
+
+        params = fit_transforms(source[inliers[:, 0]][None], target[inliers[:, 1]][None], model)[0]
+
+    model_class = SimilarityTransform if model == 'similarity' else AffineTransform
+
+    return model_class(matrix=params), inliers
+
+
+def fit_transforms(source:np.ndarray, target:np.ndarray, model:str='similarity') -> np.ndarray:
+    '''
+    Least squares fit of a batch of transforms from source to target points.
+
+    Parameters
+    ----------
+    source, target : ndarray
+        (x, y) points, shape (batch, points, 2).
+
+    Returns
+    -------
+    ndarray
+        Homogeneous transform matrices, shape (batch, 3, 3).
+    '''
+    batch, count = source.shape[:2]
+    x, y = source[..., 0], source[..., 1]
+    ones, zeros = np.ones_like(x), np.zeros_like(x)
+    params = np.zeros((batch, 3, 3))
+    params[:, 2, 2] = 1.0
+
+    if model == 'similarity':
+        # x' = a x - b y + tx, y' = b x + a y + ty
+        design = np.concatenate([np.stack([x, -y, ones, zeros], axis=-1), np.stack([y, x, zeros, ones], axis=-1)], axis=1)
+        rhs = np.concatenate([target[..., 0], target[..., 1]], axis=1)
+        a, b, tx, ty = np.moveaxis(np.linalg.pinv(design) @ rhs[..., None], 1, 0)[..., 0]
+        params[:, 0] = np.stack([a, -b, tx], axis=-1)
+        params[:, 1] = np.stack([b, a, ty], axis=-1)
+    elif model == 'affine':
+        design = np.stack([x, y, ones], axis=-1)
+        params[:, :2] = np.swapaxes(np.linalg.pinv(design) @ target, 1, 2)
+    else:
+        raise ValueError(f'Unknown transform model \'{model}\', expected one of {transform_models}')
+
+    return params
+
+
+def __residuals(params:np.ndarray, source:np.ndarray, target:np.ndarray) -> np.ndarray:
+    # distance of each transformed source point from its target for each transform, shape (transforms, points)
+    moved = source @ np.swapaxes(params[:, :2, :2], 1, 2) + params[:, None, :2, 2]
+    return np.hypot(*np.moveaxis(moved - target[None], -1, 0))
+
+
+def __unique_pairs(pairs:np.ndarray, residual:np.ndarray) -> np.ndarray:
+    # a star can only match once, keep the best fitting pair of any duplicates
+    order = np.argsort(residual)
+    pairs = pairs[order]
+    _, first = np.unique(pairs[:, 0], return_index=True)
+    pairs = pairs[np.sort(first)]
+    _, first = np.unique(pairs[:, 1], return_index=True)
+
+    return pairs[np.sort(first)]
+
+
+def warp(data:np.ndarray, transform, shape=None, order:int=1, cval:float=np.nan) -> np.ndarray:
+    '''
+    Warp an image onto the target pixel grid of a transform from image (x, y) to target (x, y).
+    '''
+    from scipy.ndimage import affine_transform
+
+    shape = data.shape if shape is None else tuple(shape)
+
+    # affine_transform maps output (row, col) to input (row, col)
+    swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float64)
+    inverse = swap @ np.linalg.inv(transform.params) @ swap
+
+    return affine_transform(np.asarray(data, dtype=np.float32), inverse[:2, :2], offset=inverse[:2, 2], output_shape=shape,
+                            order=order, mode='constant', cval=cval)
+
+
+def register_images(ifc:ImageFileCollection, dest_path:Path, reference:str=None, model:str='similarity', n_stars:int=50,
+                    workers:int=None) -> ImageFileCollection:
+    '''
+    Register images of the same target onto the pixel grid of a reference image.
+
+    Parameters
+    ----------
+    ifc : ImageFileCollection
+        Images to register.
+
+    dest_path : Path
+        Directory the registered images are written to, with the same filenames.
+
+    reference : str
+        Filename of the reference image in ifc, the first image if None.
+
+    model : str
+        Transform model, one of transform_models.
+
+    n_stars : int
+        Number of the brightest stars of each image used for matching.
+
+    workers : int
+        Number of worker processes, None for all cores.
+
+    Returns
+    -------
+    ImageFileCollection
+        The registered images. Images that couldn't be registered are logged and left out.
+    '''
+    files = list(ifc.files_filtered())
+    if len(files) == 0:
+        raise ValueError('No images to register')
+
+    reference = files[0] if reference is None else reference
+    reference_path = Path(ifc.location) / reference
+    reference_header = fits.getheader(reference_path)
+
+    with fits.open(reference_path) as hdus:
+        reference_stars = detect_stars(hdus[0].data, n_stars)
+
+    logging.info(f'Registering {len(files)} images to \'{reference}\' using {len(reference_stars)} stars')
+
+    shape = (reference_header['naxis2'], reference_header['naxis1'])
+    tasks = [(str(Path(ifc.location) / fn), str(Path(dest_path) / fn), reference, reference_stars, shape, model, n_stars) for fn in files]
+
+    registered = []
+    for fn, result in zip(files, parallel.map_ordered(_register_file, tasks, workers)):
+        if isinstance(result, str):
+            logging.warning(f'Could not register \'{fn}\': {result}')
+        else:
+            logging.debug(f'Registered \'{fn}\' with {result} stars')
+            registered.append(fn)
+
+    return ImageFileCollection(location=dest_path, filenames=registered)
+
+
+def register_image(ccd:CCDData, reference:str, reference_stars:np.ndarray, shape, model:str='similarity', n_stars:int=50) -> CCDData:
+    '''
+    Register an image onto the pixel grid of shape (rows, cols) of a reference image, given the reference
+    filename and its stars from detect_stars. Raises ValueError if the image can't be matched.
+    '''
+    mask = ccd.mask if ccd.mask is not None and ccd.mask.any() else None
+
+    stars = detect_stars(ccd.data, n_stars, mask=mask)
+    transform, inliers = find_transform(stars, reference_stars, model)
+
+    data = warp(ccd.data, transform, shape)
+    new_mask = ~np.isfinite(data)
+    if mask is not None:
+        new_mask |= warp(mask.astype(np.float32), transform, shape, order=0, cval=1.0) > 0
+
+    residuals = np.hypot(*(transform(stars[inliers[:, 0]]) - reference_stars[inliers[:, 1]]).T)
+
+    header = fits.Header(ccd.meta)
+    # the frame's own WCS no longer applies to the warped pixels
+    wcs_helpers.remove_wcs_header(header)
+    header['regref'] = (reference, 'Registration reference image')
+    header['regnstar'] = (len(inliers), 'Stars used for registration')
+    header['regrms'] = (float(np.sqrt(np.mean(residuals ** 2))), '[px] Registration residual rms')
+
+    return CCDData(data, unit=ccd.unit, meta=header, mask=new_mask)
+
+
+def _register_file(task):
+    path, dest, reference, reference_stars, shape, model, n_stars = task
+
+    try:
+        registered = register_image(CCDData.read(path, unit='adu'), reference, reference_stars, shape, model, n_stars)
+    except ValueError as e:
+        return str(e)
+
+    registered.write(dest, overwrite=True)
+
+    return registered.meta['regnstar']
@@ -0,0 +1,53 @@
+# numpy arrays in shared memory, to pass image data between processes without pickling it
+
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArray:
+    '''
+    A numpy array backed by a block of shared memory.
+
+    Create one with SharedArray.create, pass its spec() to another process and open it there
+    with SharedArray.attach. The creating process must unlink() it once no longer needed.
+    '''
+
+    def __init__(self, shm:shared_memory.SharedMemory, shape, dtype, owner:bool):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype=np.float32):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        return cls(shm, shape, dtype, True)
+
+    @classmethod
+    def from_array(cls, data:np.ndarray):
+        shared = cls.create(data.shape, data.dtype)
+        shared.array[...] = data
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, dtype, False)
+
+    def spec(self):
+        '''
+        Picklable (name, shape, dtype) description used to attach to the array from another process.
+        '''
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
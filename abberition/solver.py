@@ -0,0 +1,575 @@
+'''
+Offline blind plate solving with a local index of star quads.
+
+An index is built once from a catalog. The sky is covered by overlapping fields, and quads of four
+bright stars of each field are described by a geometric hash code. The two stars of a quad furthest
+apart (A, B) define a frame in which A is at (0, 0) and B at (1, 1), and the positions of the other
+two stars (C, D) in that frame are the code, which doesn't change with translation, rotation or
+scale. Only quads whose A, B separation is in the scale range of the index are kept, so an index
+suits the fields of view of a set of instruments. Codes are stored with the catalog stars in an npz
+file.
+
+To solve a frame, quads of its brightest stars are coded the same way, for both parities, and looked
+up in the index with a KD-tree. Each match gives a candidate tangent plane projection, verified by
+projecting the index stars around it into the frame and counting the stars found at their positions.
+The first candidate with enough matches is refined with all of them. This follows the method of
+astrometry.net, see https://arxiv.org/abs/0910.2233.
+
+Solving takes well under a second per frame once the index is loaded. Indexes are loaded once per
+process, so frames are solved in parallel in worker processes (see Processor.solve_astrometry).
+'''
+
+from astropy.wcs import WCS
+from dataclasses import dataclass
+import logging
+import numpy as np
+from pathlib import Path
+import time
+
+from abberition import library, matching, metrics
+
+
+__index_path = library.get_library_path() / 'index.npz'
+__indexes = {}
+
+
+def get_index_path() -> Path:
+    return __index_path
+
+
+def set_index_path(path:Path):
+    global __index_path
+    __index_path = Path(path)
+
+
+def has_index(path:Path=None) -> bool:
+    return Path(path if path is not None else __index_path).exists()
+
+
+def radec_to_xyz(ra, dec) -> np.ndarray:
+    '''
+    Unit vectors of sky positions in degrees, shape (n, 3).
+    '''
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def xyz_to_radec(xyz:np.ndarray):
+    xyz = np.atleast_2d(xyz)
+    ra = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360.0
+    dec = np.degrees(np.arcsin(np.clip(xyz[:, 2] / np.linalg.norm(xyz, axis=1), -1.0, 1.0)))
+
+    return ra, dec
+
+
+def tan_project(xyz:np.ndarray, center:np.ndarray) -> np.ndarray:
+    '''
+    Gnomonic projection of unit vectors about the unit vector center, as (xi, eta) in degrees with xi
+    to the east and eta to the north, shape (n, 2).
+    '''
+    east, north = __tangent_axes(center)
+    depth = xyz @ center
+
+    return np.degrees(np.column_stack([(xyz @ east) / depth, (xyz @ north) / depth]))
+
+
+def tan_deproject(plane:np.ndarray, center:np.ndarray) -> np.ndarray:
+    east, north = __tangent_axes(center)
+    plane = np.radians(np.atleast_2d(plane))
+    xyz = center[None, :] + plane[:, :1] * east[None, :] + plane[:, 1:] * north[None, :]
+
+    return xyz / np.linalg.norm(xyz, axis=1)[:, None]
+
+
+def __tangent_axes(center:np.ndarray):
+    east = np.array([-center[1], center[0], 0.0])
+    norm = np.linalg.norm(east)
+    east = east / norm if norm > 1e-12 else np.array([0.0, 1.0, 0.0])
+
+    return east, np.cross(center, east)
+
+
+def get_quads(points:np.ndarray, min_size:float, max_size:float, inner:int=2) -> np.ndarray:
+    '''
+    Get the quads of points, which must be ordered brightest first. Each pair of points (A, B) whose
+    separation is between min_size and max_size forms quads with the brightest inner points inside
+    the circle through A and B, so A and B are the quad's widest pair. Pairs of brighter points come
+    first.
+
+    Returns
+    -------
+    ndarray
+        Point indices (A, B, C, D) of the quads, shape (m, 4).
+    '''
+    n = len(points)
+    if n < 4:
+        return np.empty((0, 4), dtype=np.int64)
+
+    a, b = np.triu_indices(n, k=1)
+    order = np.lexsort((a, b))
+    a, b = a[order], b[order]
+
+    size = np.hypot(*(points[b] - points[a]).T)
+    valid = (size >= min_size) & (size <= max_size)
+    a, b, size = a[valid], b[valid], size[valid]
+
+    mid = (points[a] + points[b]) / 2.0
+    inside = np.hypot(*(points[None, :, :] - mid[:, None, :]).transpose(2, 0, 1)) < size[:, None] / 2.0
+    rows = np.arange(len(a))
+    inside[rows, a] = inside[rows, b] = False
+
+    # the first inner points inside each circle, in order of brightness
+    counts = np.cumsum(inside, axis=1)
+    firsts = [np.argmax(inside & (counts == i + 1), axis=1) for i in range(inner)]
+
+    quads = []
+    for i in range(inner):
+        for j in range(i + 1, inner):
+            has = counts[:, -1] > j
+            quads.append(np.column_stack([a[has], b[has], firsts[i][has], firsts[j][has]]))
+
+    quads = np.concatenate(quads) if len(quads) > 0 else np.empty((0, 4), dtype=np.int64)
+    return quads.astype(np.int64)
+
+
+def get_codes(points:np.ndarray, quads:np.ndarray):
+    '''
+    Get the hash codes of quads of points.
+
+    A and B are swapped so the code's C and D x coordinates sum to at most 1, and C and D so C's x
+    coordinate is at most D's, which makes the code independent of the order the quad was found in.
+
+    Returns
+    -------
+    codes : ndarray
+        (Cx, Cy, Dx, Dy), shape (m, 4).
+
+    quads : ndarray
+        The quads with their points reordered to match the codes, shape (m, 4).
+    '''
+    quads = quads.copy()
+    z = points[:, 0] + 1j * points[:, 1]
+    za, zb, zc, zd = (z[quads[:, i]] for i in range(4))
+
+    # similarity taking A to 0 and B to 1 + 1j
+    c = (zc - za) / (zb - za) * (1 + 1j)
+    d = (zd - za) / (zb - za) * (1 + 1j)
+
+    swap = c.real + d.real > 1.0
+    c[swap], d[swap] = (1 + 1j) - c[swap], (1 + 1j) - d[swap]
+    quads[swap, 0], quads[swap, 1] = quads[swap, 1], quads[swap, 0].copy()
+
+    swap = c.real > d.real
+    c[swap], d[swap] = d[swap], c[swap].copy()
+    quads[swap, 2], quads[swap, 3] = quads[swap, 3], quads[swap, 2].copy()
+
+    return np.column_stack([c.real, c.imag, d.real, d.imag]), quads
+
+
+@dataclass
+class Index:
+    '''
+    Stars and quad codes of a solver index, with KD-trees for lookups.
+    '''
+    xyz: np.ndarray
+    mag: np.ndarray
+    quads: np.ndarray
+    codes: np.ndarray
+    scale_min: float
+    scale_max: float
+
+    def __post_init__(self):
+        from scipy.spatial import cKDTree
+
+        self.code_tree = cKDTree(self.codes)
+        self.star_tree = cKDTree(self.xyz)
+
+    def stars_within(self, center:np.ndarray, radius:float) -> np.ndarray:
+        '''
+        Indices of the index stars within radius degrees of the unit vector center.
+        '''
+        chord = 2.0 * np.sin(np.radians(min(radius, 180.0)) / 2.0)
+        return np.array(self.star_tree.query_ball_point(center, chord), dtype=np.int64)
+
+
+def build_index(ra, dec, mag, path:Path, scale_min:float=0.25, scale_max:float=1.0, stars_per_field:int=50,
+                verify_stars_per_field:int=200) -> Index:
+    '''
+    Build a solver index from a catalog and save it to path.
+
+    Parameters
+    ----------
+    ra, dec, mag : array
+        Catalog positions in degrees and magnitudes.
+
+    path : Path
+        npz file to write.
+
+    scale_min, scale_max : float
+        Range of quad sizes in degrees. Quads should span a good part of the frames to be solved, so
+        for frames with fields of view from w to h degrees use about (w / 4, h).
+
+    stars_per_field : int
+        Number of the brightest stars in each field used for quads. The fields have a radius of
+        scale_max, and frames should have 10 or more of them to be solved reliably.
+
+    verify_stars_per_field : int
+        Number of the brightest stars in each field kept to verify solutions, which should put a few
+        tens of them in each frame.
+
+    Returns
+    -------
+    Index
+    '''
+    from scipy.spatial import cKDTree
+
+    start = time.perf_counter()
+    order = np.argsort(np.asarray(mag, dtype=np.float64), kind='stable')
+    ra, dec, mag = np.asarray(ra, dtype=np.float64)[order], np.asarray(dec, dtype=np.float64)[order], np.asarray(mag, dtype=np.float32)[order]
+    xyz = radec_to_xyz(ra, dec)
+    tree = cKDTree(xyz)
+
+    # fields of radius scale_max spaced so every quad is inside one of them
+    centers = __field_centers(ra, dec, scale_max / 2.0)
+    chord = 2.0 * np.sin(np.radians(scale_max) / 2.0)
+
+    quads, codes, kept = [], [], []
+    for center, members in zip(centers, tree.query_ball_point(centers, chord)):
+        if len(members) < 4:
+            continue
+
+        # catalog indices are in order of brightness
+        members = np.sort(members)[:max(stars_per_field, verify_stars_per_field)]
+        kept.append(members[:verify_stars_per_field])
+
+        members = members[:stars_per_field]
+        plane = tan_project(xyz[members], center)
+        field_codes, field_quads = get_codes(plane, get_quads(plane, scale_min, scale_max))
+        quads.append(members[field_quads])
+        codes.append(field_codes)
+
+    if sum(len(q) for q in quads) == 0:
+        raise ValueError('No quads in the scale range, the catalog is too sparse or the scale range too small')
+
+    # quads are found again in overlapping fields
+    quads, codes = np.concatenate(quads), np.concatenate(codes)
+    _, first = np.unique(np.sort(quads, axis=1), axis=0, return_index=True)
+    first = np.sort(first)
+    quads, codes = quads[first], codes[first]
+
+    # keep only the stars used by quads or for verifying
+    used = np.unique(np.concatenate(kept + [quads.ravel()]))
+    quads = np.searchsorted(used, quads)
+    xyz, mag = xyz[used], mag[used]
+
+    np.savez(path, xyz=xyz, mag=mag, quads=quads.astype(np.int32), codes=codes.astype(np.float32),
+             scale=np.array([scale_min, scale_max]))
+    logging.info(f'Built solver index of {len(quads)} quads of {len(xyz)} stars in {time.perf_counter() - start:.1f} s: {path}')
+
+    __indexes.pop(str(Path(path).resolve()), None)
+    return Index(xyz, mag, quads, codes, scale_min, scale_max)
+
+
+def __field_centers(ra:np.ndarray, dec:np.ndarray, spacing:float) -> np.ndarray:
+    # centers of a grid of fields in declination bands, where the catalog has stars
+    centers = []
+    dec_min, dec_max = max(-90.0, np.min(dec) - spacing), min(90.0, np.max(dec) + spacing)
+
+    for band in np.arange(dec_min, dec_max + spacing, spacing):
+        band = min(band, 90.0)
+        in_band = np.abs(dec - band) <= spacing
+        if not np.any(in_band):
+            continue
+
+        ra_spacing = spacing / max(np.cos(np.radians(band)), 1e-3)
+        steps = np.unique(np.floor(ra[in_band] / ra_spacing))
+        steps = np.unique(np.concatenate([steps - 1, steps, steps + 1]))
+        band_ra = (steps * ra_spacing) % 360.0
+        centers.append(radec_to_xyz(band_ra, np.full(len(band_ra), band)))
+
+    return np.concatenate(centers)
+
+
+def load_index(path:Path=None) -> Index:
+    '''
+    Load a solver index, by default from get_index_path(). Indexes are kept loaded for the life of
+    the process.
+    '''
+    path = Path(path if path is not None else __index_path).resolve()
+    key = str(path)
+
+    if key not in __indexes:
+        if not path.exists():
+            raise FileNotFoundError(f'No solver index at {path}, build one with solver.build_index')
+
+        with np.load(path) as data:
+            scale_min, scale_max = (float(s) for s in data['scale'])
+            __indexes[key] = Index(data['xyz'], data['mag'], data['quads'].astype(np.int64), data['codes'].astype(np.float64),
+                                   scale_min, scale_max)
+
+        logging.info(f'Loaded solver index of {len(__indexes[key].quads)} quads: {path}')
+
+    return __indexes[key]
+
+
+def solve(stars_x, stars_y, shape, index:Index=None, scale_range=None, center=None, radius:float=2.0, n_stars:int=25, n_verify:int=100,
+          code_tolerance:float=0.01,
+          match_tolerance:float=3.0, min_matches:int=8, min_fraction:float=0.25, max_candidates:int=5000) -> WCS:
+    '''
+    Blind solve a frame from its star positions.
+
+    Parameters
+    ----------
+    stars_x, stars_y : array
+        Pixel positions of the stars, brightest first, as from astrometry.find_stars.
+
+    shape : tuple
+        (height, width) of the frame.
+
+    index : Index
+        Solver index, the one at get_index_path() if None.
+
+    scale_range : tuple
+        Lower and upper bounds of the pixel scale in arcsec/px, to limit the search.
+
+    center, radius
+        Approximate (ra, dec) of the frame in degrees, such as the telescope's pointing, to limit the
+        search to index quads within radius degrees of it. The whole index is searched if center is None.
+
+    n_stars : int
+        Number of the brightest stars used for quads.
+
+    n_verify : int
+        Number of the brightest stars matched against the index stars to verify a candidate.
+
+    code_tolerance : float
+        Distance between codes taken as a match.
+
+    match_tolerance : float
+        Distance in pixels between a star and a projected index star taken as a match.
+
+    min_matches : int
+        Number of matched stars, including those of the quad, for a solution to be accepted.
+
+    min_fraction : float
+        Fraction of the index stars projected into the frame (or of the verify stars if fewer) that
+        must be matched for a solution to be accepted. This rejects candidates of the wrong scale,
+        which project many index stars into the frame and match some of them by chance.
+
+    max_candidates : int
+        Number of candidates verified before giving up.
+
+    Returns
+    -------
+    WCS
+        TAN projection of the frame.
+    '''
+    start = time.perf_counter()
+    index = index if index is not None else load_index()
+
+    stars = np.column_stack([np.asarray(stars_x, dtype=np.float64), np.asarray(stars_y, dtype=np.float64)])
+    height, width = shape[0], shape[1]
+    diagonal = np.hypot(width, height)
+
+    # quad sizes in pixels that can match quads of the index
+    if scale_range is not None:
+        min_size, max_size = index.scale_min * 3600.0 / scale_range[1], index.scale_max * 3600.0 / scale_range[0]
+    else:
+        min_size, max_size = 0.1 * min(width, height), diagonal
+
+    quad_stars = stars[:n_stars]
+    quads = get_quads(quad_stars, min_size, max_size, inner=3)
+
+    if len(quads) == 0:
+        raise ValueError(f'No quads in {len(quad_stars)} stars, can\'t solve')
+
+    # look up both parities, a mirrored frame has mirrored codes
+    candidates = []
+    for parity in [1.0, -1.0]:
+        codes, ordered = get_codes(quad_stars * [1.0, parity], quads)
+        for quad, hits in zip(ordered, index.code_tree.query_ball_point(codes, code_tolerance)):
+            candidates.extend((quad, hit) for hit in hits)
+
+    verify_stars = stars[:n_verify]
+    if center is not None:
+        # the quad's first star is within radius of the pointing, or near enough to the frame's edge
+        hint = radec_to_xyz(*center)[0]
+        near = np.cos(np.radians(radius + index.scale_max))
+        candidates = [(quad, hit) for quad, hit in candidates if index.xyz[index.quads[hit, 0]] @ hint >= near]
+
+    center_px = np.array([(width - 1) / 2.0, (height - 1) / 2.0])
+
+    for tried, (quad, hit) in enumerate(candidates[:max_candidates]):
+        wcs = __fit_tan(quad_stars[quad], index.xyz[index.quads[hit]], center_px)
+        if wcs is None:
+            continue
+
+        scale = np.sqrt(abs(np.linalg.det(wcs.wcs.cd))) * 3600.0
+        if scale_range is not None and not scale_range[0] <= scale <= scale_range[1]:
+            continue
+
+        field_radius = scale * diagonal / 2.0 / 3600.0 * 1.1
+        pairs, expected = __verify(wcs, index, verify_stars, shape, field_radius, match_tolerance)
+
+        if len(pairs) < max(min_matches, min_fraction * min(expected, len(verify_stars))):
+            continue
+
+        # refine with all matched stars, then match again
+        for _ in range(2):
+            refined = __fit_tan(verify_stars[pairs[:, 0]], index.xyz[pairs[:, 1]], center_px)
+            if refined is None:
+                break
+            wcs = refined
+            pairs, expected = __verify(wcs, index, verify_stars, shape, field_radius, match_tolerance)
+
+        if len(pairs) < max(min_matches, min_fraction * min(expected, len(verify_stars))):
+            continue
+
+        metrics.count('solver_candidates', tried + 1)
+        logging.info(f'Solved with {len(pairs)} matched stars after {tried + 1} candidates in {time.perf_counter() - start:.2f} s: '
+                     f'center ({wcs.wcs.crval[0]:.4f}, {wcs.wcs.crval[1]:.4f}), {scale:.3f} arcsec/px')
+        return wcs
+
+    metrics.count('solver_candidates', min(len(candidates), max_candidates))
+    raise ValueError(f'No solution in {min(len(candidates), max_candidates)} candidates from {len(quads)} quads')
+
+
+def __fit_tan(pixels:np.ndarray, xyz:np.ndarray, center_px:np.ndarray) -> WCS:
+    # fit a TAN projection, tangent at the sky position of the frame center, to matched stars
+    fit = __fit_linear(pixels - center_px, xyz)
+    if fit is None:
+        return None
+
+    tangent, cd = fit
+    singular = np.linalg.svd(cd, compute_uv=False)
+
+    # cameras don't shear, a skewed fit is a false match
+    if singular[1] <= 0 or singular[0] / singular[1] > 1.1:
+        return None
+
+    ra, dec = xyz_to_radec(tangent)
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crpix = center_px + 1.0
+    wcs.wcs.crval = [ra[0], dec[0]]
+    wcs.wcs.cd = cd
+
+    return wcs
+
+
+def __fit_linear(offsets:np.ndarray, xyz:np.ndarray):
+    # least squares tangent point and CD matrix taking pixel offsets from the reference pixel to the
+    # tangent plane, None if the stars don't constrain them
+    if len(offsets) < 3:
+        return None
+
+    tangent = np.sum(xyz, axis=0)
+    tangent /= np.linalg.norm(tangent)
+
+    design = np.column_stack([offsets, np.ones(len(offsets))])
+    for _ in range(5):
+        plane = tan_project(xyz, tangent)
+        solution, _, rank, _ = np.linalg.lstsq(design, plane, rcond=None)
+
+        if rank < 3:
+            return None
+
+        # move the tangent point to the reference pixel, until it is there
+        tangent = tan_deproject(solution[2], tangent)[0]
+        if np.hypot(*solution[2]) < 1e-12:
+            break
+
+    return tangent, solution[:2].T
+
+
+def refine_wcs(wcs:WCS, pixels:np.ndarray, ra, dec) -> WCS:
+    '''
+    Refit the pointing (CRVAL) and the rotation and scale (CD) of a TAN or TAN-SIP WCS to matched
+    stars, keeping its reference pixel and SIP distortion, which are fixed to the sensor. Suits a WCS
+    of an earlier frame of a sequence, where the pointing has drifted.
+
+    Parameters
+    ----------
+    wcs : WCS
+        WCS to refine.
+
+    pixels : ndarray
+        (x, y) pixel positions of stars, shape (n, 2) with n >= 3.
+
+    ra, dec : array
+        Sky positions of the stars in degrees.
+
+    Returns
+    -------
+    WCS
+        Refined WCS, None if the stars don't constrain it.
+    '''
+    pixels = np.asarray(pixels, dtype=np.float64)
+
+    if wcs.sip is not None:
+        # relative to CRPIX with 1 based pixels, whatever the origin
+        offsets = wcs.sip_pix2foc(pixels + 1.0, 1)
+    else:
+        offsets = pixels - (wcs.wcs.crpix - 1.0)
+
+    fit = __fit_linear(offsets, radec_to_xyz(ra, dec))
+    if fit is None:
+        return None
+
+    tangent, cd = fit
+    ra, dec = xyz_to_radec(tangent)
+
+    refined = WCS(naxis=2)
+    refined.wcs.ctype = list(wcs.wcs.ctype)
+    refined.wcs.crpix = wcs.wcs.crpix
+    refined.wcs.crval = [ra[0], dec[0]]
+    refined.wcs.cd = cd
+    refined.sip = wcs.sip
+    refined.pixel_shape = wcs.pixel_shape
+
+    return refined
+
+
+def __verify(wcs:WCS, index:Index, stars:np.ndarray, shape, radius:float, tolerance:float):
+    # mutual nearest pairs of (star, index star) within tolerance, and the number of index stars in
+    # the frame
+    center = radec_to_xyz(*wcs.wcs.crval)[0]
+    nearby = index.stars_within(center, radius)
+
+    if len(nearby) == 0:
+        return np.empty((0, 2), dtype=np.int64), 0
+
+    plane = tan_project(index.xyz[nearby], center)
+    pixels = (plane @ np.linalg.inv(wcs.wcs.cd).T) + wcs.wcs.crpix - 1.0
+
+    inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < shape[1]) & (pixels[:, 1] >= 0) & (pixels[:, 1] < shape[0])
+    nearby, pixels = nearby[inside], pixels[inside]
+
+    if len(nearby) == 0:
+        return np.empty((0, 2), dtype=np.int64), 0
+
+    pairs, _ = matching.match_pairs(stars, pixels, tolerance)
+
+    return np.column_stack([pairs[:, 0], nearby[pairs[:, 1]]]), len(nearby)
+
+
+if __name__ == '__main__':
+    import argparse
+    from astropy.table import Table
+
+    parser = argparse.ArgumentParser(description='Build a solver index from a catalog table')
+    parser.add_argument('catalog', help='catalog table (FITS, CSV, ...) with ra and dec columns in degrees')
+    parser.add_argument('index', nargs='?', default=str(get_index_path()), help='index file to write')
+    parser.add_argument('--mag-column', default='phot_g_mean_mag')
+    parser.add_argument('--scale-min', type=float, default=0.25, help='smallest quad size in degrees')
+    parser.add_argument('--scale-max', type=float, default=1.0, help='largest quad size in degrees')
+    parser.add_argument('--stars-per-field', type=int, default=50)
+    parser.add_argument('--verify-stars-per-field', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    table = Table.read(args.catalog)
+    build_index(np.asarray(table['ra']), np.asarray(table['dec']), np.asarray(table[args.mag_column]), args.index, args.scale_min,
+                args.scale_max, args.stars_per_field, args.verify_stars_per_field)
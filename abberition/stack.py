@@ -0,0 +1,298 @@
+'''
+Stack aligned frames with per-pixel rejection.
+
+The stack is streamed over bands of rows, so only one band of every frame is in memory at a time.
+Rejection and the weighted mean are computed in the same pass over each band, so outliers such
+as satellite and plane trails are rejected without a second pass over the data.
+
+Rejection methods:
+    'none'        no rejection
+    'minmax'      reject the nlow lowest and nhigh highest values of each pixel
+    'sigma_clip'  iterative median/standard deviation clipping
+    'winsorized'  sigma clipping with a standard deviation estimated from winsorized values, robust for small stacks
+    'linear_fit'  clipping with the mean and standard deviation of a line fit to the sorted values of each pixel
+                  against their normal scores, robust for trails in small stacks
+'''
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from ccdproc import CCDData, ImageFileCollection
+from contextlib import contextmanager
+import logging
+import numpy as np
+from pathlib import Path
+import warnings
+
+from abberition import background, tiling
+
+
+rejection_methods = ['none', 'minmax', 'sigma_clip', 'winsorized', 'linear_fit']
+
+
+def stack(images:ImageFileCollection, method:str='sigma_clip', weights=None, sigma_low:float=3.0, sigma_high:float=3.0,
+          maxiters:int=5, nlow:int=1, nhigh:int=1, match_backgrounds:bool=False, mem_limit:float=2e9) -> CCDData:
+    '''
+    Combine aligned frames of the same shape with per-pixel rejection.
+
+    Parameters
+    ----------
+    images : ImageFileCollection
+        Aligned frames.
+
+    method : str
+        Rejection method, one of rejection_methods.
+
+    weights : dict or sequence
+        Weight per frame, either by filename or in collection order. Equal weights if None.
+
+    sigma_low, sigma_high : float
+        Rejection thresholds in standard deviations below and above the center.
+
+    maxiters : int
+        Maximum number of rejection iterations.
+
+    nlow, nhigh : int
+        Number of low and high values rejected by 'minmax'.
+
+    match_backgrounds : bool
+        Offset each frame to the mean background level before rejection.
+
+    mem_limit : float
+        Approximate memory (bytes) used by each band of the stack.
+
+    Returns
+    -------
+    CCDData
+        Weighted mean of the unrejected values. NaN where all values were rejected.
+    '''
+    if method not in rejection_methods:
+        raise ValueError(f'Unknown rejection method \'{method}\', expected one of {rejection_methods}')
+
+    paths = [Path(images.location) / fn for fn in images.files_filtered()]
+    n = len(paths)
+
+    if n == 0:
+        raise ValueError('No images to stack')
+
+    header = fits.getheader(paths[0])
+    shape = (header['naxis2'], header['naxis1'])
+
+    frame_weights = __get_weights(weights, images.files_filtered(), n)
+
+    offsets = np.zeros(n, dtype=np.float32)
+    if match_backgrounds:
+        levels = np.array([background.get_background(np.asarray(fits.getdata(p), dtype=np.float32)).median for p in paths])
+        offsets = (levels - np.mean(levels)).astype(np.float32)
+
+    # several temporaries of the band are needed during rejection
+    tile_rows = int(max(1, min(shape[0], mem_limit / (6 * 4 * n * shape[1]))))
+    tiles = tiling.get_row_tiles(shape, tile_rows)
+
+    logging.info(f'Stacking {n} frames with {method} rejection in {len(tiles)} bands of {tile_rows} rows')
+
+    out = np.full(shape, np.nan, dtype=np.float32)
+    rejected = 0
+
+    hdus = [fits.open(p, memmap=True) for p in paths]
+    try:
+        for tile in tiles:
+            cube = np.empty((n,) + tile.shape(), dtype=np.float32)
+            for i, hdu in enumerate(hdus):
+                cube[i] = hdu[0].section[tile.slices]
+                cube[i] -= offsets[i]
+
+            mask = ~np.isfinite(cube)
+            mask |= reject(cube, mask, method, sigma_low, sigma_high, maxiters, nlow, nhigh)
+            rejected += int(np.count_nonzero(mask))
+
+            out[tile.core] = weighted_mean(cube, mask, frame_weights)
+    finally:
+        for hdu in hdus:
+            hdu.close()
+
+    ccd = CCDData(out, unit=header.get('bunit', u.adu), meta=header, wcs=WCS(header) if WCS(header).has_celestial else None)
+    ccd.meta['ncombine'] = n
+    ccd.meta['rejmeth'] = method
+    ccd.meta['rejfrac'] = rejected / (n * out.size)
+
+    return ccd
+
+
+def __get_weights(weights, filenames, n:int) -> np.ndarray:
+    if weights is None:
+        return np.ones(n, dtype=np.float32)
+
+    if isinstance(weights, dict):
+        return np.array([weights.get(fn, 1.0) for fn in filenames], dtype=np.float32)
+
+    weights = np.asarray(weights, dtype=np.float32)
+    if len(weights) != n:
+        raise ValueError(f'Expected {n} weights, got {len(weights)}')
+
+    return weights
+
+
+def weighted_mean(cube:np.ndarray, mask:np.ndarray, weights:np.ndarray) -> np.ndarray:
+    '''
+    Weighted mean along the first axis of the unmasked values of cube.
+    '''
+    w = np.where(mask, 0.0, weights[:, None, None]).astype(np.float32)
+    total = np.sum(np.where(mask, 0.0, cube) * w, axis=0)
+    weight = np.sum(w, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight > 0, total / weight, np.nan).astype(np.float32)
+
+
+def reject(cube:np.ndarray, mask:np.ndarray, method:str, sigma_low:float=3.0, sigma_high:float=3.0, maxiters:int=5, nlow:int=1, nhigh:int=1) -> np.ndarray:
+    '''
+    Get the mask of values rejected along the first axis of cube. Values already in mask are ignored.
+    '''
+    if method == 'none':
+        return np.zeros_like(mask)
+    elif method == 'minmax':
+        return reject_minmax(cube, mask, nlow, nhigh)
+    elif method == 'sigma_clip':
+        return reject_sigma_clip(cube, mask, sigma_low, sigma_high, maxiters)
+    elif method == 'winsorized':
+        return reject_sigma_clip(cube, mask, sigma_low, sigma_high, maxiters, winsorize=True)
+    elif method == 'linear_fit':
+        return reject_linear_fit(cube, mask, sigma_low, sigma_high, maxiters)
+
+    raise ValueError(f'Unknown rejection method \'{method}\'')
+
+
+def reject_minmax(cube:np.ndarray, mask:np.ndarray, nlow:int=1, nhigh:int=1) -> np.ndarray:
+    '''
+    Reject the nlow lowest and nhigh highest unmasked values of each pixel.
+    '''
+    values = np.where(mask, np.inf, cube)
+    order = np.argsort(values, axis=0)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(len(cube))[:, None, None], axis=0)
+
+    count = np.sum(~mask, axis=0)
+    rejected = (ranks < nlow) | ((ranks >= count - nhigh) & (ranks < count))
+
+    # keep at least one value
+    return rejected & ~mask & (count > nlow + nhigh)
+
+
+def reject_sigma_clip(cube:np.ndarray, mask:np.ndarray, sigma_low:float=3.0, sigma_high:float=3.0, maxiters:int=5, winsorize:bool=False) -> np.ndarray:
+    '''
+    Iteratively reject values more than sigma_low/sigma_high standard deviations below/above the median.
+    If winsorize is set, the standard deviation is estimated from values winsorized at 1.5 sigma.
+    '''
+    rejected = np.zeros_like(mask)
+
+    for _ in range(maxiters):
+        current = mask | rejected
+        values = np.where(current, np.nan, cube)
+
+        with np.errstate(invalid='ignore'), __ignore_all_nan():
+            center = nan_median(values)
+            std = __winsorized_std(values, center) if winsorize else np.nanstd(values, axis=0)
+
+            new = ~current & ((cube < center - sigma_low * std) | (cube > center + sigma_high * std))
+
+        # keep at least a third of the values of a pixel
+        keep = np.sum(~(current | new), axis=0) >= np.maximum(np.sum(~mask, axis=0) / 3.0, 1)
+        new &= keep
+
+        if not np.any(new):
+            break
+
+        rejected |= new
+
+    return rejected
+
+
+def nan_median(values:np.ndarray) -> np.ndarray:
+    '''
+    Median along the first axis ignoring NaN. Faster than np.nanmedian for stacks as it is a single sort.
+    '''
+    values = np.sort(values, axis=0)
+    count = np.sum(~np.isnan(values), axis=0)
+
+    lo = np.take_along_axis(values, np.maximum((count - 1) // 2, 0)[None], axis=0)[0]
+    hi = np.take_along_axis(values, np.minimum(count // 2, len(values) - 1)[None], axis=0)[0]
+
+    return np.where(count > 0, 0.5 * (lo + hi), np.nan)
+
+
+def __winsorized_std(values:np.ndarray, center:np.ndarray, iters:int=5) -> np.ndarray:
+    std = np.nanstd(values, axis=0)
+
+    for _ in range(iters):
+        clipped = np.clip(values, center - 1.5 * std, center + 1.5 * std)
+        # 1.134 corrects the bias of the std of values winsorized at 1.5 sigma
+        new_std = 1.134 * np.nanstd(clipped, axis=0)
+        center = nan_median(clipped)
+
+        if np.allclose(new_std, std, rtol=5e-4, equal_nan=True):
+            std = new_std
+            break
+
+        std = new_std
+
+    return std
+
+
+def reject_linear_fit(cube:np.ndarray, mask:np.ndarray, sigma_low:float=3.0, sigma_high:float=3.0, maxiters:int=5) -> np.ndarray:
+    '''
+    Iteratively fit a line to the sorted unrejected values of each pixel against their normal scores, and
+    reject values more than sigma_low/sigma_high standard deviations from the centre of the line.
+
+    For normally distributed values the intercept of the line is the mean and its slope the standard
+    deviation. The line is fit to the central values only, with normal scores within one, so outliers
+    in the tails such as trails don't pull it, and refit each iteration without the rejected values.
+    '''
+    from scipy.special import ndtri
+
+    rejected = np.zeros_like(mask)
+
+    for _ in range(maxiters):
+        current = mask | rejected
+        values = np.where(current, np.nan, cube)
+        count = np.sum(~current, axis=0)
+
+        order = np.argsort(np.where(current, np.inf, cube), axis=0)
+        ranks = np.empty_like(order)
+        np.put_along_axis(ranks, order, np.arange(len(cube))[:, None, None], axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'), __ignore_all_nan():
+            # Blom's normal scores of the ranks of the unrejected values
+            scores = np.where(current, np.nan, ndtri((ranks + 0.625) / (count + 0.25))).astype(np.float32)
+
+            central = ~current & (np.abs(scores) <= 1.0)
+            x = np.where(central, scores, np.nan)
+            y = np.where(central, values, np.nan)
+
+            x_mean = np.nanmean(x, axis=0)
+            y_mean = np.nanmean(y, axis=0)
+            sigma = np.nansum((x - x_mean) * (y - y_mean), axis=0) / np.nansum((x - x_mean) ** 2, axis=0)
+            sigma = np.nan_to_num(sigma)
+            center = y_mean - sigma * x_mean
+
+            residual = values - center
+            new = ~current & ((residual < -sigma_low * sigma) | (residual > sigma_high * sigma))
+
+        # linear fits need at least three values
+        keep = np.sum(~(current | new), axis=0) >= 3
+        new &= keep
+
+        if not np.any(new):
+            break
+
+        rejected |= new
+
+    return rejected
+
+
+@contextmanager
+def __ignore_all_nan():
+    # numpy warns for pixels with all values rejected
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        yield
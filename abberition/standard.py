@@ -8,10 +8,11 @@ import logging
 import numpy as np 
 import os
 from pathlib import Path
-from abberition import calibration, io, library
+from abberition import calibration, io, library, metrics
 from abberition import conversion
 
 
+@metrics.stage('create_bias')
 def create_bias(biases: ImageFileCollection, sigma_low=5.0, sigma_high=5.0, data_type=np.float32):
     # get list of files
     bias_files = biases.files_filtered(include_path=True)
@@ -55,6 +56,7 @@ def is_bias_dark_match(bias, dark):
 
 
 
+@metrics.stage('create_dark')
 def create_dark(darks: ImageFileCollection, sigma_low:float=5.0, sigma_high:float=5.0, data_type=np.float32, del_tmp_dir:bool=True):
     '''
     Calibrate and create a dark standard from a collection of darks.
@@ -107,6 +109,7 @@ def create_dark(darks: ImageFileCollection, sigma_low:float=5.0, sigma_high:floa
     return combined_dark
 
 
+@metrics.stage('create_flats')
 def create_flats(ifc_flats:ImageFileCollection, out_path:Path=None, min_exp=1.5, dtype=np.float32, data_max=None, reject_too_dark=True, reject_too_bright=True, ignore_temp=False, overwrite=True):
     from pathlib import Path
     from os import makedirs
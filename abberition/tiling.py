@@ -0,0 +1,78 @@
+# split images into overlapping tiles for processing in pieces
+
+
+class Tile:
+    '''
+    A rectangular region of an image.
+
+    slices: region of the full image including the overlap border
+    core: region of the full image the tile is responsible for
+    core_local: the core region relative to the tile's slices
+    '''
+
+    def shape(self):
+        return (self.slices[0].stop - self.slices[0].start, self.slices[1].stop - self.slices[1].start)
+
+    def core_shape(self):
+        return (self.core[0].stop - self.core[0].start, self.core[1].stop - self.core[1].start)
+
+    def __init__(self, slices, core):
+        self.slices = slices
+        self.core = core
+        self.core_local = (slice(core[0].start - slices[0].start, core[0].stop - slices[0].start),
+                           slice(core[1].start - slices[1].start, core[1].stop - slices[1].start))
+
+    def __repr__(self):
+        return f'Tile(rows={self.core[0].start}:{self.core[0].stop}, cols={self.core[1].start}:{self.core[1].stop})'
+
+
+def get_tiles(shape, tile_shape, overlap:int=0) -> list:
+    '''
+    Split an image of shape (rows, cols) into tiles of at most tile_shape, with each tile
+    extended by overlap pixels on each side where possible. The cores of the tiles cover the
+    image exactly once.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the full image (rows, cols).
+
+    tile_shape : int or tuple
+        Maximum core shape of each tile (rows, cols).
+
+    overlap : int
+        Number of pixels each tile is extended by to give context at its borders.
+
+    Returns
+    -------
+    list of Tile
+    '''
+    if isinstance(tile_shape, int):
+        tile_shape = (tile_shape, tile_shape)
+
+    rows, cols = shape[0], shape[1]
+    tile_rows = max(1, min(int(tile_shape[0]), rows))
+    tile_cols = max(1, min(int(tile_shape[1]), cols))
+
+    tiles = []
+
+    for r0 in range(0, rows, tile_rows):
+        r1 = min(r0 + tile_rows, rows)
+
+        for c0 in range(0, cols, tile_cols):
+            c1 = min(c0 + tile_cols, cols)
+
+            core = (slice(r0, r1), slice(c0, c1))
+            slices = (slice(max(r0 - overlap, 0), min(r1 + overlap, rows)),
+                      slice(max(c0 - overlap, 0), min(c1 + overlap, cols)))
+
+            tiles.append(Tile(slices, core))
+
+    return tiles
+
+
+def get_row_tiles(shape, tile_rows:int, overlap:int=0) -> list:
+    '''
+    Split an image into full width bands of at most tile_rows rows.
+    '''
+    return get_tiles(shape, (tile_rows, shape[1]), overlap)
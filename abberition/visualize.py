@@ -1,9 +1,8 @@
-# An assortment of visualizations to display data
+# An assortment of visualizations to display data, pyplot is only imported by the functions that plot
 
 
 import astropy.visualization as vis
 from astropy.wcs import WCS
-import matplotlib.pyplot as plt
 import numpy as np
 from numpy.linalg import norm
 from astropy.visualization import make_lupton_rgb, ImageNormalize
@@ -28,10 +27,53 @@ def data_to_image(data, max_val=1.0):
     #return vis.make_lupton_rgb(data, data, data, minimum=low, stretch=100, Q=6)
     return hist_eq(data, 1.0)
 
+def auto_stretch(data, target_background:float=0.25, shadows_clip:float=-2.8, sample_size:int=100000):
+    '''
+    Stretch linear data for display with a midtones transfer function, so the background sits at
+    target_background and shadows below shadows_clip MAD-sigmas of the median are clipped to black.
+    Statistics are taken from a sample of about sample_size pixels, so large frames stretch quickly.
+
+    Returns data scaled to [0, 1], with non-finite pixels at 0.
+    '''
+    data = np.asarray(data, dtype=np.float32)
+    step = max(data.size // sample_size, 1)
+
+    sample = data.ravel()[::step]
+    sample = sample[np.isfinite(sample)]
+    if len(sample) == 0:
+        return np.zeros(data.shape, dtype=np.float32)
+
+    low, high = np.percentile(sample, [0.0, 99.99])
+    scale = high - low if high > low else 1.0
+
+    sample = np.clip((sample - low) / scale, 0.0, 1.0)
+    median = np.median(sample)
+    mad = 1.4826 * np.median(np.abs(sample - median))
+
+    shadows = np.clip(median + shadows_clip * mad, 0.0, median)
+    if median <= shadows or shadows >= 1.0:
+        # flat data, stretch linearly
+        shadows, midtones = 0.0, 0.5
+    else:
+        # the midtones balance that maps the clipped median to target_background
+        midtones = __mtf(target_background, (median - shadows) / (1.0 - shadows))
+
+    x = np.clip(((data - low) / scale - shadows) / (1.0 - shadows), 0.0, 1.0)
+    x[~np.isfinite(x)] = 0.0
+
+    return __mtf(midtones, x).astype(np.float32)
+
+def __mtf(m, x):
+    # midtones transfer function, 0, m and 1 map to 0, 0.5 and 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(x > 0, (m - 1) * x / ((2 * m - 1) * x - m), 0.0)
+
 def new_plot(figsize=(20,20)):
+    import matplotlib.pyplot as plt
     return plt.figure(figsize=figsize)
 
 def show_plot():
+    import matplotlib.pyplot as plt
     plt.show()
 
 def draw_wcs_grid(wcs:WCS, grid_res=20):
@@ -39,10 +81,13 @@ def draw_wcs_grid(wcs:WCS, grid_res=20):
     pass
 
 def draw_stars(x_stars, y_stars, style='bo', marker_size=16):
+    import matplotlib.pyplot as plt
     plt.plot(x_stars, y_stars, style, fillstyle="none", ms=marker_size)
 
 def draw_rejected_stars(im, x_stars, y_stars, x_rejected, y_rejected):
     # draw stars and rejected stars on image
+    import matplotlib.pyplot as plt
+
     draw_stars(im, x_stars, y_stars, 'go')
     plt.plot(x_rejected, y_rejected, 'rx')
 
@@ -53,16 +98,22 @@ def points_to_image(x, y, val, min_x=0, min_y=0, max_x=2048, max_y=2048, grid_re
     return griddata((x, y), val, (grid_x, grid_y), method='nearest').T
 
 def draw_im_overlay(im, alpha=1.0, interp='bicubic', cmap='gray', show_scale=False):
+    import matplotlib.pyplot as plt
+
     ix = plt.imshow(im, origin='lower', alpha=alpha, cmap=cmap, interpolation=interp)
     if show_scale:
         plt.colorbar(ix)
 
 def draw_im_wcs_points(im, x_stars, y_stars, wcs:WCS, star_sky):
+    import matplotlib.pyplot as plt
+
     draw_stars(im, x_stars, y_stars, 'bx', 10)
     wcs_px = star_sky.to_pixel(wcs)
     plt.plot(wcs_px[0], wcs_px[1], 'ro', fillstyle='none', ms=12)
 
 def draw_im(data, stretch=True):
+    import matplotlib.pyplot as plt
+
     im = data
     if stretch:
         im = data_to_image(data)
@@ -72,6 +123,8 @@ def draw_im(data, stretch=True):
 
 def draw_wcs_distortion(wcs:WCS, grid_res=20, exaggeration=10):
     # Draw exaggerated distortion map from WCS
+    import matplotlib.pyplot as plt
+
     w = wcs.array_shape[1]
     h = wcs.array_shape[0]
 
@@ -123,6 +176,8 @@ def draw_wcs_distortion(wcs:WCS, grid_res=20, exaggeration=10):
 
 def draw_ccd(ccd:ccdp.CCDData, color='gray', stretch=True, show_colorbar=True, fig_size = (10, 10)):
     # Draw CCD with WCS grid overlay
+    import matplotlib.pyplot as plt
+
     wcs = ccd.wcs
     
     im = ccd.data
@@ -0,0 +1,306 @@
+'''
+Watch a capture directory and process lights as they arrive.
+
+New FITS files are noticed with inotify if the optional inotify_simple package is available, otherwise
+by polling the directory. A file is taken once it has been closed after writing (inotify) or its size
+and modification time haven't changed for a settle time (polling).
+
+Each new light is sanitized into the processor's source lights, calibrated, then solved or registered,
+and added to the running stack of its filter (see pipeline.RunningStack) without restacking earlier
+frames. The stack of the filter is written to the stacked lights straight away.
+'''
+
+from astropy.io import fits
+from ccdproc import CCDData, ImageFileCollection
+import fnmatch
+import logging
+import numpy as np
+import os
+from pathlib import Path
+import time
+
+from abberition import astrometry, background, calibration, combine, conversion, image, io, live, metrics, pipeline, registration
+
+
+fits_patterns = ['*.fits', '*.fit', '*.fts']
+watch_backends = ['auto', 'inotify', 'poll']
+
+
+class FolderWatcher:
+    '''
+    Notices new files matching patterns in a directory.
+
+    Parameters
+    ----------
+    path : Path
+        Directory to watch.
+
+    patterns : list
+        Filename patterns of the files to take, matched case insensitively.
+
+    settle : float
+        Seconds a file's size and modification time must be unchanged before it is taken, when it
+        wasn't seen being closed.
+
+    backend : str
+        One of watch_backends. 'auto' uses inotify if inotify_simple is installed, otherwise polling.
+
+    include_existing : bool
+        Take the files already in the directory, otherwise only files added later.
+    '''
+
+    def __init__(self, path:Path, patterns:list=None, settle:float=2.0, backend:str='auto', include_existing:bool=True):
+        if backend not in watch_backends:
+            raise ValueError(f'Unknown watch backend \'{backend}\', expected one of {watch_backends}')
+
+        self.path = Path(path)
+        self.patterns = [p.lower() for p in (patterns if patterns is not None else fits_patterns)]
+        self.settle = settle
+
+        self.seen = set()
+        self.pending = {}
+        self.closed = set()
+        self.inotify = None
+
+        if backend in ['auto', 'inotify']:
+            try:
+                from inotify_simple import INotify, flags
+                self.inotify = INotify()
+                self.inotify.add_watch(str(self.path), flags.CLOSE_WRITE | flags.MOVED_TO)
+            except ImportError:
+                if backend == 'inotify':
+                    raise
+                logging.debug('inotify_simple not available, polling for new files')
+
+        if not include_existing:
+            self.seen.update(self.__list())
+
+    def __list(self) -> set:
+        return set(entry.name for entry in os.scandir(self.path)
+                   if entry.is_file() and any(fnmatch.fnmatch(entry.name.lower(), p) for p in self.patterns))
+
+    def __read_events(self, timeout_ms:int=0) -> bool:
+        events = self.inotify.read(timeout=timeout_ms)
+        self.closed.update(event.name for event in events)
+
+        return len(events) > 0
+
+    def poll(self) -> list:
+        '''
+        Get the paths of the files that are complete since the last poll, ordered by name.
+        '''
+        if self.inotify is not None:
+            self.__read_events()
+
+        now = time.monotonic()
+        ready = []
+
+        for name in sorted(self.__list() - self.seen):
+            try:
+                stat = (self.path / name).stat()
+            except FileNotFoundError:
+                continue
+
+            signature = (stat.st_size, stat.st_mtime_ns)
+
+            if name in self.closed:
+                ready.append(name)
+            elif name not in self.pending or self.pending[name][0] != signature:
+                self.pending[name] = (signature, now)
+            elif now - self.pending[name][1] >= self.settle:
+                ready.append(name)
+
+        for name in ready:
+            self.seen.add(name)
+            self.pending.pop(name, None)
+            self.closed.discard(name)
+
+        return [self.path / name for name in ready]
+
+    def wait(self, timeout:float):
+        '''
+        Wait up to timeout seconds for files to change, returning early on inotify events.
+        '''
+        if self.inotify is not None:
+            self.__read_events(int(timeout * 1000))
+        else:
+            time.sleep(timeout)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class WatchSession:
+    '''
+    Processes lights one at a time into running per-filter stacks, writing each stage to the
+    directories of a Processor.
+
+    Lights are plate solved and stacked on an output frame planned from the first solved light, padded
+    by margin (see pipeline.get_reference_grid), or registered to the first light if register is set.
+
+    Masters are selected and read once per setup (see live.CalibrationCache), not for every light.
+    '''
+
+    def __init__(self, processor, register:bool=False, model:str='similarity', n_stars:int=50, resolution:float=None, margin:float=0.25,
+                 remove_cosmics:bool=False, match_backgrounds:bool=True):
+        self.processor = processor
+        self.register = register
+        self.model = model
+        self.n_stars = n_stars
+        self.resolution = resolution
+        self.margin = margin
+        self.remove_cosmics = remove_cosmics
+        self.match_backgrounds = match_backgrounds
+
+        self.reprojection = None
+        self.reference = None
+        self.seed = None
+        self.stacks = {}
+        self.masters = live.CalibrationCache(processor.flats_calib, prepare=False)
+
+        for path in [processor.light_src_path, processor.light_calib_path, processor.light_stacked_path,
+                     processor.light_registered_path if register else processor.light_solved_path]:
+            io.mkdirs(path)
+
+    def add(self, path:Path) -> str:
+        '''
+        Process a new light and add it to the stack of its filter, which is written to the stacked
+        lights. Returns the filter, or None if the light couldn't be stacked.
+        '''
+        filename = Path(path).name
+
+        with metrics.frame(filename, 'watch'):
+            light = self.__ingest(path)
+
+            bias, dark, flat = self.masters.get(light.header)
+            calibrated = calibration.calibrate_light(light, flat, bias, dark, remove_cosmics=self.remove_cosmics)
+            calibrated = conversion.to_float32(calibrated)
+            calibrated.write(self.processor.light_calib_path / filename, overwrite=True)
+
+            if self.register:
+                filter, origin, data, footprint, level = self.__register(calibrated, filename)
+            else:
+                filter, origin, data, footprint, level = self.__solve(calibrated, filename)
+
+            if data is None:
+                logging.warning(f'\'{filename}\' is outside the output frame')
+                return None
+
+            if filter not in self.stacks:
+                self.stacks[filter] = pipeline.RunningStack(self.reprojection)
+
+            stack = self.stacks[filter]
+            stack.add(data, footprint, origin, level=level)
+            self.__write_stack(filter)
+
+        logging.info(f'Stacked \'{filename}\' ({filter}, {stack.count} frames)')
+
+        return filter
+
+    def __ingest(self, path:Path) -> CCDData:
+        # copy the light to the source lights with its header sanitized, as io.get_images does
+        summary = image.SanitizeSummary()
+        dest = self.processor.light_src_path / Path(path).name
+
+        with fits.open(path, memmap=False) as hdus:
+            image.apply_schema(hdus[0].header, summary)
+            hdus.writeto(dest, overwrite=True)
+
+            light = CCDData(hdus[0].data, unit='adu', meta=hdus[0].header)
+
+        summary.log()
+
+        return light
+
+    def __solve(self, calibrated:CCDData, filename:str):
+        # each light is seeded with the WCS of the one before, see astrometry.solve_wcs
+        solved = astrometry.solve_wcs(calibrated, self.processor.light_solved_path / filename, seed=self.seed)
+        self.seed = solved.wcs
+
+        if self.reprojection is None:
+            self.reprojection = pipeline.get_reference_grid(solved.wcs, solved.shape, self.resolution, self.margin)
+            logging.info(f'Stacking onto {self.reprojection.shape[1]}x{self.reprojection.shape[0]} px')
+
+        return pipeline.reproject_light(solved, self.reprojection, self.match_backgrounds)
+
+    def __register(self, calibrated:CCDData, filename:str):
+        if self.reference is None:
+            self.reference = (filename, registration.detect_stars(calibrated.data, self.n_stars))
+            self.reprojection = combine.Reprojection(None, calibrated.shape)
+            logging.info(f'Registering to \'{filename}\' using {len(self.reference[1])} stars')
+
+        registered = registration.register_image(calibrated, self.reference[0], self.reference[1], self.reprojection.shape, self.model,
+                                                 self.n_stars)
+        registered.write(self.processor.light_registered_path / filename, overwrite=True)
+
+        data = np.asarray(registered.data, dtype=np.float32)
+        footprint = (np.isfinite(data) & ~registered.mask).astype(np.float32)
+        level = background.get_background(data, use_cache=False).median if self.match_backgrounds else None
+
+        return registered.header.get('filter', 'NONE'), (0, 0), data, footprint, level
+
+    def __write_stack(self, filter:str):
+        fn = f'{filter}.fits'
+        self.stacks[filter].result().write(self.processor.light_stacked_path / fn, overwrite=True)
+
+        self.processor.lights_stacked = ImageFileCollection(location=self.processor.light_stacked_path,
+                                                            filenames=[f'{f}.fits' for f in self.stacks])
+
+
+def watch_lights(processor, capture_path:Path, register:bool=False, interval:float=1.0, settle:float=2.0, backend:str='auto',
+                 include_existing:bool=True, idle_timeout:float=None, **kwargs) -> dict:
+    '''
+    Watch capture_path for new lights and process each into the running stack of its filter as it arrives.
+
+    Parameters
+    ----------
+    processor : Processor
+        Processor whose stage directories are written, and whose calibrated flats are used if set.
+
+    capture_path : Path
+        Directory the lights are captured to.
+
+    register : bool
+        Register the lights to the first light instead of plate solving them.
+
+    interval : float
+        Seconds between checks for new files.
+
+    settle, backend, include_existing
+        See FolderWatcher.
+
+    idle_timeout : float
+        Stop once no new light has arrived for this many seconds. Watches until interrupted if None.
+
+    Other arguments are passed to WatchSession.
+
+    Returns
+    -------
+    dict
+        RunningStack of each filter.
+    '''
+    watcher = FolderWatcher(capture_path, settle=settle, backend=backend, include_existing=include_existing)
+    session = WatchSession(processor, register=register, **kwargs)
+
+    logging.info(f'Watching {capture_path} for new lights')
+    last_light = time.monotonic()
+
+    try:
+        while idle_timeout is None or time.monotonic() - last_light < idle_timeout:
+            for path in watcher.poll():
+                try:
+                    session.add(path)
+                except Exception as e:
+                    logging.warning(f'Could not process \'{path.name}\': {e}')
+
+                last_light = time.monotonic()
+
+            watcher.wait(interval)
+    except KeyboardInterrupt:
+        logging.info('Stopped watching')
+    finally:
+        watcher.close()
+
+    return session.stacks
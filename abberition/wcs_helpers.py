@@ -21,31 +21,32 @@ WCS:
 - Mosaic keywords for Multi-HDU fits files: https://www.ucolick.org/%7Esla/fits/mosaic/
 - https://fits.gsfc.nasa.gov/fits_wcs.html
 
-# TODO: pass distortion model into solve wcs?
-
 '''
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-from astroquery.astrometry_net import AstrometryNet
-from astroquery.gaia import Gaia
 from astropy.io import fits
 from astropy.wcs.utils import fit_wcs_from_points
 from enum import Enum
-from gwcs.wcstools import wcs_from_points
-from matplotlib import pyplot as plt
 import numpy as np
 from numpy.linalg import norm
-import time
 from  astropy.wcs import WCS
-from . import visualize
+from . import background
+from . import catalog
+from . import matching
+
+def solve_astrometry_net(stars_x_px, stars_y_px, width, height, center=None, radius=2.0):
+    # Use astrometry.net for initial wcs, searching within radius degrees of center (ra, dec) if given
+    from astroquery.astrometry_net import AstrometryNet
 
-def solve_astrometry_net(stars_x_px, stars_y_px, width, height):
-    # Use astrometry.net for initial wcs
     print('Using astrometry.net for initial wcs')
     ast = AstrometryNet()
     #ast.api_key = '#############'
 
-    hdr = ast.solve_from_source_list(stars_x_px, stars_y_px, image_width=width, image_height=height)
+    settings = {}
+    if center is not None:
+        settings = {'center_ra': center[0], 'center_dec': center[1], 'radius': radius}
+
+    hdr = ast.solve_from_source_list(stars_x_px, stars_y_px, image_width=width, image_height=height, **settings)
     return WCS(hdr)
 
 def get_distortion(wcs:WCS, grid_res:None):
@@ -103,55 +104,29 @@ def get_center_sky(wcs, width_px, height_px):
     return wcs.pixel_to_world(width_px/2, height_px/2)
 
 def extract_background(data):
-    from photutils.background import Background2D, SExtractorBackground, MedianBackground, MMMBackground
-    from astropy.stats import SigmaClip
-    
-    sigma_clip = SigmaClip(sigma=3.0)
-    bkg_estimator = SExtractorBackground()
-    bkg_proc = Background2D(data, (32, 32), filter_size=(3, 3), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
+    # shared, cached sigma clipped SExtractor background on 32x32 boxes
+    bkg = background.get_background(data, box_size=32, filter_size=3, sigma=3.0)
 
-    return bkg_proc.background
+    return bkg.background
 
 def gaia_get_wcs(wcs, im_size, pixel_border=50, max_count=1000, mag_limit=16):
-
+    # gaia stars within the wcs footprint, from the local catalog store (see catalog.py)
     vert_x = [-pixel_border, -pixel_border, im_size[0]+pixel_border, im_size[0]+pixel_border]
     vert_y = [-pixel_border, im_size[0]+pixel_border, im_size[0]+pixel_border, -pixel_border]
 
     vert_sky = wcs.pixel_to_world(vert_x, vert_y)
 
+    return catalog.get_store().polygon(vert_sky.ra.deg, vert_sky.dec.deg, mag_limit=mag_limit, max_count=max_count)
 
-    # need to call job.get_results() to get data table
-    query = (f"select top {max_count} source_id, ra, dec, phot_g_mean_mag, phot_rp_mean_mag from gaiaedr3.gaia_source where "
-                        f"phot_g_mean_mag < {mag_limit} "
-                        "AND "
-                        "1=CONTAINS("
-                        "POINT('ICRS', ra, dec), "
-                        "POLYGON('ICRS', "
-                        f"{vert_sky[0].ra.deg}, {vert_sky[0].dec.deg}, "
-                        f"{vert_sky[1].ra.deg}, {vert_sky[1].dec.deg}, "
-                        f"{vert_sky[2].ra.deg}, {vert_sky[2].dec.deg}, "
-                        f"{vert_sky[3].ra.deg}, {vert_sky[3].dec.deg})) "
-                        "order by phot_g_mean_mag")
-    #print(f'Gaia TAP query: \n{query}')
-
-    job = Gaia.launch_job_async(query)
-
-    while not job.is_finished():
-        time.sleep(0.1)
-
-    return job.get_results()
-
-def gaia_get(num_stars, center:SkyCoord, fov_deg):
-    # async await for a gaia job to complete
-    job = gaia_request_async(num_stars, center, fov_deg)
-
-    while not job.is_finished():
-        time.sleep(0.1)
-
-    return job.get_results()
+def gaia_get(num_stars, center:SkyCoord, fov_deg, mag_limit=None):
+    # brightest gaia stars within fov_deg of center brighter than G mag_limit, from the local catalog store.
+    # Unlike the direct archive query this replaced, stars are limited to catalog.default_mag_limit if None
+    return catalog.get_store().cone(center.ra.deg, center.dec.deg, fov_deg/2, mag_limit=mag_limit, max_count=num_stars)
 
 def gaia_request_async(num_stars, center:SkyCoord, fov_deg):
     # need to call job.get_results() to get data table
+    from astroquery.gaia import Gaia
+
     query = (f"select top {num_stars} source_id, ra, dec, phot_g_mean_mag, phot_rp_mean_mag from gaiaedr3.gaia_source where "
                         "1=CONTAINS("
                         f"POINT('ICRS', {center.ra.deg}, {center.dec.deg}), "
@@ -196,13 +171,14 @@ def get_fits_sky_coord(header: fits.Header, ra_key='OBJCTRA', dec_key='OBJCTDEC'
 
 def create_starinfo_table(stars_tbl, matched_star_indices, gaias_tbl, matched_gaia_indices):
     stars_id = np.array(stars_tbl['id'], dtype=np.int32)
-    stars_x = np.array(stars_tbl['xcentroid'], dtype=np.int32)
-    stars_y = np.array(stars_tbl['ycentroid'], dtype=np.int32)
+    stars_x = np.array(stars_tbl['xcentroid'], dtype=np.float32)
+    stars_y = np.array(stars_tbl['ycentroid'], dtype=np.float32)
     stars_fwhm = np.array(stars_tbl['fwhm'], dtype=np.float32)
     stars_sharpness = np.array(stars_tbl['sharpness'], dtype=np.float32)
     stars_roundness = np.array(stars_tbl['roundness'], dtype=np.float32)
     stars_pa = np.array(stars_tbl['pa'], dtype=np.float32)
-    stars_sky = np.array(stars_tbl['sky'], dtype=np.float32)
+    # newer photutils star finders no longer report the local sky
+    stars_sky = np.array(stars_tbl['sky'] if 'sky' in stars_tbl.colnames else np.zeros(len(stars_tbl)), dtype=np.float32)
     stars_peak = np.array(stars_tbl['peak'], dtype=np.float32)
     stars_flux = np.array(stars_tbl['flux'], dtype=np.float32)
     stars_mag = np.array(stars_tbl['mag'], dtype=np.float32)
@@ -244,58 +220,10 @@ def get_dists(src, dests):
     return dists
 
 def match_coords_px(stars_px, catalog_px, window_extent_px=20):
-    #  idx: indices into catalog_sky of the closest star in the catalog
-    #  sep: separation of the closest star, NaN if bad result
-    indices = []
-    separations = []
-    big_int=100000000000
-    num_stars = len(stars_px[0])
-
-    for i in range(num_stars):
-        star_xy = stars_px[:,i]
-
-        # get bool array of stars within window_extent_px
-        l = star_xy - window_extent_px
-        u = star_xy + window_extent_px
-
-        ge = np.greater_equal(catalog_px.T, l)
-        le = np.less_equal(catalog_px.T, u)
-        c = np.array([ge.T[0], ge.T[1], le.T[0], le.T[1]]).T
-        near = np.all(c, axis=1)
-        nearby_star_indices = np.where(near)[0]
-
-        if len(nearby_star_indices) > 0:
-            nearby_stars = catalog_px.T[nearby_star_indices]
-
-            seps = get_dists(star_xy, nearby_stars)
-            min_idx = seps.argmin()
-
-            indices.append(min_idx)
-            separations.append(seps[min_idx])
-        else:
-            indices.append(big_int)
-            separations.append(np.NaN)
-
-    indices = np.array(indices)
-    separations = np.array(separations)
-
-    # remove stars with duplicate gaia indices 
-    for i in range(num_stars):
-        dups = [i]
-        i_idx = indices[i]
-
-        # get list of duplicates
-        for j in range(i+1,num_stars):
-            if i_idx == indices[j]:
-                dups.append(j)
-
-        # if there are dups, find the nearest stars and their offsets from the 
-        # paired stars and find which of the dups is closest to that point
-        if len(dups) > 1:
-            # just setting separations to NaN so we don't use the points
-            separations[dups] = np.NaN
-
-    return np.array(indices), np.array(separations)    
+    #  idx: indices into catalog_px of the matched catalog star, len(catalog_px[0]) if unmatched
+    #  sep: separation of the matched catalog star, NaN if unmatched or not the mutual nearest
+    #  see matching.match_nearest
+    return matching.match_nearest(np.transpose(stars_px), np.transpose(catalog_px), window_extent_px)
 
 def replace_wcs_fits(header, wcs):
     hdr = remove_wcs_header(header)
@@ -324,6 +252,8 @@ def compute_wcs_fits(filename, out_filename, fwhm_est=2.0, find_threshold=3.0, f
     return out_fits  
 
 def generate_wcs(data, fwhm_est=2.0, find_threshold=3.0, fwhm_min=1.5, min_star_count=15, gaia_request_count=1000, gaia_mag_limit=17, max_match_sep_px=20, gwcs_refine_max_stdev=1.5):
+    from gwcs.wcstools import wcs_from_points
+
     width, height = np.shape(data)
 
     # find star pixel locations, ordered by brightness
@@ -0,0 +1,49 @@
+#%%
+# Time how long a new worker process takes to import abberition modules.
+#
+# Workers import the module of the function they run, so a calibration worker starts by importing
+# abberition.processor. Plotting, astroquery, gwcs and reproject load on first use, so they should
+# not be pulled in by any of these imports. For comparison each module is also timed with those
+# packages imported first, as they were before they were deferred.
+import os
+import statistics
+import subprocess
+import sys
+
+import test_setup
+
+modules = ['abberition.calibration', 'abberition.processor', 'abberition.pipeline', 'abberition.astrometry']
+deferred = ['matplotlib.pyplot', 'astroquery.gaia', 'astroquery.astrometry_net', 'gwcs', 'reproject', 'skimage.io']
+runs = 5
+
+probe = '''
+import sys, time
+start = time.perf_counter()
+{preload}
+import {module}
+print(time.perf_counter() - start, *[name for name in {deferred!r} if name in sys.modules])
+'''
+
+
+def time_import(module:str, preload:bool=False):
+    # median seconds to import module in a new interpreter, and the deferred packages it loaded, from
+    # the last line printed as astroquery prints status messages on import
+    env = dict(os.environ, PYTHONPATH=test_setup.abberition_path)
+    code = probe.format(module=module, deferred=deferred, preload='\n'.join(f'import {name}' for name in deferred) if preload else '')
+
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout.splitlines()[-1].split()
+        times.append(float(out[0]))
+
+    return statistics.median(times), out[1:]
+
+
+print(f'{"module":<26} {"import":>8} {"eager":>8}  deferred packages loaded')
+for module in modules:
+    lazy, loaded = time_import(module)
+    eager, _ = time_import(module, preload=True)
+
+    print(f'{module:<26} {lazy:>7.2f}s {eager:>7.2f}s  {", ".join(loaded) if loaded else "none"}')
+
+# %%
@@ -0,0 +1,41 @@
+#%%
+# Check that sanitizing headers across worker processes gives the same headers as sanitizing them in
+# the current process, including the structural cards (BITPIX, NAXIS...) the library filters on.
+from astropy.io import fits
+import numpy as np
+
+import test_setup
+
+from abberition import image
+
+
+def make_headers(count:int) -> list:
+    headers = []
+    for i in range(count):
+        header = fits.PrimaryHDU(np.zeros((4, 6), dtype=np.uint16)).header
+        header['instrume'] = 'camera'
+        header['xbinning'] = 1
+        header['ybinning'] = 1
+        header['xpixsz'] = 3.76
+        header['ypixsz'] = 3.76
+        header['imagetyp'] = 'Light Frame'
+        header['ccd-temp'] = -10.0 + i * 0.1
+        headers.append(header)
+
+    return headers
+
+
+if __name__ == '__main__':
+    serial = make_headers(16)
+    pooled = make_headers(16)
+
+    image.sanitize_headers(serial, workers=1)
+    image.sanitize_headers(pooled, workers=2)
+
+    for s, p in zip(serial, pooled):
+        assert list(s.items()) == list(p.items()), (s, p)
+        assert all(key in p for key in ['bitpix', 'naxis', 'naxis1', 'naxis2'])
+
+    print(f'{len(serial)} headers identical with 1 and 2 workers')
+
+# %%
@@ -0,0 +1,36 @@
+#%%
+# Check the rejection methods of stack.reject on synthetic stacks: the fraction of values rejected from
+# pure gaussian noise, and the mean of a small stack with a bright trail in one frame.
+import numpy as np
+
+import test_setup
+
+from abberition import stack
+
+rng = np.random.default_rng(0)
+
+
+def rejected_mean(cube:np.ndarray, method:str) -> float:
+    rejected = stack.reject(cube, np.zeros(cube.shape, dtype=bool), method)
+    return float(np.mean(np.nanmean(np.where(rejected, np.nan, cube), axis=0)))
+
+
+if __name__ == '__main__':
+    for n in [8, 30, 100]:
+        noise = rng.normal(100.0, 10.0, (n, 100, 100))
+        rejected = stack.reject(noise, np.zeros(noise.shape, dtype=bool), 'linear_fit')
+
+        # 0.27% of gaussian values are more than 3 sigma from the mean, more are expected from small stacks
+        # as the standard deviation is estimated from fewer values
+        print(f'linear_fit rejects {rejected.mean():.2%} of gaussian noise with {n} frames')
+        assert rejected.mean() < (0.02 if n < 10 else 0.01)
+
+    trail = rng.normal(100.0, 1.0, (8, 50, 50))
+    trail[3] += 1000.0
+
+    for method in ['sigma_clip', 'linear_fit']:
+        mean = rejected_mean(trail, method)
+        print(f'{method} mean with a trail in 1 of 8 frames {mean:.1f}')
+        assert abs(mean - 100.0) < 1.0
+
+# %%